@@ -0,0 +1,211 @@
+import datetime
+import numpy as np
+
+
+class AggregationWattage:
+    """ estimate the actual wattage of many assets from energy_aggregation_daily with one query
+        instead of one query per asset, the daily energy (interpolated_kwh + measured_kwh) of all the assets is fetched at once
+        into numpy arrays ordered by asset_id, aggregation_time, and the daily wattage is computed for all the rows at once:
+          daily wattage = daily energy / night time of the day (24 hours - (sunset - sunrise)) * 1000
+
+        the days with a zero wattage are left out of the per asset statistics, as in the per asset methods
+
+    """
+
+    def __init__(self, sunriseTimeDict, sunsetTimeDict, startDate, endDate):
+        """ compute the night time in hours of each date of the period from the sun time dicts of the script
+
+        """
+        self.startDate = startDate
+        num_days = (endDate - startDate).days + 1
+        daytime_seconds = []
+        for day_index in range(num_days):
+            date = startDate + datetime.timedelta(days=day_index)
+            daytime_seconds.append((sunsetTimeDict[date] - sunriseTimeDict[date]).total_seconds())
+        daytime_seconds_array = np.array(daytime_seconds, dtype=np.float64)
+        #night time in hours and in minutes, indexed by the number of days from startDate
+        self.night_hours_array = 24 - daytime_seconds_array / 60.0 / 60.0
+        self.night_minutes_array = 24 * 60 - daytime_seconds_array / 60.0
+
+        self.asset_id_array = np.empty(0, dtype=np.int64)
+        self.day_index_array = np.empty(0, dtype=np.int64)
+        self.energy_array = np.empty(0, dtype=np.float64)
+        #daily energy values as returned by the db (Decimal for numeric columns), only kept by fetch(keep_values=True)
+        self.energy_values = None
+
+    def fetch(self, cur, start_time, end_time, assets_id_list=None, itersize=100000, keep_values=False):
+        """ fetch the daily energy of the assets with start_time <= aggregation_time < end_time in one query
+            assets_id_list limits the query to some assets (e.g. the shard of a worker), None fetches every asset
+            keep_values also keeps the daily energy in the db type in energy_values, for rounding it like the per asset methods
+
+        """
+        if assets_id_list is None:
+            asset_filter = ""
+            params = (start_time, end_time)
+        else:
+            asset_filter = "b.asset_id = any(%s) and "
+            params = (list(assets_id_list), start_time, end_time)
+        try:
+            cur.execute("select b.asset_id, (a.aggregation_time::date - %%s::date), (a.interpolated_kwh + a.measured_kwh)::float8, a.interpolated_kwh + a.measured_kwh \
+                         from energy_metering_points b, energy_aggregation_daily a \
+                         where %sb.id = a.metering_point_id \
+                         and a.aggregation_time >= %%s and a.aggregation_time < %%s \
+                         order by b.asset_id, a.aggregation_time" % asset_filter, (self.startDate, ) + params)
+        except:
+            print("I am unable to get data")
+
+        asset_id_pieces = []
+        day_index_pieces = []
+        energy_pieces = []
+        energy_values = []
+        rows = cur.fetchmany(itersize)
+        while rows:
+            asset_id_pieces.append(np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)))
+            day_index_pieces.append(np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows)))
+            energy_pieces.append(np.fromiter((np.nan if row[2] is None else row[2] for row in rows), dtype=np.float64, count=len(rows)))
+            if keep_values:
+                energy_values += [row[3] for row in rows if row[3] is not None]
+            rows = cur.fetchmany(itersize)
+
+        if asset_id_pieces:
+            self.asset_id_array = np.concatenate(asset_id_pieces)
+            self.day_index_array = np.concatenate(day_index_pieces)
+            self.energy_array = np.concatenate(energy_pieces)
+        # a missing kwh value gives a null daily energy, skip the day
+        valid = ~np.isnan(self.energy_array)
+        self.asset_id_array = self.asset_id_array[valid]
+        self.day_index_array = self.day_index_array[valid]
+        self.energy_array = self.energy_array[valid]
+        self.energy_values = energy_values if keep_values else None
+        print("fetched %d daily energy rows" % len(self.energy_array))
+
+    def load_from_store(self, dailyEnergyStore, start_time, end_time, assets_id_list=None):
+        """ load the daily energy from a DailyEnergyStore instead of the database, the same arrays as fetch()
+            the store keeps the float8 value of each metering point and day, so the rows are the ones fetch() gets from the db
+            (the metering points of an asset on the same day are ordered by metering point id), no numeric values are kept
+
+        """
+        asset_id_array, energy_matrix, first_date = dailyEnergyStore.window(start_time.date(), end_time.date(), assets_id_list)
+        # the non nan values, ordered by asset id, then by day
+        column_indexes, day_indexes = np.nonzero(~np.isnan(energy_matrix))
+        order = np.lexsort((day_indexes, asset_id_array[column_indexes]))
+        column_indexes = column_indexes[order]
+        day_indexes = day_indexes[order]
+        self.asset_id_array = asset_id_array[column_indexes]
+        self.day_index_array = day_indexes + (first_date - self.startDate).days
+        self.energy_array = np.asarray(energy_matrix[column_indexes, day_indexes], dtype=np.float64)
+        self.energy_values = None
+        print("loaded %d daily energy rows from the store" % len(self.energy_array))
+
+    def group_starts(self, asset_id_array):
+        """ index of the first row of each asset, the rows are ordered by asset id
+
+        """
+        if len(asset_id_array) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(([0], np.flatnonzero(asset_id_array[1:] != asset_id_array[:-1]) + 1))
+
+    def daily_wattage(self):
+        """ the wattage of every fetched row in watts
+
+        """
+        return (self.energy_array / self.night_hours_array[self.day_index_array]) * 1000
+
+    def mean_wattage(self):
+        """ the mean of the non zero daily wattages of each asset
+            return a dict: asset id -> actual wattage, the assets without a non zero day are left out
+
+        """
+        wattage_array = self.daily_wattage()
+        non_zero = wattage_array != 0
+        asset_id_array = self.asset_id_array[non_zero]
+        wattage_array = wattage_array[non_zero]
+        group_starts = self.group_starts(asset_id_array)
+        if len(group_starts) == 0:
+            return {}
+
+        sums = np.add.reduceat(wattage_array, group_starts)
+        counts = np.diff(np.concatenate((group_starts, [len(wattage_array)])))
+
+        return dict(zip(asset_id_array[group_starts].tolist(), (sums / counts).tolist()))
+
+    def median_wattage(self):
+        """ the median of the non zero daily wattages of each asset
+            return a dict: asset id -> actual wattage, the assets without a non zero day are left out
+
+        """
+        wattage_array = self.daily_wattage()
+        non_zero = wattage_array != 0
+        asset_id_array = self.asset_id_array[non_zero]
+        wattage_array = wattage_array[non_zero]
+        # sort the wattages inside each asset, the assets stay in order
+        order = np.lexsort((wattage_array, asset_id_array))
+        asset_id_array = asset_id_array[order]
+        wattage_array = wattage_array[order]
+        group_starts = self.group_starts(asset_id_array)
+        if len(group_starts) == 0:
+            return {}
+
+        counts = np.diff(np.concatenate((group_starts, [len(wattage_array)])))
+        lower = wattage_array[group_starts + (counts - 1) // 2]
+        upper = wattage_array[group_starts + counts // 2]
+
+        return dict(zip(asset_id_array[group_starts].tolist(), ((lower + upper) / 2.0).tolist()))
+
+    def nominal_wattage_violations(self, nominal_wattage_dict, margin_kwh=0.2):
+        """ find the days where an asset consumed more than margin_kwh above its normal energy consumption,
+            the normal energy consumption is the nominal wattage during the night time: (nominal_wattage * night minutes / 60) / 1000 kwh
+
+            the expected energy of every fetched (asset, day) row is computed at once from the nominal wattage of the asset
+            and the night time of the day, only the rows over the margin are returned
+
+            return a list of (asset_id, date, daily_energy, normal_energy), ordered by asset_id, aggregation_time
+
+        """
+        asset_ids, asset_index_array = np.unique(self.asset_id_array, return_inverse=True)
+        # an asset without nominal wattage never violates
+        nominal_wattage_array = np.array([np.nan if nominal_wattage_dict.get(asset_id) is None else float(nominal_wattage_dict[asset_id]) for asset_id in asset_ids.tolist()], dtype=np.float64)
+        normal_energy_array = (nominal_wattage_array[asset_index_array] * self.night_minutes_array[self.day_index_array] / 60.0) / 1000.0
+        violation_index = np.flatnonzero(self.energy_array - normal_energy_array > margin_kwh)
+
+        violations = []
+        for asset_id, day_index, daily_energy, normal_energy in zip(self.asset_id_array[violation_index].tolist(), self.day_index_array[violation_index].tolist(), self.energy_array[violation_index].tolist(), normal_energy_array[violation_index].tolist()):
+            violations.append((asset_id, self.startDate + datetime.timedelta(days=day_index), daily_energy, normal_energy))
+
+        return violations
+
+    def rolling_window_wattage(self, normal_energy_method, window_size=30):
+        """ the wattage of each asset from the normal daily energy of its first window_size days, like the barcelona reverse engineering:
+            the daily energy is rounded to 0.1 kwh, the zero days are left out and normal_energy_method(list of daily energy)
+            gives the normal daily energy, which is divided by the night time of the last day of the window
+
+            with fetch(keep_values=True) the energy is rounded in the db type like the per asset method: round(Decimal, 1)
+            rounds the exact decimal value while a float8 value rounds its binary approximation (0.35 -> 0.4 as a Decimal, 0.3 as a float),
+            the rounded values are converted to float after the rounding so the counting and tie-breaking see the same values,
+            without kept values the float energy is rounded
+
+            return a dict: asset id -> actual wattage, the assets without a non zero day are left out
+
+        """
+        group_starts = self.group_starts(self.asset_id_array)
+        group_ends = np.concatenate((group_starts[1:], [len(self.asset_id_array)])).astype(np.int64)
+        window_ends = np.minimum(group_ends, group_starts + window_size)
+        energy_values = self.energy_values if self.energy_values is not None else self.energy_array.tolist()
+
+        asset_ids = []
+        normal_energy_list = []
+        last_day_indexes = []
+        for asset_id, window_start, window_end in zip(self.asset_id_array[group_starts].tolist(), group_starts.tolist(), window_ends.tolist()):
+            energy_rolling_window = [float(round(x, 1)) for x in energy_values[window_start:window_end]]
+            energy_rolling_window = [x for x in energy_rolling_window if x != 0]
+            if len(energy_rolling_window) == 0:
+                continue
+            asset_ids.append(asset_id)
+            normal_energy_list.append(normal_energy_method(energy_rolling_window))
+            last_day_indexes.append(self.day_index_array[window_end - 1])
+        if len(asset_ids) == 0:
+            return {}
+
+        wattage_array = (np.array(normal_energy_list, dtype=np.float64) / self.night_hours_array[np.array(last_day_indexes, dtype=np.int64)]) * 1000
+
+        return dict(zip(asset_ids, wattage_array.tolist()))
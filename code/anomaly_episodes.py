@@ -0,0 +1,49 @@
+class EpisodeCoalescer:
+    """ merge consecutive flagged reading intervals of an asset into episodes while the intervals are streamed
+        an episode is a run of back-to-back intervals (each one starts where the previous one ended)
+        with the same status and calendar percentage, it is closed by a normal interval, a gap or a change of status
+
+        each closed episode is appended to the results list as:
+          asset columns + (episode_start, episode_end, duration_seconds, energy_kwh, mean_watts, calendar_percentage, status, num_intervals)
+
+    """
+
+    def __init__(self, results, asset_columns):
+        """ initialize variables
+
+            input args:
+              results: the list the episode records are appended to
+              asset_columns: tuple of the asset columns repeated at the start of each record
+
+        """
+        self.results = results
+        self.asset_columns = asset_columns
+        #the open episode: [start, end, energy_kwh, calendar_percentage, status, num_intervals], None if there is no open episode
+        self.episode = None
+
+    def add_interval(self, start_time, end_time, energy_consumed, calendar_percentage, status):
+        """ add a flagged interval, it extends the open episode or starts a new one
+
+        """
+        episode = self.episode
+        if episode is not None and episode[1] == start_time and episode[3] == calendar_percentage and episode[4] == status:
+            episode[1] = end_time
+            episode[2] += energy_consumed
+            episode[5] += 1
+            return
+
+        self.end_episode()
+        self.episode = [start_time, end_time, energy_consumed, calendar_percentage, status, 1]
+
+    def end_episode(self):
+        """ close the open episode, if any
+
+        """
+        if self.episode is None:
+            return
+
+        start_time, end_time, energy_consumed, calendar_percentage, status, num_intervals = self.episode
+        duration = (end_time - start_time).total_seconds()
+        mean_watts = (energy_consumed * 1000) / (duration / 3600.0)
+        self.results.append(self.asset_columns + (start_time, end_time, duration, energy_consumed, mean_watts, calendar_percentage, status, num_intervals))
+        self.episode = None
@@ -0,0 +1,66 @@
+class AssetMetadataLoader:
+    """ load the metadata of all valid assets (not deleted, installation_date and commissioning_date are not null) in one query
+        replace the getComponentsList methods which send four queries per asset (components, streets, communications_nodes, luminaire_types)
+
+        every component / cabinet / luminaire lookup is a set-based join, when an asset has several matching rows
+        the one with the smallest component id is used, and assets without a match are left out
+
+    """
+
+    def __init__(self, cur):
+        """ initialize variables
+
+        """
+        #database cursor
+        self.cur = cur
+
+    def get_components_list(self, with_wattage=True, dimming_calendar_id=None):
+        """ get the components list for all valid assets
+
+            input args:
+              with_wattage: if True, each tuple ends with the luminaire actual wattage
+              dimming_calendar_id: if not None, only the assets following this dimming calendar are returned
+
+            return a list of tuples ordered by asset id
+              (asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, wattage)
+              or without wattage if with_wattage is False
+
+        """
+        select_fields = "a.id, lc.component_id, a.latitude, a.longitude, a.installation_date, a.commissioning_date, s.name as street_name, cn.cabinet_id"
+        joins = "join (select distinct on (asset_id) asset_id, id as component_id \
+                       from components \
+                       where is_deleted = 'f' and component_kind = 0 \
+                       order by asset_id, id) lc on lc.asset_id = a.id \
+                 join streets as s on s.id = a.street_id \
+                 join (select distinct on (c.asset_id) c.asset_id, n.parent_id as cabinet_id \
+                       from components c, communications_nodes n \
+                       where c.id = n.id \
+                       order by c.asset_id, c.id) cn on cn.asset_id = a.id"
+        if with_wattage:
+            select_fields += ", lw.actual_wattage"
+            joins += " join (select distinct on (c.asset_id) c.asset_id, lt.actual_wattage \
+                             from luminaire_types lt, luminaires l, components c \
+                             where c.id = l.id and l.luminaire_type_id = lt.id \
+                             order by c.asset_id, c.id) lw on lw.asset_id = a.id"
+        conditions = "a.is_deleted = 'f' and a.installation_date is not null and a.commissioning_date is not null"
+        params = ()
+        if dimming_calendar_id is not None:
+            joins += " join (select distinct on (c.asset_id) c.asset_id, n.dimming_calendar_id \
+                             from components c, communications_nodes n \
+                             where c.id = n.id and n.dimming_calendar_id is not null \
+                             order by c.asset_id, c.id) dc on dc.asset_id = a.id"
+            conditions += " and dc.dimming_calendar_id = %s"
+            params = (dimming_calendar_id, )
+
+        try:
+            self.cur.execute("select " + select_fields + " from assets as a " + joins + " where " + conditions + " order by a.id", params)
+        except:
+            print("I am unable to get data")
+
+        rows = self.cur.fetchall()
+
+        results = []
+        for row in rows:
+            results.append(tuple(row))
+
+        return results
@@ -1,11 +1,16 @@
 import datetime
 from sunrise import sun
+from suntime_table import SunTimeTable, SunTimeDict
 import psycopg2
-import csv
 import sys
 import json
 import statistics
 from collections import Counter
+from asset_metadata import AssetMetadataLoader
+from aggregation_wattage import AggregationWattage
+from daily_energy_store import DailyEnergyStore
+from parallel_runner import ParallelRunner
+from csv_sink import open_sink
 
 class DayburnerEnergyNominalWattage:
 
@@ -77,6 +82,16 @@ class DayburnerEnergyNominalWattage:
             self.suntime_latitude = float(config_data['suntime_location_latitude'])
             #suntime location longitude
             self.suntime_longitude = float(config_data['suntime_location_longitude'])
+            #directory of the persisted sun time tables, empty means the table is only kept in memory
+            self.suntime_table_dir = config_data.get('suntime_table_dir', '')
+            #number of worker processes, each one computes shards of the components list with its own db connection, optional
+            self.num_workers = int(config_data.get('num_workers', '1'))
+            #report a day when its energy consumption is this many kwh above the normal energy consumption, optional
+            self.energy_margin_kwh = float(config_data.get('energy_margin_kwh', '0.2'))
+            #detect the days of all the components from one energy_aggregation_daily query (see aggregation_wattage.py), optional
+            self.bulk_detection = config_data.get('bulk_detection', 'true').lower() == 'true'
+            #directory of the daily energy store (see daily_energy_store.py), the bulk detection syncs it and reads the daily energy from it, optional
+            self.daily_energy_store_dir = config_data.get('daily_energy_store_dir', '')
 
             # sunrise time offset
             sunrise_time_delta_hours = int(config_data['sunrise_time_delta_hours'])
@@ -128,99 +143,27 @@ class DayburnerEnergyNominalWattage:
                 endDate:   datetime.date() variable, the end of a time period 
         """    
         self.sun = sun(lat=latitude, long=longitude)
-        dateTime = datetime.datetime.combine(startDate, datetime.time(hour=8))
-        while dateTime.date() <= endDate:        
-            daytimeStart, daytimeEnd = self.computeDaytimeStartEnd(dateTime)
-            self.sunriseTimeDict[dateTime.date()] = daytimeStart
-            self.sunsetTimeDict[dateTime.date()] = daytimeEnd
-            dateTime += self.oneDayDelta  
+        #the dates outside [startDate, endDate] are computed on demand, the table is saved for the next runs
+        self.sunTimeTable = SunTimeTable(latitude, longitude, self.suntime_table_dir)
+        self.sunriseTimeDict = SunTimeDict(self.sunTimeTable, 'sunrise')
+        self.sunsetTimeDict = SunTimeDict(self.sunTimeTable, 'sunset')
+        self.sunriseTimeDict.fill(startDate, endDate)
+        self.sunsetTimeDict.fill(startDate, endDate)
+        self.sunTimeTable.save()
             
     def getComponentsList(self):
         """ get assets list from assets table, which are not deleted and installation_date and commissioning_date are not null
+            the component, street, cabinet and wattage are loaded for all assets at once by the shared AssetMetadataLoader
+            only the assets following the 100% calendar (dimming calendar 1) are returned
 
-        """                
-        try:
-            self.cur.execute("select id, latitude, longitude, installation_date, commissioning_date \
-                              from assets \
-                              where is_deleted = 'f' \
-                              and installation_date is not null and commissioning_date is not null")
-        except:
-            print("I am unable to get data")
-
-        rows = self.cur.fetchall()   
-        results = []
-        for row in rows:
-            asset_id = row[0]
-            latitude = row[1]
-            longitude = row[2]
-            installation_date = row[3]
-            commissioning_date = row[4]
-
-            try:
-                self.cur.execute("select dimming_calendar_id \
-                                  from components A, communications_nodes B \
-                                  where A.id = B.id and asset_id = %s \
-                                  and dimming_calendar_id is not null", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            calendar_id_row = self.cur.fetchone()
-            # print(asset_id, calendar_id_row)
-            calendar_id = int(calendar_id_row[0])
-            if calendar_id != 1:
-                # this asset doesn't follow the 100% calendar, ignore it in this analysis
-                continue
-
-            try:
-                self.cur.execute("select id \
-                                  from components \
-                                  where asset_id = %s \
-                                  and is_deleted = 'f' and component_kind = 0", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            component_id_row = self.cur.fetchone() 
-            component_id = component_id_row[0]
-
-            try:
-                self.cur.execute("select s.name as street_name \
-                                  from assets as a, streets as s \
-                                  where a.id = %s \
-                                  and a.street_id = s.id", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            street_name_row = self.cur.fetchone() 
-            street_name = street_name_row[0]
-
-            try:
-                self.cur.execute("select parent_id \
-                                  from components A,communications_nodes B \
-                                  where A.id=B.id and asset_id = %s", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            cabinet_id_row = self.cur.fetchone()     
-            cabinet_id = cabinet_id_row[0]
-
-            try:
-                self.cur.execute("select c.asset_id, lt.type_designation, lt.actual_wattage \
-                                  from luminaire_types lt, luminaires l, components c \
-                                  where c.asset_id = %s and c.id = l.id and l.luminaire_type_id = lt.id", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            nominal_wattage_row = self.cur.fetchone()     
-            nominal_wattage = nominal_wattage_row[2]
-
-            results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, nominal_wattage))
-
-        return results                     
+        """
+        metadataLoader = AssetMetadataLoader(self.cur)
+        return metadataLoader.get_components_list(dimming_calendar_id=1)
 
     def detect_dayburners_with_nominal_wattage(self, asset_tuple, start_time, end_time):
         """ use the nominal wattage and suntime to compute the normal energy consumption for each day
             get the actual daily energy consumption from the energy_aggregation_daily table, which is measured_kwh + interpolated_kwh  
-            report if the energy consumption differs by 0.1 kwh or 0.2 kwh between the normal and actual one
+            report if the energy consumption is more than energy_margin_kwh (0.2 kwh by default) above the normal one
 
         """
         asset_id = asset_tuple[0]
@@ -264,37 +207,106 @@ class DayburnerEnergyNominalWattage:
             # compute the normal energy consumption in kwh using night time and nominal wattage
             normal_energy_consumption = (nominal_wattage * nighttime_in_min / 60.0) / 1000.0 
 
-            if dailyEnergyConsumption - normal_energy_consumption > 0.2:
-                # actual energy consumption is more than 0.2 kwh higher than normal_energy_consumption, report that
+            if dailyEnergyConsumption - normal_energy_consumption > self.energy_margin_kwh:
+                # actual energy consumption is more than the margin higher than normal_energy_consumption, report that
                 results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, nominal_wattage, currentDate, dailyEnergyConsumption, normal_energy_consumption))
 
         return results
 
+    def detect_dayburners_bulk(self, component_id_list, start_time, end_time):
+        """ bulk version of detect_dayburners_with_nominal_wattage for a list of components:
+            one query for the daily energy of all the components, the normal energy of every day is computed at once
+            return the records in the order of the components list, then by date
+
+        """
+        aggregationWattage = AggregationWattage(self.sunriseTimeDict, self.sunsetTimeDict, start_time.date(), end_time.date())
+        dailyEnergyStore = None
+        if self.daily_energy_store_dir:
+            dailyEnergyStore = DailyEnergyStore(self.daily_energy_store_dir, self.pg_dbname)
+        if dailyEnergyStore is not None and dailyEnergyStore.covers(start_time.date(), end_time.date()):
+            aggregationWattage.load_from_store(dailyEnergyStore, start_time, end_time, [asset_tuple[0] for asset_tuple in component_id_list])
+        else:
+            aggregationWattage.fetch(self.cur, start_time, end_time, [asset_tuple[0] for asset_tuple in component_id_list])
+        nominal_wattage_dict = dict((asset_tuple[0], asset_tuple[8]) for asset_tuple in component_id_list)
+
+        asset_violations_dict = {}
+        for (asset_id, currentDate, dailyEnergyConsumption, normal_energy_consumption) in aggregationWattage.nominal_wattage_violations(nominal_wattage_dict, self.energy_margin_kwh):
+            asset_violations_dict.setdefault(asset_id, []).append((currentDate, dailyEnergyConsumption, normal_energy_consumption))
+
+        records = []
+        for asset_tuple in component_id_list:
+            for violation in asset_violations_dict.get(asset_tuple[0], []):
+                records.append(tuple(asset_tuple[:9]) + violation)
+
+        return records
+
     def computeResults(self, component_id_list):
-        """ compute results
+        """ compute results and write them to the output file
+            with num_workers > 1 the components list is split into shards computed by worker processes,
+            the records are written to the output file as soon as they are computed
 
-        """    
+        """
+        if self.bulk_detection and self.daily_energy_store_dir:
+            # the store is synced once here, the workers only read it
+            self.sync_daily_energy_store()
+        with open_sink(self.outputFilename, self.get_title_row()) as sink:
+            if self.num_workers > 1:
+                parallelRunner = ParallelRunner(DayburnerEnergyNominalWattage, self.configFilename, self.num_workers)
+                parallelRunner.run(component_id_list, 'compute_records', sink=sink)
+            else:
+                self.compute_records(component_id_list, sink)
+
+    def sync_daily_energy_store(self):
+        """ append the days of the period missing from the daily energy store, a new store starts at the period start date
+            a store starting after the period start date does not cover the period, the daily energy is fetched from the db then
+
+        """
+        dailyEnergyStore = DailyEnergyStore(self.daily_energy_store_dir, self.pg_dbname)
+        num_new_days = dailyEnergyStore.sync(self.cur, self.startDate, self.endDate)
+        print("%d new days in the daily energy store" % num_new_days)
+        if not dailyEnergyStore.covers(self.startDate, self.endDate):
+            print("the daily energy store starts after the period start date, the daily energy is fetched from the db")
+
+    def get_title_row(self):
+        """ title row of the output file
+
+        """
+        return ('asset_id', 'component_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'cabinet_id', 'nominal_wattage', 'current_date', 'actual_energy_consumption', 'normal_energy_consumption')
+
+    def compute_records(self, component_id_list, sink=None):
+        """ compute the records of the output file for a list of components
+            if a sink is given, the records of each component are written to it and an empty list is returned
+
+        """
         count = 0
         start_time = datetime.datetime.combine(self.startDate, datetime.time())
         end_time = datetime.datetime.combine(self.endDate, datetime.time())
-        with open(self.outputFilename, "w") as csvFile:
-            csvWriter = csv.writer(csvFile, delimiter=',')  
-            title_row = ('asset_id', 'component_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'cabinet_id', 'nominal_wattage', 'current_date', 'actual_energy_consumption', 'normal_energy_consumption')
-            csvWriter.writerow(title_row)     
-            for component_id_tuple in component_id_list:
-                count += 1
-                #only compute for first 500 components
-                #if count > 500:
-                #    break
-                print(count)
-                #print(component_id_tuple)
-                
-                results = self.detect_dayburners_with_nominal_wattage(component_id_tuple, start_time, end_time)              
-                #print('len of results: ', len(results))
-                #the results returned is a list of tuples
-                #if len(results) > 0:
-                for record in results:
-                    csvWriter.writerow(record)     
+        if self.bulk_detection:
+            records = self.detect_dayburners_bulk(component_id_list, start_time, end_time)
+            if sink is not None:
+                sink.write_batch(records)
+                return []
+            return records
+
+        records = []
+        for component_id_tuple in component_id_list:
+            count += 1
+            #only compute for first 500 components
+            #if count > 500:
+            #    break
+            print(count)
+            #print(component_id_tuple)
+            
+            results = self.detect_dayburners_with_nominal_wattage(component_id_tuple, start_time, end_time)              
+            #print('len of results: ', len(results))
+            #the results returned is a list of tuples
+            #if len(results) > 0:
+            if sink is not None:
+                sink.write_batch(results)
+            else:
+                records += results
+
+        return records
 
     def run(self):
         """  call this method to run the program
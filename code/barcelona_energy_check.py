@@ -4,6 +4,7 @@ import csv
 import json
 import datetime
 import statistics
+from rolling_stats import RollingDeviationDetector
 
 class BarcelonaEnergyCheck:
     def __init__(self):
@@ -18,6 +19,9 @@ class BarcelonaEnergyCheck:
         self.pg_host = "citytouch-buenos-aires-log.cuxwb2nbset5.us-west-2.rds.amazonaws.com"
         self.pg_port = "5432"
 
+        #rolling window of 30 days, report the days more than 1.5 stdev and 0.2 kwh above the window average
+        self.rollingDeviationDetector = RollingDeviationDetector(window_size=30, num_std_threshold=1.5, energy_deviation_threshold=0.2)
+
     def connect_db(self):
         """ build connection to the database
 
@@ -269,6 +273,7 @@ class BarcelonaEnergyCheck:
     def find_dayburners_energy_deviation_rolling_window_avg(self, asset_tuple, start_time, end_time):
         """ find dayburners by calculating energy deviation from 30 day rolling window average 
             if # of stdev > 1.5 and deviation > 0.2 kwh, report that record
+            the window length and both thresholds are set on the RollingDeviationDetector
         """
 
         asset_id = asset_tuple[0]
@@ -291,7 +296,7 @@ class BarcelonaEnergyCheck:
 
         rows = self.cur.fetchall()
 
-        energy_rolling_window = []
+        energy_rolling_window = self.rollingDeviationDetector.new_window()
         results = []
         lastTime = None
         lastDate = None
@@ -311,34 +316,12 @@ class BarcelonaEnergyCheck:
                 num_days = (currentDate - lastDate).days
                 dailyEnergyConsumption = energyConsumption / num_days
                 #print(lastTime, dailyEnergyConsumption)
-                if len(energy_rolling_window) == 30:
-                    # the rolling window is full
-                    # compute the mean and std of energy consumption within the rolling window       
-                    avg_energy_consumption = statistics.mean(energy_rolling_window)
-                    std_energy_consumption = statistics.stdev(energy_rolling_window)
-                    if std_energy_consumption == 0:
-                        if dailyEnergyConsumption - avg_energy_consumption > 0.2:
-                            results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, lastDate, dailyEnergyConsumption, avg_energy_consumption, std_energy_consumption, None))
-                    else:    
-                        num_std = (dailyEnergyConsumption - avg_energy_consumption) / std_energy_consumption
-                        #if num_std < -1.5 or num_std > 1.5:
-                        if num_std > 1.5 and dailyEnergyConsumption - avg_energy_consumption > 0.2:
-                            results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, lastDate, dailyEnergyConsumption, avg_energy_consumption, std_energy_consumption, num_std))
-                    '''
-                    energy_deviation = dailyEnergyConsumption - avg_energy_consumption
-                    #if energy_deviation < -0.2 or energy_deviation > 0.2:
-                    if energy_deviation > 0.2:    
-                        #report this abnormal case
-                        #print('{0} {1:5.1f} {2: 5.4f} {3} {4:5.1f} {5} {6:5.1f}'.format(asset_id, dailyEnergyConsumption, num_std, lastDate, lastEnergy, currentDate, currentEnergy))
-                        
-                        results.append((asset_id, lastDate, dailyEnergyConsumption, avg_energy_consumption, energy_deviation))
-                    '''
-                    #update rolling window    
-                    energy_rolling_window.pop(0)
-                    energy_rolling_window.append(dailyEnergyConsumption)    
-                else:
-                    # the rolling window is not full, just append new element to the end of the rolling window
-                    energy_rolling_window.append(dailyEnergyConsumption)    
+                # once the rolling window is full, compare with the mean and std of energy consumption within the rolling window,
+                # then the day is added to the rolling window
+                deviation = self.rollingDeviationDetector.check(energy_rolling_window, dailyEnergyConsumption)
+                if deviation is not None:
+                    avg_energy_consumption, std_energy_consumption, num_std = deviation
+                    results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, lastDate, dailyEnergyConsumption, avg_energy_consumption, std_energy_consumption, num_std))
                 #update record
                 lastTime = currentTime    
                 lastDate = currentDate
@@ -1,11 +1,16 @@
 import datetime
 from sunrise import sun
+from suntime_table import SunTimeTable, SunTimeDict
 import psycopg2
 import csv
 import sys
 import json
 import statistics
 from collections import Counter
+from asset_metadata import AssetMetadataLoader
+from aggregation_wattage import AggregationWattage
+from parallel_runner import ParallelRunner
+from csv_sink import open_sink
 
 class DayburnerEnergyOnly:
 
@@ -72,73 +77,20 @@ class DayburnerEnergyOnly:
             self.suntime_latitude = float(config_data['suntime_location_latitude'])
             #suntime location longitude
             self.suntime_longitude = float(config_data['suntime_location_longitude'])
+            #directory of the persisted sun time tables, empty means the table is only kept in memory
+            self.suntime_table_dir = config_data.get('suntime_table_dir', '')
+            #compute the actual wattage of all the assets from one energy_aggregation_daily query (see aggregation_wattage.py), optional
+            self.bulk_wattage = config_data.get('bulk_wattage', 'true').lower() == 'true'
+            #number of worker processes, each one computes shards of the components list with its own db connection, optional
+            self.num_workers = int(config_data.get('num_workers', '1'))
          
     def getComponentsList(self):
         """ get assets list from assets table, which are not deleted and installation_date and commissioning_date are not null
+            the component, street, cabinet and wattage are loaded for all assets at once by the shared AssetMetadataLoader
 
-        """                
-        try:
-            self.cur.execute("select id, latitude, longitude, installation_date, commissioning_date \
-                              from assets \
-                              where is_deleted = 'f' \
-                              and installation_date is not null and commissioning_date is not null")
-        except:
-            print("I am unable to get data")
-
-        rows = self.cur.fetchall()   
-        results = []
-        for row in rows:
-            asset_id = row[0]
-            latitude = row[1]
-            longitude = row[2]
-            installation_date = row[3]
-            commissioning_date = row[4]
-
-            try:
-                self.cur.execute("select id \
-                                  from components \
-                                  where asset_id = %s \
-                                  and is_deleted = 'f' and component_kind = 0", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            component_id_data = self.cur.fetchall() 
-            component_id = component_id_data[0][0] 
-
-            try:
-                self.cur.execute("select s.name as street_name \
-                                  from assets as a, streets as s \
-                                  where a.id = %s \
-                                  and a.street_id = s.id", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            street_name_data = self.cur.fetchall() 
-            street_name = street_name_data[0][0]
-
-            try:
-                self.cur.execute("select parent_id \
-                                  from components A,communications_nodes B \
-                                  where A.id=B.id and asset_id = %s", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            cabinet_id_data = self.cur.fetchall()     
-            cabinet_id = cabinet_id_data[0][0]
-
-            try:
-                self.cur.execute("select c.asset_id, lt.type_designation, lt.actual_wattage \
-                                  from luminaire_types lt, luminaires l, components c \
-                                  where c.asset_id = %s and c.id = l.id and l.luminaire_type_id = lt.id", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            nominal_wattage_data = self.cur.fetchall()     
-            nominal_wattage = nominal_wattage_data[0][2]
-
-            results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, nominal_wattage))
-
-        return results  
+        """
+        metadataLoader = AssetMetadataLoader(self.cur)
+        return metadataLoader.get_components_list()
 
     def computeDaytimeStartEnd(self, date):
         """
@@ -172,12 +124,13 @@ class DayburnerEnergyOnly:
                 endDate:   datetime.date() variable, the end of a time period 
         """    
         self.sun = sun(lat=latitude, long=longitude)
-        dateTime = datetime.datetime.combine(startDate, datetime.time(hour=8))
-        while dateTime.date() <= endDate:        
-            daytimeStart, daytimeEnd = self.computeDaytimeStartEnd(dateTime)
-            self.sunriseTimeDict[dateTime.date()] = daytimeStart
-            self.sunsetTimeDict[dateTime.date()] = daytimeEnd
-            dateTime += self.oneDayDelta     
+        #the dates outside [startDate, endDate] are computed on demand, the table is saved for the next runs
+        self.sunTimeTable = SunTimeTable(latitude, longitude, self.suntime_table_dir)
+        self.sunriseTimeDict = SunTimeDict(self.sunTimeTable, 'sunrise')
+        self.sunsetTimeDict = SunTimeDict(self.sunTimeTable, 'sunset')
+        self.sunriseTimeDict.fill(startDate, endDate)
+        self.sunsetTimeDict.fill(startDate, endDate)
+        self.sunTimeTable.save()
 
     def find_dayburners_energy_with_actual_wattage(self, asset_tuple, actual_wattage, start_time, end_time):
         """ find dayburners by use actual wattage, which is computed by reverse engineering
@@ -414,6 +367,16 @@ class DayburnerEnergyOnly:
 
         return actual_wattage      
 
+    def compute_actual_wattage_bulk(self, component_id_list, start_time, end_time):
+        """ bulk version of compute_actual_wattage_from_aggregation_energy for a list of components, with one query
+            return a dict: asset id -> actual wattage, the assets without a non zero day are left out
+
+        """
+        aggregationWattage = AggregationWattage(self.sunriseTimeDict, self.sunsetTimeDict, start_time.date(), end_time.date())
+        aggregationWattage.fetch(self.cur, start_time, end_time, [component_id_tuple[0] for component_id_tuple in component_id_list], keep_values=True)
+
+        return aggregationWattage.rolling_window_wattage(self.get_avg_top2_most_frequent_value)
+
     def get_most_frequent_value(self, energy_rolling_window):
         """ get the most frequent value from the input energy_rolling_window
             and assume it is the normal daily energy consumption value
@@ -441,9 +404,29 @@ class DayburnerEnergyOnly:
             return (top1_value + top2_value) / 2.0
                 
     def computeResults(self, component_id_list):
-        """ compute results
+        """ compute results and write them to the output file
+            with num_workers > 1 the components list is split into shards computed by worker processes,
+            the records are written to the output file as soon as they are computed
 
-        """    
+        """
+        with open_sink(self.outputFilename, self.get_title_row()) as sink:
+            if self.num_workers > 1:
+                parallelRunner = ParallelRunner(DayburnerEnergyOnly, self.configFilename, self.num_workers, 'prepare_worker')
+                parallelRunner.run(component_id_list, 'compute_records', sink=sink)
+            else:
+                self.compute_records(component_id_list, sink)
+
+    def get_title_row(self):
+        """ title row of the output file
+
+        """
+        return ('asset_id', 'component_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'cabinet_id', 'nominal_wattage', 'actual_wattage', 'current_date', 'dailyEnergyConsumption', 'normal_energy_consumption', 'actual_on_time_in_min', 'nighttime_in_min')
+
+    def compute_records(self, component_id_list, sink=None):
+        """ compute the records of the output file for a list of components
+            if a sink is given, the records of each component are written to it and an empty list is returned
+
+        """
         #id = 3776
         #latitude = -6.118187
         #longitude = 106.894265
@@ -454,31 +437,45 @@ class DayburnerEnergyOnly:
         count = 0
         start_time = datetime.datetime.combine(self.startDate, datetime.time())
         end_time = datetime.datetime.combine(self.endDate, datetime.time())
-        with open(self.outputFilename, "w") as csvFile:
-            csvWriter = csv.writer(csvFile, delimiter=',')  
-            title_row = ('asset_id', 'component_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'cabinet_id', 'nominal_wattage', 'actual_wattage', 'current_date', 'dailyEnergyConsumption', 'normal_energy_consumption', 'actual_on_time_in_min', 'nighttime_in_min')
-            csvWriter.writerow(title_row)     
-            for component_id_tuple in component_id_list:
-                count += 1
-                #only compute for first 500 components
-                #if count > 500:
-                #    break
-                print(count)
-                #print(component_id_tuple)
-                #actual_wattage = self.compute_actual_wattage(component_id_tuple, start_time, end_time)
+        records = []
+        if self.bulk_wattage:
+            actual_wattage_dict = self.compute_actual_wattage_bulk(component_id_list, start_time, end_time)
+        for component_id_tuple in component_id_list:
+            count += 1
+            #only compute for first 500 components
+            #if count > 500:
+            #    break
+            print(count)
+            #print(component_id_tuple)
+            #actual_wattage = self.compute_actual_wattage(component_id_tuple, start_time, end_time)
+            if self.bulk_wattage:
+                actual_wattage = actual_wattage_dict.get(component_id_tuple[0])
+            else:
                 actual_wattage = self.compute_actual_wattage_from_aggregation_energy(component_id_tuple, start_time, end_time)
-                if actual_wattage is None:
-                    continue
+            if actual_wattage is None:
+                continue
+
+            #print(actual_wattage)    
+
+            #results = self.find_dayburners_energy_with_actual_wattage(component_id_tuple, actual_wattage, start_time, end_time)             
+            results = self.find_dayburners_aggregation_energy_with_actual_wattage(component_id_tuple, actual_wattage, start_time, end_time)                
+            #print('len of results: ', len(results))
+            #the results returned is a list of tuples
+            #if len(results) > 0:
+            if sink is not None:
+                sink.write_batch(results)
+            else:
+                records += results
 
-                #print(actual_wattage)    
+        return records
 
-                #results = self.find_dayburners_energy_with_actual_wattage(component_id_tuple, actual_wattage, start_time, end_time)             
-                results = self.find_dayburners_aggregation_energy_with_actual_wattage(component_id_tuple, actual_wattage, start_time, end_time)                
-                #print('len of results: ', len(results))
-                #the results returned is a list of tuples
-                #if len(results) > 0:
-                for record in results:
-                    csvWriter.writerow(record)    
+    def prepare_worker(self):
+        """ prepare a worker process of the parallel runner: read the config, open its own db connection and compute the sun time
+
+        """
+        self.getConfig(self.configFilename)
+        self.connectDB()
+        self.computeSunTime(self.suntime_latitude, self.suntime_longitude, self.startDate, self.endDate)
 
     def find_actual_wattage_greater_than_nominal_wattage(self, component_id_list):
         """ report the assets where computed actual wattage is greater than the nominal wattage
@@ -487,6 +484,8 @@ class DayburnerEnergyOnly:
         count = 0
         start_time = datetime.datetime.combine(self.startDate, datetime.time())
         end_time = datetime.datetime.combine(self.endDate, datetime.time())
+        if self.bulk_wattage:
+            actual_wattage_dict = self.compute_actual_wattage_bulk(component_id_list, start_time, end_time)
         with open(self.outputFilename, "w") as csvFile:
             csvWriter = csv.writer(csvFile, delimiter=',')  
             title_row = ('asset_id', 'component_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'cabinet_id', 'nominal_wattage', 'actual_wattage')
@@ -498,7 +497,10 @@ class DayburnerEnergyOnly:
                 #    break
                 print(count)
                 #print(component_id_tuple)
-                actual_wattage = self.compute_actual_wattage_from_aggregation_energy(component_id_tuple, start_time, end_time)
+                if self.bulk_wattage:
+                    actual_wattage = actual_wattage_dict.get(component_id_tuple[0])
+                else:
+                    actual_wattage = self.compute_actual_wattage_from_aggregation_energy(component_id_tuple, start_time, end_time)
                 if actual_wattage is None:
                     continue
 
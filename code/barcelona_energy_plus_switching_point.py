@@ -1,10 +1,13 @@
 import datetime
 from sunrise import sun
+from suntime_table import SunTimeTable, SunTimeDict
 import psycopg2
-import csv
 import sys
 import json
-import statistics
+from rolling_stats import RollingDeviationDetector
+from asset_metadata import AssetMetadataLoader
+from parallel_runner import ParallelRunner
+from csv_sink import open_sink
 
 class DayburnerEnergyPlusSwitchingPoint:
 
@@ -71,65 +74,25 @@ class DayburnerEnergyPlusSwitchingPoint:
             self.suntime_latitude = float(config_data['suntime_location_latitude'])
             #suntime location longitude
             self.suntime_longitude = float(config_data['suntime_location_longitude'])
+            #directory of the persisted sun time tables, empty means the table is only kept in memory
+            self.suntime_table_dir = config_data.get('suntime_table_dir', '')
+            #number of worker processes, each one computes shards of the components list with its own db connection, optional
+            self.num_workers = int(config_data.get('num_workers', '1'))
+            #rolling window length in days, number of stdev and deviation in kwh for the energy deviation check, optional
+            rolling_window_days = int(config_data.get('rolling_window_days', '30'))
+            num_std_threshold = float(config_data.get('num_std_threshold', '1.5'))
+            energy_deviation_threshold = float(config_data.get('energy_deviation_threshold_kwh', '0.2'))
+            self.rollingDeviationDetector = RollingDeviationDetector(rolling_window_days, num_std_threshold, energy_deviation_threshold)
             
     
 
     def getComponentsList(self):
         """ get assets list from assets table, which are not deleted and installation_date and commissioning_date are not null
+            the component, street and cabinet are loaded for all assets at once by the shared AssetMetadataLoader
 
-        """                
-        try:
-            self.cur.execute("select id, latitude, longitude, installation_date, commissioning_date \
-                              from assets \
-                              where is_deleted = 'f' \
-                              and installation_date is not null and commissioning_date is not null")
-        except:
-            print("I am unable to get data")
-
-        rows = self.cur.fetchall()   
-        results = []
-        for row in rows:
-            asset_id = row[0]
-            latitude = row[1]
-            longitude = row[2]
-            installation_date = row[3]
-            commissioning_date = row[4]
-
-            try:
-                self.cur.execute("select id \
-                                  from components \
-                                  where asset_id = %s \
-                                  and is_deleted = 'f' and component_kind = 0", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            component_id_data = self.cur.fetchall() 
-            component_id = component_id_data[0][0] 
-
-            try:
-                self.cur.execute("select s.name as street_name \
-                                  from assets as a, streets as s \
-                                  where a.id = %s \
-                                  and a.street_id = s.id", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            street_name_data = self.cur.fetchall() 
-            street_name = street_name_data[0][0]
-
-            try:
-                self.cur.execute("select parent_id \
-                                  from components A,communications_nodes B \
-                                  where A.id=B.id and asset_id = %s", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            cabinet_id_data = self.cur.fetchall()     
-            cabinet_id = cabinet_id_data[0][0]
-
-            results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id))
-
-        return results
+        """
+        metadataLoader = AssetMetadataLoader(self.cur)
+        return metadataLoader.get_components_list(with_wattage=False)
 
     def compute_light_on_time(self, component_id_tuple, start_time, end_time):
         """ use switching point table, compute the light on time for the input component from [0:00 - 23:59:59] in UTC
@@ -254,16 +217,18 @@ class DayburnerEnergyPlusSwitchingPoint:
                 endDate:   datetime.date() variable, the end of a time period 
         """    
         self.sun = sun(lat=latitude, long=longitude)
-        dateTime = datetime.datetime.combine(startDate, datetime.time(hour=8))
-        while dateTime.date() <= endDate:        
-            daytimeStart, daytimeEnd = self.computeDaytimeStartEnd(dateTime)
-            self.sunriseTimeDict[dateTime.date()] = daytimeStart
-            self.sunsetTimeDict[dateTime.date()] = daytimeEnd
-            dateTime += self.oneDayDelta     
+        #the dates outside [startDate, endDate] are computed on demand, the table is saved for the next runs
+        self.sunTimeTable = SunTimeTable(latitude, longitude, self.suntime_table_dir)
+        self.sunriseTimeDict = SunTimeDict(self.sunTimeTable, 'sunrise')
+        self.sunsetTimeDict = SunTimeDict(self.sunTimeTable, 'sunset')
+        self.sunriseTimeDict.fill(startDate, endDate)
+        self.sunsetTimeDict.fill(startDate, endDate)
+        self.sunTimeTable.save()
 
     def find_dayburners_energy_deviation_rolling_window_avg(self, asset_tuple, start_time, end_time):
         """ find dayburners by calculating energy deviation from 30 day rolling window average 
             if # of stdev > 1.5 and deviation > 0.2 kwh, report that record
+            the window length and both thresholds are set on the RollingDeviationDetector
         """
 
         asset_id = asset_tuple[0]
@@ -286,7 +251,7 @@ class DayburnerEnergyPlusSwitchingPoint:
 
         rows = self.cur.fetchall()
 
-        energy_rolling_window = []
+        energy_rolling_window = self.rollingDeviationDetector.new_window()
         results = []
         lastTime = None
         lastDate = None
@@ -306,34 +271,12 @@ class DayburnerEnergyPlusSwitchingPoint:
                 num_days = (currentDate - lastDate).days
                 dailyEnergyConsumption = energyConsumption / num_days
                 #print(lastTime, dailyEnergyConsumption)
-                if len(energy_rolling_window) == 30:
-                    # the rolling window is full
-                    # compute the mean and std of energy consumption within the rolling window       
-                    avg_energy_consumption = statistics.mean(energy_rolling_window)
-                    std_energy_consumption = statistics.stdev(energy_rolling_window)
-                    if std_energy_consumption == 0:
-                        if dailyEnergyConsumption - avg_energy_consumption > 0.2:
-                            results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, lastDate, dailyEnergyConsumption, avg_energy_consumption, std_energy_consumption, None))
-                    else:    
-                        num_std = (dailyEnergyConsumption - avg_energy_consumption) / std_energy_consumption
-                        #if num_std < -1.5 or num_std > 1.5:
-                        if num_std > 1.5 and dailyEnergyConsumption - avg_energy_consumption > 0.2:
-                            results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, lastDate, dailyEnergyConsumption, avg_energy_consumption, std_energy_consumption, num_std))
-                    '''
-                    energy_deviation = dailyEnergyConsumption - avg_energy_consumption
-                    #if energy_deviation < -0.2 or energy_deviation > 0.2:
-                    if energy_deviation > 0.2:    
-                        #report this abnormal case
-                        #print('{0} {1:5.1f} {2: 5.4f} {3} {4:5.1f} {5} {6:5.1f}'.format(asset_id, dailyEnergyConsumption, num_std, lastDate, lastEnergy, currentDate, currentEnergy))
-                        
-                        results.append((asset_id, lastDate, dailyEnergyConsumption, avg_energy_consumption, energy_deviation))
-                    '''
-                    #update rolling window    
-                    energy_rolling_window.pop(0)
-                    energy_rolling_window.append(dailyEnergyConsumption)    
-                else:
-                    # the rolling window is not full, just append new element to the end of the rolling window
-                    energy_rolling_window.append(dailyEnergyConsumption)    
+                # once the rolling window is full, compare with the mean and std of energy consumption within the rolling window,
+                # then the day is added to the rolling window
+                deviation = self.rollingDeviationDetector.check(energy_rolling_window, dailyEnergyConsumption)
+                if deviation is not None:
+                    avg_energy_consumption, std_energy_consumption, num_std = deviation
+                    results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, lastDate, dailyEnergyConsumption, avg_energy_consumption, std_energy_consumption, num_std))
                 #update record
                 lastTime = currentTime    
                 lastDate = currentDate
@@ -342,9 +285,29 @@ class DayburnerEnergyPlusSwitchingPoint:
         
                 
     def computeResults(self, component_id_list):
-        """ compute results
+        """ compute results and write them to the output file
+            with num_workers > 1 the components list is split into shards computed by worker processes,
+            the records are written to the output file as soon as they are computed
 
-        """    
+        """
+        with open_sink(self.outputFilename, self.get_title_row()) as sink:
+            if self.num_workers > 1:
+                parallelRunner = ParallelRunner(DayburnerEnergyPlusSwitchingPoint, self.configFilename, self.num_workers, 'prepare_worker')
+                parallelRunner.run(component_id_list, 'compute_records', sink=sink)
+            else:
+                self.compute_records(component_id_list, sink)
+
+    def get_title_row(self):
+        """ title row of the output file
+
+        """
+        return ('asset_id', 'component_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'cabinet_id', 'current_date', 'dailyEnergyConsumption', 'avg_energy_consumption', 'std_energy_consumption', 'num_std')
+
+    def compute_records(self, component_id_list, sink=None):
+        """ compute the records of the output file for a list of components
+            if a sink is given, the records of each component are written to it and an empty list is returned
+
+        """
         #id = 3776
         #latitude = -6.118187
         #longitude = 106.894265
@@ -355,40 +318,52 @@ class DayburnerEnergyPlusSwitchingPoint:
         count = 0
         start_time = datetime.datetime.combine(self.startDate, datetime.time())
         end_time = datetime.datetime.combine(self.endDate, datetime.time())
-        with open(self.outputFilename, "w") as csvFile:
-            csvWriter = csv.writer(csvFile, delimiter=',')  
-            title_row = ('asset_id', 'component_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'cabinet_id', 'current_date', 'dailyEnergyConsumption', 'avg_energy_consumption', 'std_energy_consumption', 'num_std')
-            csvWriter.writerow(title_row)     
-            for component_id_tuple in component_id_list:
-                count += 1
-                #only compute for first 500 components
-                #if count > 500:
-                #    break
-                print(count)
-                results = self.find_dayburners_energy_deviation_rolling_window_avg(component_id_tuple, start_time, end_time)
-                on_time_dict = self.compute_light_on_time(component_id_tuple, start_time, end_time)
-                #print('len of results: ', len(results))
-                #the results returned is a list of tuples
-                #if len(results) > 0:
-                for record in results:
-                    #csvWriter.writerow(results)
-                    date = record[8]
-                    '''
-                    if date not in on_time_dict:
-                        print(component_id_tuple)
-                        print(date)
-                        continue
-                    '''    
-                    total_light_on_time = on_time_dict[date]
-                    sunrise_time = self.sunriseTimeDict[date]
-                    sunset_time = self.sunsetTimeDict[date]
-                    daytime_in_min = (sunset_time - sunrise_time).total_seconds() / 60.0
-                    nighttime_in_min = 24 * 60 - daytime_in_min
-                    if total_light_on_time - nighttime_in_min > 60:
-                        # the difference between total_light_on_time and nighttime_in_min is more than 60 minutes
-                        # this is day-burning record, write to output file
-                        csvWriter.writerow(record)
-                #self.plot(results)    
+        records = []
+        for component_id_tuple in component_id_list:
+            count += 1
+            #only compute for first 500 components
+            #if count > 500:
+            #    break
+            print(count)
+            results = self.find_dayburners_energy_deviation_rolling_window_avg(component_id_tuple, start_time, end_time)
+            on_time_dict = self.compute_light_on_time(component_id_tuple, start_time, end_time)
+            component_records = []
+            #print('len of results: ', len(results))
+            #the results returned is a list of tuples
+            #if len(results) > 0:
+            for record in results:
+                #csvWriter.writerow(results)
+                date = record[8]
+                '''
+                if date not in on_time_dict:
+                    print(component_id_tuple)
+                    print(date)
+                    continue
+                '''    
+                total_light_on_time = on_time_dict[date]
+                sunrise_time = self.sunriseTimeDict[date]
+                sunset_time = self.sunsetTimeDict[date]
+                daytime_in_min = (sunset_time - sunrise_time).total_seconds() / 60.0
+                nighttime_in_min = 24 * 60 - daytime_in_min
+                if total_light_on_time - nighttime_in_min > 60:
+                    # the difference between total_light_on_time and nighttime_in_min is more than 60 minutes
+                    # this is day-burning record, write to output file
+                    component_records.append(record)
+            if sink is not None:
+                sink.write_batch(component_records)
+            else:
+                records += component_records
+            #self.plot(results)    
+
+        return records
+
+    def prepare_worker(self):
+        """ prepare a worker process of the parallel runner: read the config, open its own db connection and compute the sun time
+
+        """
+        self.getConfig(self.configFilename)
+        self.connectDB()
+        self.computeSunTime(self.suntime_latitude, self.suntime_longitude, self.startDate, self.endDate)
 
     def run(self):
         """  call this method to run the program
@@ -1,9 +1,12 @@
 import datetime
 from sunrise import sun
+from suntime_table import SunTimeTable, SunTimeDict
 import psycopg2
-import csv
 import sys
 import json
+from asset_metadata import AssetMetadataLoader
+from parallel_runner import ParallelRunner
+from csv_sink import open_sink
 
 class ComputeSwitchingTime:
 
@@ -70,65 +73,20 @@ class ComputeSwitchingTime:
             self.suntime_latitude = float(config_data['suntime_location_latitude'])
             #suntime location longitude
             self.suntime_longitude = float(config_data['suntime_location_longitude'])
+            #directory of the persisted sun time tables, empty means the table is only kept in memory
+            self.suntime_table_dir = config_data.get('suntime_table_dir', '')
+            #number of worker processes, each one computes shards of the components list with its own db connection, optional
+            self.num_workers = int(config_data.get('num_workers', '1'))
             
     
 
     def getComponentsList(self):
         """ get assets list from assets table, which are not deleted and installation_date and commissioning_date are not null
+            the component, street and cabinet are loaded for all assets at once by the shared AssetMetadataLoader
 
-        """                
-        try:
-            self.cur.execute("select id, latitude, longitude, installation_date, commissioning_date \
-                              from assets \
-                              where is_deleted = 'f' \
-                              and installation_date is not null and commissioning_date is not null")
-        except:
-            print("I am unable to get data")
-
-        rows = self.cur.fetchall()   
-        results = []
-        for row in rows:
-            asset_id = row[0]
-            latitude = row[1]
-            longitude = row[2]
-            installation_date = row[3]
-            commissioning_date = row[4]
-
-            try:
-                self.cur.execute("select id \
-                                  from components \
-                                  where asset_id = %s \
-                                  and is_deleted = 'f' and component_kind = 0", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            component_id_data = self.cur.fetchall() 
-            component_id = component_id_data[0][0] 
-
-            try:
-                self.cur.execute("select s.name as street_name \
-                                  from assets as a, streets as s \
-                                  where a.id = %s \
-                                  and a.street_id = s.id", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            street_name_data = self.cur.fetchall() 
-            street_name = street_name_data[0][0]
-
-            try:
-                self.cur.execute("select parent_id \
-                                  from components A,communications_nodes B \
-                                  where A.id=B.id and asset_id = %s", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            cabinet_id_data = self.cur.fetchall()     
-            cabinet_id = cabinet_id_data[0][0]
-
-            results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id))
-
-        return results
+        """
+        metadataLoader = AssetMetadataLoader(self.cur)
+        return metadataLoader.get_components_list(with_wattage=False)
 
     def compute_light_on_time(self, component_id_tuple, start_time, end_time):
         """ use switching point table, compute the light on time for the input component from [0:00 - 23:59:59] in UTC
@@ -251,12 +209,13 @@ class ComputeSwitchingTime:
                 endDate:   datetime.date() variable, the end of a time period 
         """    
         self.sun = sun(lat=latitude, long=longitude)
-        dateTime = datetime.datetime.combine(startDate, datetime.time(hour=8))
-        while dateTime.date() <= endDate:        
-            daytimeStart, daytimeEnd = self.computeDaytimeStartEnd(dateTime)
-            self.sunriseTimeDict[dateTime.date()] = daytimeStart
-            self.sunsetTimeDict[dateTime.date()] = daytimeEnd
-            dateTime += self.oneDayDelta     
+        #the dates outside [startDate, endDate] are computed on demand, the table is saved for the next runs
+        self.sunTimeTable = SunTimeTable(latitude, longitude, self.suntime_table_dir)
+        self.sunriseTimeDict = SunTimeDict(self.sunTimeTable, 'sunrise')
+        self.sunsetTimeDict = SunTimeDict(self.sunTimeTable, 'sunset')
+        self.sunriseTimeDict.fill(startDate, endDate)
+        self.sunsetTimeDict.fill(startDate, endDate)
+        self.sunTimeTable.save()
                 
     def computeOnTime(self, component_id_tuple):
         """ using switching point table, compute the total on time for the input component during daytime [8:30 - 19:00]
@@ -340,9 +299,29 @@ class ComputeSwitchingTime:
         return results  
 
     def computeResults(self, component_id_list):
-        """ compute results
+        """ compute results and write them to the output file
+            with num_workers > 1 the components list is split into shards computed by worker processes,
+            the records are written to the output file as soon as they are computed
 
-        """    
+        """
+        with open_sink(self.outputFilename, self.get_title_row()) as sink:
+            if self.num_workers > 1:
+                parallelRunner = ParallelRunner(ComputeSwitchingTime, self.configFilename, self.num_workers, 'prepare_worker')
+                parallelRunner.run(component_id_list, 'compute_records', sink=sink)
+            else:
+                self.compute_records(component_id_list, sink)
+
+    def get_title_row(self):
+        """ title row of the output file
+
+        """
+        return ('asset_id', 'component_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'cabinet_id', 'current_date', 'num_intervals', 'total_on_time')
+
+    def compute_records(self, component_id_list, sink=None):
+        """ compute the records of the output file for a list of components
+            if a sink is given, the records of each component are written to it and an empty list is returned
+
+        """
         #id = 3776
         #latitude = -6.118187
         #longitude = 106.894265
@@ -353,34 +332,46 @@ class ComputeSwitchingTime:
         count = 0
         start_time = datetime.datetime.combine(self.startDate, datetime.time())
         end_time = datetime.datetime.combine(self.endDate, datetime.time())
-        with open(self.outputFilename, "w") as csvFile:
-            csvWriter = csv.writer(csvFile, delimiter=',')  
-            title_row = ('asset_id', 'component_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'cabinet_id', 'current_date', 'num_intervals', 'total_on_time')
-            csvWriter.writerow(title_row)     
-            for component_id_tuple in component_id_list:
-                count += 1
-                #only compute for first 500 components
-                #if count > 500:
-                #    break
-                print(count)
-                #results = self.computeOnTime(component_id_tuple)
-                results = self.compute_light_on_time(component_id_tuple, start_time, end_time)
-                #print('len of results: ', len(results))
-                #the results returned is a list of tuples
-                #if len(results) > 0:
-                for record in results:
-                    #csvWriter.writerow(results)
-                    date = record[8]
-                    sunrise_time = self.sunriseTimeDict[date]
-                    sunset_time = self.sunsetTimeDict[date]
-                    daytime_in_min = (sunset_time - sunrise_time).total_seconds() / 60.0
-                    nighttime_in_min = 24 * 60 - daytime_in_min
-                    total_light_on_time = record[10]
-                    if total_light_on_time - nighttime_in_min > 60:
-                        # the difference between total_light_on_time and nighttime_in_min is more than 60 minutes
-                        # this is day-burning record, write to output file
-                        csvWriter.writerow(record)
-                #self.plot(results)    
+        records = []
+        for component_id_tuple in component_id_list:
+            count += 1
+            #only compute for first 500 components
+            #if count > 500:
+            #    break
+            print(count)
+            #results = self.computeOnTime(component_id_tuple)
+            results = self.compute_light_on_time(component_id_tuple, start_time, end_time)
+            component_records = []
+            #print('len of results: ', len(results))
+            #the results returned is a list of tuples
+            #if len(results) > 0:
+            for record in results:
+                #csvWriter.writerow(results)
+                date = record[8]
+                sunrise_time = self.sunriseTimeDict[date]
+                sunset_time = self.sunsetTimeDict[date]
+                daytime_in_min = (sunset_time - sunrise_time).total_seconds() / 60.0
+                nighttime_in_min = 24 * 60 - daytime_in_min
+                total_light_on_time = record[10]
+                if total_light_on_time - nighttime_in_min > 60:
+                    # the difference between total_light_on_time and nighttime_in_min is more than 60 minutes
+                    # this is day-burning record, write to output file
+                    component_records.append(record)
+            if sink is not None:
+                sink.write_batch(component_records)
+            else:
+                records += component_records
+            #self.plot(results)    
+
+        return records
+
+    def prepare_worker(self):
+        """ prepare a worker process of the parallel runner: read the config, open its own db connection and compute the sun time
+
+        """
+        self.getConfig(self.configFilename)
+        self.connectDB()
+        self.computeSunTime(self.suntime_latitude, self.suntime_longitude, self.startDate, self.endDate)
 
     def run(self):
         """  call this method to run the program
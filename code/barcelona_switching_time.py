@@ -1,5 +1,6 @@
 import datetime  
 from sunrise import sun 
+from suntime_table import SunTimeTable, SunTimeDict
 import psycopg2
 import csv
 import sys
@@ -70,6 +71,8 @@ class ComputeSwitchingTime:
             self.suntime_latitude = float(config_data['suntime_location_latitude'])
             #suntime location longitude
             self.suntime_longitude = float(config_data['suntime_location_longitude'])
+            #directory of the persisted sun time tables, empty means the table is only kept in memory
+            self.suntime_table_dir = config_data.get('suntime_table_dir', '')
             
     def run(self):
         """  call this method to run the program
@@ -134,12 +137,13 @@ class ComputeSwitchingTime:
                 endDate:   datetime.date() variable, the end of a time period 
         """    
         self.sun = sun(lat=latitude, long=longitude)
-        dateTime = datetime.datetime.combine(startDate, datetime.time(hour=8))
-        while dateTime.date() <= endDate:        
-            daytimeStart, daytimeEnd = self.computeDaytimeStartEnd(dateTime)
-            self.sunriseTimeDict[dateTime.date()] = daytimeStart
-            self.sunsetTimeDict[dateTime.date()] = daytimeEnd
-            dateTime += self.oneDayDelta
+        #the dates outside [startDate, endDate] are computed on demand, the table is saved for the next runs
+        self.sunTimeTable = SunTimeTable(latitude, longitude, self.suntime_table_dir)
+        self.sunriseTimeDict = SunTimeDict(self.sunTimeTable, 'sunrise')
+        self.sunsetTimeDict = SunTimeDict(self.sunTimeTable, 'sunset')
+        self.sunriseTimeDict.fill(startDate, endDate)
+        self.sunsetTimeDict.fill(startDate, endDate)
+        self.sunTimeTable.save()
     
     def computeResults(self, component_id_list):
         """ compute results
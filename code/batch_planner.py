@@ -0,0 +1,65 @@
+class BatchPlanner:
+    """ pack the assets of a run into batches with about the same number of readings
+        the readings per asset vary a lot (missing meters, short reading intervals, ...), a fixed number of assets per batch
+        gives batches of very different sizes, so the memory of a run and the time of a parallel shard are hard to predict
+
+        the number of readings of each asset in the period is taken from one grouped query or from the readings cache,
+        then the assets are packed in their order into batches of at most target_rows readings and max_assets assets,
+        an asset with more than target_rows readings gets a batch of its own
+
+    """
+
+    def __init__(self, target_rows=500000, max_assets=10000):
+        """ initialize variables
+
+        """
+        #max number of readings in a batch
+        self.target_rows = target_rows
+        #max number of assets in a batch, it keeps the 'in' list of the readings query short
+        self.max_assets = max_assets
+
+    def count_readings(self, cur, start_time, end_time):
+        """ get the number of readings of each asset with start_time <= timestamp_utc < end_time with one grouped query
+            return a dict: asset id -> number of readings, the assets without reading are left out
+
+        """
+        try:
+            cur.execute("select b.asset_id, count(*) \
+                         from energy_metering_points b, energy_meter_readings a \
+                         where b.id = a.metering_point_id \
+                         and a.timestamp_utc >= %s and a.timestamp_utc < %s \
+                         group by b.asset_id", (start_time, end_time))
+        except:
+            print("I am unable to get data")
+
+        rows = cur.fetchall()
+        reading_count_dict = {}
+        for row in rows:
+            reading_count_dict[row[0]] = row[1]
+
+        return reading_count_dict
+
+    def plan(self, assets_id_list, reading_count_dict):
+        """ pack the assets into batches, the order of the assets is kept
+            return a list of lists of asset ids
+
+        """
+        batches = []
+        batch = []
+        batch_rows = 0
+        for asset_id in assets_id_list:
+            num_rows = reading_count_dict.get(asset_id, 0)
+            if batch and (batch_rows + num_rows > self.target_rows or len(batch) >= self.max_assets):
+                batches.append(batch)
+                batch = []
+                batch_rows = 0
+            batch.append(asset_id)
+            batch_rows += num_rows
+        if batch:
+            batches.append(batch)
+
+        num_rows_list = [sum(reading_count_dict.get(asset_id, 0) for asset_id in batch) for batch in batches]
+        if batches:
+            print("%d assets in %d batches, %d to %d readings per batch" % (len(assets_id_list), len(batches), min(num_rows_list), max(num_rows_list)))
+
+        return batches
@@ -0,0 +1,80 @@
+import queue
+import threading
+
+
+class BatchPrefetcher:
+    """ fetch the data of the next batches in a background thread while the current batch is computed
+        the fetched batches are put in a bounded queue, so at most max_prefetched_batches batches wait in memory
+        (plus the one being fetched and the one being computed), and the fetch thread waits when the computing falls behind
+
+        with one batch prefetched the wall clock time of a run is about max(fetch time, compute time) instead of their sum,
+        the fetch method must not share a db connection with the computing thread
+
+        iterating over the prefetcher gives (batch, data) in the order of batches,
+        an exception raised by the fetch method is raised again in the computing thread
+
+    """
+
+    def __init__(self, fetch, batches, max_prefetched_batches=1):
+        """ start the fetch thread
+
+            input args:
+              fetch: method fetch(batch) returning the data of a batch
+              batches: iterable of batches, e.g. lists of asset ids
+              max_prefetched_batches: size of the queue of fetched batches
+
+        """
+        self.fetch = fetch
+        self.batches = batches
+        #(batch, data, exception) tuples, None is the end marker
+        self.batch_queue = queue.Queue(maxsize=max_prefetched_batches)
+        #set by close() to stop the fetch thread early
+        self.stopped = False
+
+        self.fetch_thread = threading.Thread(target=self.fetch_batches)
+        self.fetch_thread.daemon = True
+        self.fetch_thread.start()
+
+    def fetch_batches(self):
+        """ fetch thread: fetch the batches in order and queue them
+
+        """
+        try:
+            for batch in self.batches:
+                if self.stopped:
+                    break
+                self.batch_queue.put((batch, self.fetch(batch), None))
+        except Exception as e:
+            self.batch_queue.put((None, None, e))
+            return
+        self.batch_queue.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.batch_queue.get()
+            if item is None:
+                break
+            batch, data, error = item
+            if error is not None:
+                raise error
+            yield batch, data
+
+    def close(self):
+        """ stop the fetch thread, the batches that are not fetched yet are skipped
+
+        """
+        self.stopped = True
+        while self.fetch_thread.is_alive():
+            # drain the queue so the fetch thread is not blocked on a full queue
+            try:
+                self.batch_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.fetch_thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,111 @@
+import psycopg2
+import psycopg2.extras
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+#the writer is also used by the python 2 scripts
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class BatchWriter:
+    """ write rows into a table in batches instead of one insert (and one commit) per row
+        the rows are buffered and sent batch_size at a time, either as one multi-row insert (execute_values)
+        or as a COPY FROM STDIN, then the batch is committed
+
+        if a batch fails, the error is printed and the batch is rolled back, the next batches are still written
+
+    """
+
+    def __init__(self, conn, table_name, columns, batch_size=1000, method='values'):
+        """ initialize variables
+
+            input args:
+              conn: database connection, the writer commits on it after each batch
+              table_name: the table to write into
+              columns: list of column names, each row is a tuple in the same order
+              batch_size: number of rows per batch
+              method: 'values' for a multi-row insert, 'copy' for COPY FROM STDIN
+
+        """
+        self.conn = conn
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.method = method
+        #rows not written yet
+        self.rows = []
+        #number of rows written (committed) so far
+        self.num_written_rows = 0
+
+    def write(self, row):
+        """ add a row, the buffered rows are written when there are batch_size of them
+
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def write_rows(self, rows):
+        """ add a list of rows
+
+        """
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        """ write the buffered rows and commit
+
+        """
+        if len(self.rows) == 0:
+            return
+
+        cur = self.conn.cursor()
+        try:
+            if self.method == 'copy':
+                self.copy_rows(cur, self.rows)
+            else:
+                psycopg2.extras.execute_values(cur, "insert into %s (%s) values %%s" % (self.table_name, ", ".join(self.columns)),
+                                               self.rows, page_size=self.batch_size)
+            self.conn.commit()
+            self.num_written_rows += len(self.rows)
+        except psycopg2.Error as e:
+            print("I am unable to insert %d rows into %s table" % (len(self.rows), self.table_name))
+            print(e)
+            self.conn.rollback()
+        finally:
+            cur.close()
+
+        self.rows = []
+
+    def copy_rows(self, cur, rows):
+        """ send the rows with COPY FROM STDIN in the text format
+
+        """
+        lines = []
+        for row in rows:
+            lines.append("\t".join([self.copy_value(value) for value in row]))
+        data = "\n".join(lines) + "\n"
+
+        cur.copy_expert("copy %s (%s) from stdin" % (self.table_name, ", ".join(self.columns)), StringIO(data))
+
+    def copy_value(self, value):
+        """ format a value for the COPY text format, None is NULL
+
+        """
+        if value is None:
+            return "\\N"
+        if isinstance(value, float):
+            return repr(value)
+        text = value if isinstance(value, string_types) else str(value)
+        return text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+    def close(self):
+        """ write the remaining rows
+
+        """
+        self.flush()
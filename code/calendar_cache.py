@@ -0,0 +1,169 @@
+import json
+import os
+import tempfile
+from xml_parser import XML_Parser
+from calendar_profile import CompiledCalendar
+
+
+class CalendarCache:
+    """ cache of the parsed dimming calendars, shared by all the assets of a run
+        thousands of assets follow a handful of calendars, so instead of two queries, one revision query and one XML parse per asset:
+          - one bulk query maps every asset to its dimming_calendar_id (through its communications node, component_kind = 100)
+          - one DISTINCT ON query gets the latest revision (created_on_utc) of each calendar
+          - the XML of a calendar revision is parsed once and the compiled calendar is memoized by calendar id
+
+        if cache_filename is given, the parsed shapes are also saved on disk keyed by calendar id and revision,
+        a later run only fetches and parses the XML of the calendars whose latest revision changed
+
+    """
+
+    def __init__(self, cur, cache_filename='', exclude_deleted_nodes=False):
+        """ initialize variables
+
+        """
+        #database cursor
+        self.cur = cur
+        #on-disk cache file (json), empty string means no on-disk layer
+        self.cache_filename = cache_filename
+        #skip the deleted communications nodes when mapping the assets to their calendar (the switching point detector does)
+        self.exclude_deleted_nodes = exclude_deleted_nodes
+        #asset id -> dimming calendar id
+        self.asset_calendar_id_dict = {}
+        #calendar id -> latest revision (created_on_utc as a string)
+        self.calendar_revision_dict = {}
+        #calendar id -> list of 7 shape dictionaries from XML_Parser.parser
+        self.parsed_calendar_dict = {}
+        #calendar id -> CompiledCalendar
+        self.compiled_calendar_dict = {}
+
+    def load(self):
+        """ load the asset -> calendar mapping and the latest revision of each calendar,
+            then parse the calendars that are not in the on-disk cache (or whose revision changed)
+
+        """
+        self.load_asset_calendar_ids()
+        self.load_latest_revisions()
+
+        disk_cache = self.read_disk_cache()
+        stale_calendar_ids = []
+        for calendar_id, revision in self.calendar_revision_dict.items():
+            cached = disk_cache.get(str(calendar_id))
+            if cached is not None and cached['revision'] == revision:
+                self.parsed_calendar_dict[calendar_id] = cached['shapes']
+            else:
+                stale_calendar_ids.append(calendar_id)
+
+        if stale_calendar_ids:
+            self.parse_calendars(stale_calendar_ids)
+            self.write_disk_cache()
+
+    def load_asset_calendar_ids(self):
+        """ map every asset to the dimming calendar of its communications node
+
+        """
+        deleted_filter = " and c.is_deleted = 'f'" if self.exclude_deleted_nodes else ""
+        try:
+            self.cur.execute("select distinct on (c.asset_id) c.asset_id, n.dimming_calendar_id \
+                              from components c, communications_nodes n \
+                              where c.component_kind = 100 and c.id = n.id" + deleted_filter + " \
+                              order by c.asset_id, c.id")
+        except:
+            print("I am unable to get data")
+
+        rows = self.cur.fetchall()
+        for row in rows:
+            self.asset_calendar_id_dict[row[0]] = row[1]
+
+    def load_latest_revisions(self):
+        """ get the created_on_utc of the latest revision of each calendar, without the XML
+
+        """
+        try:
+            self.cur.execute("select distinct on (core_calendar_id) core_calendar_id, created_on_utc \
+                              from driver_calendar_revisions \
+                              order by core_calendar_id, created_on_utc desc")
+        except:
+            print("I am unable to get data")
+
+        rows = self.cur.fetchall()
+        for row in rows:
+            self.calendar_revision_dict[row[0]] = str(row[1])
+
+    def parse_calendars(self, calendar_ids):
+        """ fetch the XML of the latest revision of the input calendars and parse it
+
+        """
+        try:
+            self.cur.execute("select distinct on (core_calendar_id) core_calendar_id, serialized_schedules \
+                              from driver_calendar_revisions \
+                              where core_calendar_id = any(%s) \
+                              order by core_calendar_id, created_on_utc desc", (list(calendar_ids), ))
+        except:
+            print("I am unable to get data")
+
+        rows = self.cur.fetchall()
+        xml_parser = XML_Parser()
+        for row in rows:
+            self.parsed_calendar_dict[row[0]] = xml_parser.parse_from_string(row[1])
+
+    def read_disk_cache(self):
+        """ read the on-disk cache, return a dict: calendar id (as a string) -> {'revision': ..., 'shapes': [...]}
+
+        """
+        if not self.cache_filename or not os.path.exists(self.cache_filename):
+            return {}
+
+        try:
+            with open(self.cache_filename) as cache_file:
+                return json.load(cache_file)
+        except ValueError:
+            # a broken cache file is ignored, it is rewritten after parsing
+            print("I am unable to read the calendar cache")
+            return {}
+
+    def write_disk_cache(self):
+        """ save the parsed calendars on disk
+
+        """
+        if not self.cache_filename:
+            return
+
+        disk_cache = {}
+        for calendar_id, shapes in self.parsed_calendar_dict.items():
+            disk_cache[str(calendar_id)] = {'revision': self.calendar_revision_dict[calendar_id], 'shapes': shapes}
+        # write to a temporary file first, so an interrupted run never leaves a half written cache,
+        # the temporary file has a unique name so processes writing the cache at the same time do not mix their files
+        fd, tmp_filename = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(self.cache_filename)))
+        try:
+            with os.fdopen(fd, "w") as cache_file:
+                json.dump(disk_cache, cache_file)
+            os.replace(tmp_filename, self.cache_filename)
+        except:
+            os.remove(tmp_filename)
+            raise
+
+    def get_calendar_id(self, asset_id):
+        """ get the dimming calendar id of an asset, None if the asset has no communications node
+
+        """
+        return self.asset_calendar_id_dict.get(asset_id)
+
+    def get_calendars(self, asset_id):
+        """ get the list of 7 shape dictionaries for an asset, None if the asset has no calendar revision
+
+        """
+        return self.parsed_calendar_dict.get(self.get_calendar_id(asset_id))
+
+    def get_compiled_calendar(self, asset_id):
+        """ get the CompiledCalendar for an asset, None if the asset has no calendar revision
+            the compiled calendar is built once per calendar id
+
+        """
+        calendar_id = self.get_calendar_id(asset_id)
+        if calendar_id not in self.compiled_calendar_dict:
+            calendars = self.parsed_calendar_dict.get(calendar_id)
+            if calendars is None:
+                return None
+            self.compiled_calendar_dict[calendar_id] = CompiledCalendar(calendars)
+
+        return self.compiled_calendar_dict[calendar_id]
@@ -0,0 +1,74 @@
+import bisect
+import datetime
+
+
+class CompiledCalendar:
+    """ compiled form of the 7 weekday shapes returned by XML_Parser.parser
+        the shapes are converted once: the sunrise / sunset offsets become timedelta objects
+        and the shape items become sorted minute breakpoints with the matching percents,
+        so the calendar item of a time is found with bisect instead of a linear scan
+
+        the calendar date of a time is the previous day before 12pm noon, the shape of a calendar date is its weekday (Sunday is 0)
+        the item of a time is the one whose [item_minutes, next item_minutes) range contains the minutes from the calendar date start,
+        if no range contains it, the last item is used
+
+    """
+
+    def __init__(self, calendars):
+        """ initialize variables from the list of 7 shape dictionaries, starting from Sunday
+
+        """
+        #sunrise / sunset offsets for each weekday as timedelta objects
+        self.sunrise_offset_time = []
+        self.sunset_offset_time = []
+        #sorted minute breakpoints and percents of the shape items for each weekday
+        self.item_minutes = []
+        self.item_percent = []
+        for shape_dict in calendars:
+            shape_sunrise_offset = int(shape_dict['shape_sunrise_offset'])
+            shape_sunset_offset = int(shape_dict['shape_sunset_offset'])
+            self.sunrise_offset_time.append(datetime.timedelta(minutes=shape_sunrise_offset))
+            self.sunset_offset_time.append(datetime.timedelta(minutes=shape_sunset_offset))
+            # the shape items are ordered by time
+            self.item_minutes.append([int(item['item_minutes']) for item in shape_dict['items']])
+            self.item_percent.append([int(item['item_percent']) for item in shape_dict['items']])
+
+        self.oneDayDelta = datetime.timedelta(days=1)
+        self.noontime = datetime.time(12, 0, 0)
+
+    def get_percent(self, calendar_index, minutes_from_calendar_date_start):
+        """ get the percent of the calendar item that the input time belongs to
+
+            input args:
+              calendar_index: the weekday of the calendar date, Sunday is 0
+              minutes_from_calendar_date_start: the input time in the format of minutes from the start of the calendar date
+                                                (for example: 720 represents 12pm noon time )
+
+        """
+        item_minutes = self.item_minutes[calendar_index]
+        index = bisect.bisect_right(item_minutes, minutes_from_calendar_date_start) - 1
+        # before the first item, the last item is used
+        return self.item_percent[calendar_index][index]
+
+    def locate(self, local_time):
+        """ get the weekday index of the calendar date and the minutes from the calendar date start for a local datetime
+
+        """
+        if local_time.time() < self.noontime:
+            calendar_date = local_time.date() - self.oneDayDelta
+        else:
+            calendar_date = local_time.date()
+        calendar_index = calendar_date.isoweekday() % 7
+        calendar_date_start_time = datetime.datetime.combine(calendar_date, datetime.time())
+        minutes_from_calendar_date_start = (local_time - calendar_date_start_time).total_seconds() / 60
+
+        return (calendar_index, minutes_from_calendar_date_start)
+
+    def lookup(self, local_time):
+        """ get (sunrise offset, sunset offset, calendar percent) for a local datetime
+            the offsets are timedelta objects
+
+        """
+        calendar_index, minutes_from_calendar_date_start = self.locate(local_time)
+
+        return (self.sunrise_offset_time[calendar_index], self.sunset_offset_time[calendar_index], self.get_percent(calendar_index, minutes_from_calendar_date_start))
@@ -4,16 +4,20 @@ import psycopg2
 import csv
 import sys
 import json
+import bisect
 
 
 class OpenFaultsChecker:
 
-    def __init__(self, inputFilename, outputFilename):
+    def __init__(self, inputFilename, outputFilename, bulkMode=True):
         """ initialize some variables
+            in bulk mode, the faults of all the input components are loaded with one query
+            instead of one query per input line
 
         """
         self.inputFilename = inputFilename
         self.outputFilename = outputFilename
+        self.bulkMode = bulkMode
 
         self.pg_dbname = "citytouch_barcelona"
         self.pg_username = "awsmaster"
@@ -22,6 +26,8 @@ class OpenFaultsChecker:
         self.pg_port = "5432"
 
         self.oneDayDelta = datetime.timedelta(days=1)
+        #date -> start of the day in the time zone of the db session, loaded by load_day_starts
+        self.day_start_dict = {}
 
     def connect_db(self):
         """ build connection to the database
@@ -74,6 +80,151 @@ class OpenFaultsChecker:
         #return len(fault_rows)   
         return results
 
+    def read_input_records(self):
+        """ read the dayburner records of the input file, return a list of (asset_id, component_id, current_date)
+
+        """
+        records = []
+        with open(self.inputFilename, "r") as csvFile:
+            csvReader = csv.reader(csvFile, delimiter=',') 
+            next(csvReader)
+            for record in csvReader:
+                asset_id = record[0]
+                component_id = record[1]
+                current_date = datetime.datetime.strptime(record[10], '%Y-%m-%d').date()
+                records.append((asset_id, component_id, current_date))
+
+        return records
+
+    def load_faults(self, component_id_list, start_date, end_date):
+        """ load the faults of the input components that are open at some time from start_date to end_date (included)
+            return a dict: component id -> list of (fault_id, error_key, first_reported_on, closed_on), ordered by first_reported_on
+
+        """
+        try:
+            self.cur.execute("select id, error_key, is_open, first_reported_on, last_reported_on, component_id, is_deleted, asset_id, last_modified_on, closed_on \
+                              from faults \
+                              where component_id = any(%s) \
+                              and first_reported_on < %s and (closed_on > %s or closed_on is null) \
+                              order by component_id, first_reported_on, id", (component_id_list, end_date + self.oneDayDelta, start_date))
+        except:
+            print("I am unable to get data")   
+
+        fault_rows = self.cur.fetchall()  
+
+        component_faults_dict = {}
+        for row in fault_rows:
+            fault_id = row[0]
+            error_key = row[1]
+            first_reported_on = row[3]
+            component_id = row[5]
+            closed_on = row[9]
+            component_faults_dict.setdefault(component_id, []).append((fault_id, error_key, first_reported_on, closed_on))
+
+        return component_faults_dict
+
+    def load_day_starts(self, start_date, end_date):
+        """ load the start of each day from start_date to the day after end_date as a timestamp with time zone,
+            the db converts each date in the time zone of the session like it does for the date parameters of check_open_fault,
+            so the utc offset of each day follows the DST changes
+            return a dict: date -> datetime
+
+        """
+        try:
+            self.cur.execute("select d::date, d::date::timestamptz \
+                              from generate_series(%s::date, %s::date, interval '1 day') d", (start_date, end_date + self.oneDayDelta))
+        except:
+            print("I am unable to get data")
+
+        rows = self.cur.fetchall()
+        day_start_dict = {}
+        for row in rows:
+            day_start_dict[row[0]] = row[1]
+
+        return day_start_dict
+
+    def day_start(self, current_date, reference_time):
+        """ the start of a day as a datetime object comparable with the fault timestamps:
+            the start of the day in the db session time zone (see load_day_starts) if reference_time has a tzinfo, the naive midnight otherwise
+
+        """
+        if reference_time.tzinfo is None:
+            return datetime.datetime.combine(current_date, datetime.time())
+
+        return self.day_start_dict[current_date]
+
+    def find_open_faults(self, faults, date_list):
+        """ find the faults open during each day of a component, the same condition as check_open_fault:
+              first_reported_on < next day and (closed_on > current day or closed_on is null)
+            faults: list of (fault_id, error_key, first_reported_on, closed_on) ordered by first_reported_on
+            date_list: sorted list of distinct dates
+            return a dict: date -> list of open faults, ordered by first_reported_on
+
+            the days are swept in order: a fault enters the open list on the first day it is reported
+            and leaves it once it is closed, so each fault is visited a constant number of times
+
+        """
+        open_faults_dict = {}
+        if len(faults) == 0:
+            for current_date in date_list:
+                open_faults_dict[current_date] = []
+            return open_faults_dict
+
+        reference_time = faults[0][2]
+        first_reported_list = [fault[2] for fault in faults]
+        num_reported = 0
+        open_faults = []
+        for current_date in date_list:
+            current_day_start = self.day_start(current_date, reference_time)
+            next_day_start = self.day_start(current_date + self.oneDayDelta, reference_time)
+            #the faults first reported before the next day
+            num_new_reported = bisect.bisect_left(first_reported_list, next_day_start, num_reported)
+            open_faults = open_faults + faults[num_reported:num_new_reported]
+            num_reported = num_new_reported
+            #the faults closed before the day are closed for all the later days too
+            open_faults = [fault for fault in open_faults if fault[3] is None or fault[3] > current_day_start]
+            open_faults_dict[current_date] = open_faults
+
+        return open_faults_dict
+
+    def process_input_file_bulk(self):
+        """ bulk version of process_input_file, the results are the same (and in the same order)
+            the faults of all the input components and dates are loaded with one query and indexed per component
+
+        """
+        records = self.read_input_records()
+        print(len(records))
+        if len(records) == 0:
+            return []
+
+        #the dates of each component
+        component_dates_dict = {}
+        for asset_id, component_id, current_date in records:
+            component_dates_dict.setdefault(int(component_id), set()).add(current_date)
+
+        start_date = min(record[2] for record in records)
+        end_date = max(record[2] for record in records)
+        component_faults_dict = self.load_faults(list(component_dates_dict.keys()), start_date, end_date)
+        self.day_start_dict = self.load_day_starts(start_date, end_date)
+
+        #(component id, date) -> open faults
+        open_faults_dict = {}
+        for component_id, date_set in component_dates_dict.items():
+            component_open_faults_dict = self.find_open_faults(component_faults_dict.get(component_id, []), sorted(date_set))
+            for current_date, open_faults in component_open_faults_dict.items():
+                open_faults_dict[(component_id, current_date)] = open_faults
+
+        results = []
+        for asset_id, component_id, current_date in records:
+            for fault_record in open_faults_dict[(int(component_id), current_date)]:
+                fault_id = fault_record[0]
+                error_key = fault_record[1]
+                first_reported_on = fault_record[2]
+                closed_on = fault_record[3]
+                results.append((asset_id, component_id, current_date, fault_id, error_key, first_reported_on, closed_on))
+
+        return results
+
     def process_input_file(self):
         """ read each dayburner record from the input file 
             and if there are open faults for the day-burner record, write to the output file
@@ -123,14 +274,19 @@ class OpenFaultsChecker:
 
         """    
         self.connect_db()
-        results = self.process_input_file()
+        if self.bulkMode:
+            results = self.process_input_file_bulk()
+        else:
+            results = self.process_input_file()
         self.write_to_file(results)
         self.disconnect_db()
 
 if __name__ == "__main__":
     inputFilename = sys.argv[1]
     outputFilename = sys.argv[2]
-    open_faults_checker = OpenFaultsChecker(inputFilename, outputFilename)
+    #optional third argument 'row' runs one faults query per input line
+    bulkMode = not (len(sys.argv) > 3 and sys.argv[3] == 'row')
+    open_faults_checker = OpenFaultsChecker(inputFilename, outputFilename, bulkMode)
     open_faults_checker.run()
 
 
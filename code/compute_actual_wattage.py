@@ -1,15 +1,18 @@
 import datetime
 from sunrise import sun
+from suntime_table import SunTimeTable, SunTimeDict
 import psycopg2
 import csv
 import sys
 import json
 import statistics
 from collections import Counter
+from asset_metadata import AssetMetadataLoader
+from aggregation_wattage import AggregationWattage
 
 class ActualWattage:
 
-	def __init__(self, configJSONFilename):
+    def __init__(self, configJSONFilename):
         """ initialize variables
 
         """
@@ -72,73 +75,20 @@ class ActualWattage:
             self.suntime_latitude = float(config_data['suntime_location_latitude'])
             #suntime location longitude
             self.suntime_longitude = float(config_data['suntime_location_longitude'])
+            #directory of the persisted sun time tables, empty means the table is only kept in memory
+            self.suntime_table_dir = config_data.get('suntime_table_dir', '')
+            #compute the actual wattage of all the assets from one energy_aggregation_daily query (see aggregation_wattage.py), optional
+            self.bulk_wattage = config_data.get('bulk_wattage', 'true').lower() == 'true'
+            #statistic of the daily wattages of an asset in bulk mode: mean or median, optional
+            self.wattage_statistic = config_data.get('wattage_statistic', 'mean')
          
     def getComponentsList(self):
         """ get assets list from assets table, which are not deleted and installation_date and commissioning_date are not null
+            the component, street, cabinet and wattage are loaded for all assets at once by the shared AssetMetadataLoader
 
-        """                
-        try:
-            self.cur.execute("select id, latitude, longitude, installation_date, commissioning_date \
-                              from assets \
-                              where is_deleted = 'f' \
-                              and installation_date is not null and commissioning_date is not null")
-        except:
-            print("I am unable to get data")
-
-        rows = self.cur.fetchall()   
-        results = []
-        for row in rows:
-            asset_id = row[0]
-            latitude = row[1]
-            longitude = row[2]
-            installation_date = row[3]
-            commissioning_date = row[4]
-
-            try:
-                self.cur.execute("select id \
-                                  from components \
-                                  where asset_id = %s \
-                                  and is_deleted = 'f' and component_kind = 0", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            component_id_data = self.cur.fetchall() 
-            component_id = component_id_data[0][0] 
-
-            try:
-                self.cur.execute("select s.name as street_name \
-                                  from assets as a, streets as s \
-                                  where a.id = %s \
-                                  and a.street_id = s.id", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            street_name_data = self.cur.fetchall() 
-            street_name = street_name_data[0][0]
-
-            try:
-                self.cur.execute("select parent_id \
-                                  from components A,communications_nodes B \
-                                  where A.id=B.id and asset_id = %s", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            cabinet_id_data = self.cur.fetchall()     
-            cabinet_id = cabinet_id_data[0][0]
-
-            try:
-                self.cur.execute("select c.asset_id, lt.type_designation, lt.actual_wattage \
-                                  from luminaire_types lt, luminaires l, components c \
-                                  where c.asset_id = %s and c.id = l.id and l.luminaire_type_id = lt.id", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            nominal_wattage_data = self.cur.fetchall()     
-            nominal_wattage = nominal_wattage_data[0][2]
-
-            results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, nominal_wattage))
-
-        return results  
+        """
+        metadataLoader = AssetMetadataLoader(self.cur)
+        return metadataLoader.get_components_list()
 
     def computeDaytimeStartEnd(self, date):
         """
@@ -172,12 +122,13 @@ class ActualWattage:
                 endDate:   datetime.date() variable, the end of a time period 
         """    
         self.sun = sun(lat=latitude, long=longitude)
-        dateTime = datetime.datetime.combine(startDate, datetime.time(hour=8))
-        while dateTime.date() <= endDate:        
-            daytimeStart, daytimeEnd = self.computeDaytimeStartEnd(dateTime)
-            self.sunriseTimeDict[dateTime.date()] = daytimeStart
-            self.sunsetTimeDict[dateTime.date()] = daytimeEnd
-            dateTime += self.oneDayDelta 
+        #the dates outside [startDate, endDate] are computed on demand, the table is saved for the next runs
+        self.sunTimeTable = SunTimeTable(latitude, longitude, self.suntime_table_dir)
+        self.sunriseTimeDict = SunTimeDict(self.sunTimeTable, 'sunrise')
+        self.sunsetTimeDict = SunTimeDict(self.sunTimeTable, 'sunset')
+        self.sunriseTimeDict.fill(startDate, endDate)
+        self.sunsetTimeDict.fill(startDate, endDate)
+        self.sunTimeTable.save()
 
     def compute_actual_wattage_from_aggregation_energy(self, asset_tuple, start_time, end_time):
         """ use aggregation energy table 
@@ -208,22 +159,34 @@ class ActualWattage:
 
             #compute night time
             sunrise_time = self.sunriseTimeDict[currentDate]
-	        sunset_time = self.sunsetTimeDict[currentDate]
-	        daytime_in_hours = (sunset_time - sunrise_time).total_seconds() / 60.0 / 60.0
-	        nighttime_in_hours = 24 - daytime_in_hours
-	        
-	        # compute the actual wattage for the asset in watts
-	        actual_wattage = (dailyEnergyConsumption / nighttime_in_hours) * 1000
+            sunset_time = self.sunsetTimeDict[currentDate]
+            daytime_in_hours = (sunset_time - sunrise_time).total_seconds() / 60.0 / 60.0
+            nighttime_in_hours = 24 - daytime_in_hours
+            
+            # compute the actual wattage for the asset in watts
+            actual_wattage = (dailyEnergyConsumption / nighttime_in_hours) * 1000
             wattage_list.append(actual_wattage)
 
         wattage_list = [x for x in wattage_list if x != 0]
-        if len(energy_rolling_window) == 0:
+        if len(wattage_list) == 0:
             return None      
 
         actual_wattage = statistics.mean(wattage_list)
         
         return actual_wattage  
 
+    def compute_actual_wattage_bulk(self, component_id_list, start_time, end_time):
+        """ bulk version of compute_actual_wattage_from_aggregation_energy for a list of components, with one query
+            return a dict: asset id -> actual wattage, the assets without a non zero day are left out
+
+        """
+        aggregationWattage = AggregationWattage(self.sunriseTimeDict, self.sunsetTimeDict, start_time.date(), end_time.date())
+        aggregationWattage.fetch(self.cur, start_time, end_time, [component_id_tuple[0] for component_id_tuple in component_id_list])
+        if self.wattage_statistic == 'median':
+            return aggregationWattage.median_wattage()
+
+        return aggregationWattage.mean_wattage()
+
     def compute_results(self, component_id_list):
         """ report the assets with actual wattage and nominal wattage
 
@@ -231,6 +194,8 @@ class ActualWattage:
         count = 0
         start_time = datetime.datetime.combine(self.startDate, datetime.time())
         end_time = datetime.datetime.combine(self.endDate, datetime.time())
+        if self.bulk_wattage:
+            actual_wattage_dict = self.compute_actual_wattage_bulk(component_id_list, start_time, end_time)
         with open(self.outputFilename, "w") as csvFile:
             csvWriter = csv.writer(csvFile, delimiter=',')  
             title_row = ('asset_id', 'component_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'cabinet_id', 'nominal_wattage', 'actual_wattage')
@@ -242,7 +207,10 @@ class ActualWattage:
                 #    break
                 print(count)
                 #print(component_id_tuple)
-                actual_wattage = self.compute_actual_wattage_from_aggregation_energy(component_id_tuple, start_time, end_time)
+                if self.bulk_wattage:
+                    actual_wattage = actual_wattage_dict.get(component_id_tuple[0])
+                else:
+                    actual_wattage = self.compute_actual_wattage_from_aggregation_energy(component_id_tuple, start_time, end_time)
                 if actual_wattage is None:
                     continue
 
@@ -0,0 +1,90 @@
+import csv
+import queue
+import threading
+
+
+class CsvSink:
+    """ write the results of a run to a csv file while they are computed
+        the batches of records are put in a bounded queue and written by a background thread, the file is flushed after each batch,
+        so the memory holds at most max_queued_batches batches and a crashed run keeps the batches written before the crash
+
+        when the queue is full, write_batch blocks until the writer thread catches up
+
+    """
+
+    def __init__(self, filename, title_row, max_queued_batches=8):
+        """ open the output file, write the title row and start the writer thread
+
+        """
+        self.filename = filename
+        #batches waiting to be written, None is the end marker
+        self.batch_queue = queue.Queue(maxsize=max_queued_batches)
+        #number of records written
+        self.num_records = 0
+        #exception raised in the writer thread
+        self.error = None
+
+        self.csvFile = open(filename, "w")
+        self.csvWriter = csv.writer(self.csvFile, delimiter=',')
+        self.csvWriter.writerow(title_row)
+
+        self.writer_thread = threading.Thread(target=self.write_batches)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def write_batches(self):
+        """ writer thread: write the queued batches until the end marker
+
+        """
+        while True:
+            records = self.batch_queue.get()
+            if records is None:
+                break
+            if self.error is not None:
+                # keep draining the queue so write_batch never blocks forever
+                continue
+            try:
+                self.csvWriter.writerows(records)
+                self.csvFile.flush()
+                self.num_records += len(records)
+            except Exception as e:
+                self.error = e
+
+    def write_batch(self, records):
+        """ queue a batch of records
+
+        """
+        if self.error is not None:
+            raise self.error
+        if len(records) > 0:
+            self.batch_queue.put(records)
+
+    def close(self, raise_error=True):
+        """ write the remaining batches, stop the writer thread and close the file
+            an exception of the writer thread is raised again, unless raise_error is False
+
+        """
+        self.batch_queue.put(None)
+        self.writer_thread.join()
+        self.csvFile.close()
+        if raise_error and self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # an exception of the run is not replaced by the writer error
+        self.close(raise_error=exc_type is None)
+        return False
+
+
+def open_sink(filename, title_row):
+    """ open the output sink of a run from the output file name: a ParquetSink for a .parquet file, a CsvSink otherwise
+
+    """
+    if filename.lower().endswith('.parquet'):
+        from parquet_sink import ParquetSink
+        return ParquetSink(filename, title_row)
+
+    return CsvSink(filename, title_row)
@@ -0,0 +1,296 @@
+import datetime
+import json
+import os
+import sys
+import numpy as np
+import psycopg2
+
+
+class DailyEnergyStore:
+    """ local store of the daily energy consumption (interpolated_kwh + measured_kwh of energy_aggregation_daily) of every metering point
+        the energy is kept as a dense float64 matrix in a raw file, memory mapped when it is read, one store per region:
+          <store_dir>/<region>/daily_energy_<N>.f64     days x metering points, one row of float64 values per day (nan = no energy row)
+          <store_dir>/<region>/daily_energy_index.json  origin_day (days since 1970-01-01 of the first row), num_days,
+                                                        metering_point_ids, asset_ids (asset of each column), data file
+
+        a value is the (interpolated_kwh + measured_kwh)::float8 of one energy_aggregation_daily row, the same value as
+        AggregationWattage.fetch reads from the db, the metering points of an asset are not merged
+
+        the days are the rows of the file so a sync appends the new days at the end of the file without rewriting it,
+        opening a store reads only the index and the pages of the matrix that are used,
+        the days already in the store are not fetched again (delete the store to refetch corrected days)
+
+    """
+
+    def __init__(self, store_dir, region):
+        """ initialize variables and open the store if it exists
+
+        """
+        #directory of the store
+        self.store_dir = store_dir
+        #region (database name), each region has its own sub directory
+        self.region = region
+        self.data_filename = None
+        self.index_filename = os.path.join(store_dir, region, "daily_energy_index.json")
+
+        self.epoch_date = datetime.date(1970, 1, 1)
+        #day of the first row, days since 1970-01-01
+        self.origin_day = None
+        #number of days in the store
+        self.num_days = 0
+        #metering point ids of the columns, sorted, and the asset id of each column
+        self.metering_point_id_array = np.empty(0, dtype=np.int64)
+        self.asset_id_array = np.empty(0, dtype=np.int64)
+        #memory mapped days x metering points matrix
+        self.data = np.empty((0, 0), dtype=np.float64)
+
+        if os.path.exists(self.index_filename):
+            self.load()
+
+    def load(self):
+        """ read the index and memory map the matrix
+
+        """
+        with open(self.index_filename) as index_file:
+            index = json.load(index_file)
+        self.data_filename = os.path.join(self.store_dir, self.region, index['data_file'])
+        self.origin_day = index['origin_day']
+        self.num_days = index['num_days']
+        self.metering_point_id_array = np.array(index['metering_point_ids'], dtype=np.int64)
+        self.asset_id_array = np.array(index['asset_ids'], dtype=np.int64)
+        if self.num_days > 0 and len(self.metering_point_id_array) > 0:
+            # the file may be longer than num_days rows if an append was interrupted, the index is the reference
+            self.data = np.memmap(self.data_filename, dtype=np.float64, mode='r', shape=(self.num_days, len(self.metering_point_id_array)))
+        else:
+            self.data = np.empty((self.num_days, len(self.metering_point_id_array)), dtype=np.float64)
+
+    def write_index(self):
+        """ write the index, after the matrix so an interrupted write keeps the previous state
+
+        """
+        tmp_filename = self.index_filename + ".tmp"
+        with open(tmp_filename, "w") as index_file:
+            json.dump({'origin_day': self.origin_day, 'num_days': self.num_days, 'metering_point_ids': self.metering_point_id_array.tolist(),
+                       'asset_ids': self.asset_id_array.tolist(), 'data_file': os.path.basename(self.data_filename)}, index_file)
+        os.replace(tmp_filename, self.index_filename)
+
+    def create(self, origin_date):
+        """ create an empty store starting at origin_date
+
+        """
+        directory = os.path.dirname(self.index_filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.data_filename = os.path.join(directory, "daily_energy_0.f64")
+        open(self.data_filename, "wb").close()
+        self.origin_day = self.to_day(origin_date)
+        self.num_days = 0
+        self.write_index()
+        self.load()
+
+    def to_day(self, date):
+        """ convert a datetime.date() to days since 1970-01-01
+
+        """
+        return (date - self.epoch_date).days
+
+    def first_date(self):
+        """ date of the first day of the store
+
+        """
+        return self.epoch_date + datetime.timedelta(days=self.origin_day)
+
+    def end_date(self):
+        """ date after the last day of the store, the next sync starts at this date
+
+        """
+        return self.epoch_date + datetime.timedelta(days=self.origin_day + self.num_days)
+
+    def covers(self, start_date, end_date):
+        """ check if the store has every day start_date <= date < end_date
+
+        """
+        return self.origin_day is not None and self.first_date() <= start_date and end_date <= self.end_date()
+
+    def window(self, start_date, end_date, assets_id_list=None):
+        """ get the daily energy of the days start_date <= date < end_date
+            return (asset id of each row, metering points x days float64 matrix, first date of the matrix),
+            with assets_id_list only the metering points of these assets are kept, else every metering point of the store
+
+        """
+        first_day_index = max(self.to_day(start_date) - self.origin_day, 0)
+        last_day_index = min(self.to_day(end_date) - self.origin_day, self.num_days)
+        last_day_index = max(last_day_index, first_day_index)
+        first_date = self.epoch_date + datetime.timedelta(days=self.origin_day + first_day_index)
+        if assets_id_list is None:
+            return (self.asset_id_array, self.data[first_day_index:last_day_index].T, first_date)
+
+        columns = np.flatnonzero(np.isin(self.asset_id_array, np.asarray(list(assets_id_list), dtype=np.int64)))
+
+        return (self.asset_id_array[columns], self.data[first_day_index:last_day_index, columns].T, first_date)
+
+    def add_metering_points(self, metering_point_ids, asset_ids):
+        """ add columns for new metering points, the matrix is rewritten (the past days of the new metering points are nan)
+            the new matrix goes to a new data file, the index switches to it and the old file is removed
+
+        """
+        metering_point_ids = np.asarray(metering_point_ids, dtype=np.int64)
+        asset_ids = np.asarray(asset_ids, dtype=np.int64)
+        new = ~np.isin(metering_point_ids, self.metering_point_id_array)
+        if not new.any():
+            return
+
+        new_metering_point_id_array = np.concatenate((self.metering_point_id_array, metering_point_ids[new]))
+        new_asset_id_array = np.concatenate((self.asset_id_array, asset_ids[new]))
+        order = np.argsort(new_metering_point_id_array, kind='stable')
+        new_metering_point_id_array = new_metering_point_id_array[order]
+        new_asset_id_array = new_asset_id_array[order]
+
+        new_data = np.full((self.num_days, len(new_metering_point_id_array)), np.nan, dtype=np.float64)
+        if self.num_days > 0 and len(self.metering_point_id_array) > 0:
+            new_data[:, np.searchsorted(new_metering_point_id_array, self.metering_point_id_array)] = self.data
+        old_data_filename = self.data_filename
+        generation = int(os.path.basename(old_data_filename)[len("daily_energy_"):-len(".f64")]) + 1
+        self.data_filename = os.path.join(os.path.dirname(old_data_filename), "daily_energy_%d.f64" % generation)
+        new_data.tofile(self.data_filename)
+        del new_data
+        self.data = np.empty((0, 0), dtype=np.float64)
+        self.metering_point_id_array = new_metering_point_id_array
+        self.asset_id_array = new_asset_id_array
+        self.write_index()
+        os.remove(old_data_filename)
+        self.load()
+
+    def append_days(self, day_matrix):
+        """ append a days x metering points matrix of the days following the store, the columns follow metering_point_id_array
+
+        """
+        day_matrix = np.asarray(day_matrix, dtype=np.float64)
+        with open(self.data_filename, "r+b") as data_file:
+            # drop the rows of an interrupted append
+            data_file.truncate(self.num_days * len(self.metering_point_id_array) * 8)
+            data_file.seek(0, os.SEEK_END)
+            data_file.write(np.ascontiguousarray(day_matrix).tobytes())
+        self.num_days += day_matrix.shape[0]
+        self.write_index()
+        self.load()
+
+    def sync(self, cur, start_date, end_date, itersize=100000):
+        """ fetch the daily energy of the days after the store up to end_date (excluded) with one query and append them
+            start_date is the origin of a new store, it is not used when the store exists
+            return the number of new days
+
+        """
+        if self.origin_day is None:
+            self.create(start_date)
+        sync_start_date = self.end_date()
+        num_new_days = (end_date - sync_start_date).days
+        if num_new_days <= 0:
+            return 0
+
+        try:
+            cur.execute("select b.id, b.asset_id, (a.aggregation_time::date - %s::date), (a.interpolated_kwh + a.measured_kwh)::float8 \
+                         from energy_metering_points b, energy_aggregation_daily a \
+                         where b.id = a.metering_point_id \
+                         and a.aggregation_time >= %s and a.aggregation_time < %s", (sync_start_date, sync_start_date, end_date))
+        except:
+            print("I am unable to get data")
+
+        metering_point_id_pieces = []
+        asset_id_pieces = []
+        day_index_pieces = []
+        energy_pieces = []
+        rows = cur.fetchmany(itersize)
+        while rows:
+            metering_point_id_pieces.append(np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)))
+            asset_id_pieces.append(np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows)))
+            day_index_pieces.append(np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows)))
+            energy_pieces.append(np.fromiter((np.nan if row[3] is None else row[3] for row in rows), dtype=np.float64, count=len(rows)))
+            rows = cur.fetchmany(itersize)
+
+        if metering_point_id_pieces:
+            metering_point_id_array = np.concatenate(metering_point_id_pieces)
+            day_index_array = np.concatenate(day_index_pieces)
+            energy_array = np.concatenate(energy_pieces)
+            metering_point_ids, first_indexes = np.unique(metering_point_id_array, return_index=True)
+            self.add_metering_points(metering_point_ids, np.concatenate(asset_id_pieces)[first_indexes])
+        else:
+            metering_point_id_array = np.empty(0, dtype=np.int64)
+            day_index_array = np.empty(0, dtype=np.int64)
+            energy_array = np.empty(0, dtype=np.float64)
+
+        day_matrix = np.full((num_new_days, len(self.metering_point_id_array)), np.nan, dtype=np.float64)
+        day_matrix[day_index_array, np.searchsorted(self.metering_point_id_array, metering_point_id_array)] = energy_array
+        self.append_days(day_matrix)
+
+        return num_new_days
+
+
+class DailyEnergyStoreSync:
+    """ sync command of the daily energy store:
+          python daily_energy_store.py config.json
+        appends the days up to period_end_date (excluded) to the store in daily_energy_store_dir,
+        a new store starts at period_start_date, the region is the database name
+
+    """
+
+    def __init__(self, configJSONFilename):
+        """ initialize variables
+
+        """
+        #configuration file name
+        self.configFilename = configJSONFilename
+
+    def connect_db(self):
+        """ build connection to the database
+
+        """
+        #connect to the database
+        try:
+            print(self.pg_dbname)
+            self.conn = psycopg2.connect("dbname=%s user=%s password=%s host=%s port=%s" % (self.pg_dbname, self.pg_username, self.pg_password, self.pg_host, self.pg_port))
+            print("connected!")
+        except psycopg2.Error as e:
+            print("I am unable to connect to the database")
+            print(e)
+
+        #define cursor
+        self.cur = self.conn.cursor()
+
+    def get_config(self, configFilename):
+        """ get configuration parameters
+
+        """
+        with open(configFilename) as config_file:
+            config_data = json.load(config_file)
+
+            self.pg_dbname = config_data['pg_dbname']
+            self.pg_username = config_data['pg_username']
+            self.pg_password = config_data['pg_password']
+            self.pg_host = config_data['pg_host']
+            self.pg_port = config_data['pg_port']
+            #period start date, the first day of a new store
+            self.startDate = datetime.datetime.strptime(config_data['period_start_date'], '%m/%d/%Y').date()
+            #period end date, the store is synced up to this date (excluded)
+            self.endDate = datetime.datetime.strptime(config_data['period_end_date'], '%m/%d/%Y').date()
+            #directory of the daily energy store
+            self.daily_energy_store_dir = config_data['daily_energy_store_dir']
+
+    def run(self):
+        """  call this method to run the program
+
+        """
+        self.get_config(self.configFilename)
+        self.connect_db()
+        dailyEnergyStore = DailyEnergyStore(self.daily_energy_store_dir, self.pg_dbname)
+        num_new_days = dailyEnergyStore.sync(self.cur, self.startDate, self.endDate)
+        print("%d new days, %d days x %d metering points in the store" % (num_new_days, dailyEnergyStore.num_days, len(dailyEnergyStore.metering_point_id_array)))
+        self.conn.commit()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+
+    configJSONFilename = sys.argv[1]
+    dailyEnergyStoreSync = DailyEnergyStoreSync(configJSONFilename)
+    dailyEnergyStoreSync.run()
@@ -0,0 +1,52 @@
+import itertools
+
+
+class StreamingReader:
+    """ read the rows of a query through a psycopg2 named (server-side) cursor
+        the result stays on the server and is transferred itersize rows at a time,
+        so the client memory stays flat whatever the size of the result and the rows can be processed as they arrive
+
+        the named cursor lives inside the current transaction, so the connection must not be in autocommit mode
+
+    """
+
+    #counter used to give each named cursor a unique name
+    cursor_counter = itertools.count()
+
+    def __init__(self, conn, itersize=2000):
+        """ initialize variables
+
+        """
+        #database connection
+        self.conn = conn
+        #number of rows transferred from the server in one round trip
+        self.itersize = itersize
+
+    def iter_batches(self, query, params):
+        """ execute the query and yield the result as lists of at most itersize rows
+
+        """
+        cursor_name = "stream_cursor_%d" % next(StreamingReader.cursor_counter)
+        cur = self.conn.cursor(name=cursor_name)
+        cur.itersize = self.itersize
+        try:
+            try:
+                cur.execute(query, params)
+            except:
+                print("I am unable to get data")
+                return
+
+            rows = cur.fetchmany(self.itersize)
+            while rows:
+                yield rows
+                rows = cur.fetchmany(self.itersize)
+        finally:
+            cur.close()
+
+    def iter_rows(self, query, params):
+        """ execute the query and yield the rows one at a time
+
+        """
+        for rows in self.iter_batches(query, params):
+            for row in rows:
+                yield row
@@ -1,9 +1,13 @@
 import datetime  
 from sunrise import sun 
+from suntime_table import SunTimeTable, SunTimeDict
 import psycopg2
 import csv
 import sys
 import json
+import bisect
+from readings_cache import ReadingsCache
+from fast_fetch import register_float_numeric, readings_columns, to_epoch
 
 class EnergyConsumption:
 
@@ -69,6 +73,16 @@ class EnergyConsumption:
             self.suntime_latitude = float(config_data['suntime_location_latitude'])
             #suntime location longitude
             self.suntime_longitude = float(config_data['suntime_location_longitude'])
+            #directory of the persisted sun time tables, empty means the table is only kept in memory
+            self.suntime_table_dir = config_data.get('suntime_table_dir', '')
+            #fetch the readings of a batch of assets with one range scan, instead of one query per asset per day, optional
+            self.batchMode = config_data.get('batch_mode', 'false').lower() == 'true'
+            #number of assets in one batch for the batch mode
+            self.assetBatchSize = int(config_data.get('asset_batch_size', '1000'))
+            #directory of the local readings cache (see readings_cache.py), the batch mode reads from it instead of the db, optional
+            self.readings_cache_dir = config_data.get('readings_cache_dir', '')
+            #the batch mode fetches kwh as floats and timestamps as epoch seconds instead of Decimal and datetime objects, optional
+            self.fastFetch = config_data.get('fast_fetch', 'false').lower() == 'true'
 
     def run(self):
         """  call this method to run the program
@@ -78,14 +92,23 @@ class EnergyConsumption:
         self.getConfig(self.configFilename)
         #step 2:  connect to db
         self.connectDB()
+        if self.fastFetch:
+            register_float_numeric(self.conn)
         #step 3:  compute sunrise and sunset time 
         self.computeSunTime(self.suntime_latitude, self.suntime_longitude, self.startDate, self.endDate)
+        if self.readings_cache_dir:
+            self.readingsCache = ReadingsCache(self.readings_cache_dir, self.pg_dbname)
+        else:
+            self.readingsCache = None
         #step 4:  get assets list
         #assets = self.getAssetsList()
         assets = [(3776, -6.118187, 106.894265, datetime.date(2016, 5, 27), datetime.date(2016, 6, 1))]
         #assets = [(3776, -6.118187, 106.894265), (13532, -6.102635, 106.932242)]
         #step 5:  call computeResults method
-        self.computeResults(assets)
+        if self.batchMode:
+            self.computeResultsInBatch(assets)
+        else:
+            self.computeResults(assets)
 
     def computeResults(self, assets):
         """ compute results
@@ -110,6 +133,22 @@ class EnergyConsumption:
                 for record in results:
                     csvWriter.writerow(record)
 
+    def computeResultsInBatch(self, assets):
+        """ compute results, the readings of each batch of assets are fetched once for the whole period
+            and split into daylight windows using sunriseTimeDict and sunsetTimeDict
+            the output rows are the same as computeResults
+
+        """
+        count = 0
+        with open(self.outputFilename, "w") as csvFile:
+            csvWriter = csv.writer(csvFile, delimiter=',')
+            for start_index in range(0, len(assets), self.assetBatchSize):
+                assets_batch = assets[start_index:start_index + self.assetBatchSize]
+                count += 1
+                print(count)
+                for record in self.computeEnergyForAssetBatch(assets_batch):
+                    csvWriter.writerow(record)
+
     def getAssetsList(self):
         """ get assets list from assets table, which are not deleted and installation_date and commissioning_date are not null
 
@@ -168,6 +207,92 @@ class EnergyConsumption:
 
         return results      
 
+    def computeEnergyForAssetBatch(self, assets):
+        """ compute the energy consumption for a batch of assets with two queries in total:
+            one grouped max() for the last meter reading dates and one range scan for the readings
+
+        Args:
+            assets: a list of tuples, (id, latitude, longitude, installation_date, commissioning_date)
+
+        """
+        assets_id_tuple = tuple([asset[0] for asset in assets])
+        if self.readingsCache is not None:
+            # the readings cache covers whole months, the last readings are looked up until the end of the month of the end date
+            period_start_time = datetime.datetime.combine(self.startDate, datetime.time())
+            period_end_time = datetime.datetime.combine(self.readingsCache.next_month(self.endDate.replace(day=1)), datetime.time())
+            last_meter_reading_datetime_dict = self.readingsCache.read_last_timestamps(assets_id_tuple, period_start_time, period_end_time)
+        else:
+            last_meter_reading_datetime_dict = self.getLastMeterReadingDateForAssets(assets_id_tuple)
+
+        #the daylight windows of all the dates in the period
+        period_dates = sorted([date for date in self.sunriseTimeDict if self.startDate <= date < self.endDate])
+        if len(period_dates) == 0:
+            return []
+        rangeStart = min([self.sunriseTimeDict[date] for date in period_dates])
+        rangeEnd = max([self.sunsetTimeDict[date] for date in period_dates])
+
+        if self.readingsCache is not None and self.fastFetch:
+            # the cached arrays already hold float kwh and epoch seconds
+            asset_id_array, meter_component_id_array, epoch_array, kwh_array = self.readingsCache.read_arrays(assets_id_tuple, rangeStart, rangeEnd + datetime.timedelta(microseconds=1))
+            batch_rows = sorted(zip(asset_id_array.tolist(), kwh_array.tolist(), epoch_array.tolist()), key=lambda row: (row[0], row[2]))
+        elif self.readingsCache is not None:
+            cached_rows = self.readingsCache.read_rows(assets_id_tuple, rangeStart, rangeEnd + datetime.timedelta(microseconds=1))
+            # (asset_id, kwh, timestamp_utc) ordered by asset_id, timestamp_utc, the same as the query
+            batch_rows = sorted([(row[0], row[2], row[3]) for row in cached_rows], key=lambda row: (row[0], row[2]))
+        elif self.fastFetch:
+            try:
+                # (asset_id, kwh as a float, timestamp_utc as epoch seconds)
+                self.cur.execute("select b.asset_id , " + readings_columns() + " \
+                             from energy_metering_points b, energy_meter_readings a \
+                             where b.asset_id in %s and b.id = a.metering_point_id \
+                                and a.timestamp_utc >= %s and a.timestamp_utc <= %s \
+                             order by b.asset_id, a.timestamp_utc", (assets_id_tuple, rangeStart, rangeEnd))
+            except:
+                print("I am unable to get data")
+            batch_rows = self.cur.fetchall()
+        else:
+            try:
+                self.cur.execute("select b.asset_id , a.kwh, a.timestamp_utc \
+                             from energy_metering_points b, energy_meter_readings a \
+                             where b.asset_id in %s and b.id = a.metering_point_id \
+                                and a.timestamp_utc >= %s and a.timestamp_utc <= %s \
+                             order by b.asset_id, a.timestamp_utc", (assets_id_tuple, rangeStart, rangeEnd))
+            except:
+                print("I am unable to get data")
+            batch_rows = self.cur.fetchall()
+
+        #readings of each asset, ordered by time
+        asset_rows_dict = {}
+        for row in batch_rows:
+            asset_rows_dict.setdefault(row[0], []).append(row)
+
+        results = []
+        for asset in assets:
+            id, lat, long, installation_date, commissioning_date = asset
+            last_meter_reading_datetime = last_meter_reading_datetime_dict.get(id)
+            if last_meter_reading_datetime is None:
+                continue
+            rows = asset_rows_dict.get(id, [])
+            timestamps = [row[2] for row in rows]
+            valid_start_date = commissioning_date + datetime.timedelta(days=self.commissioningDatePlusDays)
+            date = max(valid_start_date, self.startDate)
+            last_date = min(last_meter_reading_datetime.date(), self.endDate)
+            while date < last_date:
+                daytimeStart = self.sunriseTimeDict[date]
+                daytimeEnd = self.sunsetTimeDict[date]
+                if self.fastFetch:
+                    daytimeStart = to_epoch(daytimeStart)
+                    daytimeEnd = to_epoch(daytimeEnd)
+                #the readings within [daytimeStart, daytimeEnd], the same as the per day query
+                first_index = bisect.bisect_left(timestamps, daytimeStart)
+                last_index = bisect.bisect_right(timestamps, daytimeEnd)
+                (onTime, energyConsumedKwh, energyConsumedWatts, numIntervals, numPositiveIntervals) = self.computeEnergyForRows(rows[first_index:last_index])
+                if onTime > self.onTimeThreshold:
+                    results.append((date, id, lat, long, installation_date, commissioning_date, onTime, energyConsumedKwh, energyConsumedWatts, numIntervals, numPositiveIntervals))
+                date += self.oneDayDelta
+
+        return results
+
     def getInstallationDate(self, id):
         """ get asset installation date
 
@@ -215,6 +340,27 @@ class EnergyConsumption:
         else:
             return rows[0][0]  
 
+    def getLastMeterReadingDateForAssets(self, assets_id_tuple):
+        """ get last meter reading date for a batch of assets with one grouped query
+            only the readings from the period start date are scanned, an asset whose last reading is earlier
+            has no daytime to compute in the period, the same as when it has no reading at all
+
+        """
+        try:
+            self.cur.execute("select b.asset_id, max(a.timestamp_utc) \
+                              from energy_meter_readings a, energy_metering_points b \
+                              where a.metering_point_id = b.id and b.asset_id in %s \
+                              and a.timestamp_utc >= %s \
+                              group by b.asset_id", (assets_id_tuple, datetime.datetime.combine(self.startDate, datetime.time())))
+        except:
+            print("I am unable to get data")
+
+        last_meter_reading_datetime_dict = {}
+        for row in self.cur.fetchall():
+            last_meter_reading_datetime_dict[row[0]] = row[1]
+
+        return last_meter_reading_datetime_dict
+
     def computeDaytimeStartEnd(self, date):
         """
 
@@ -253,12 +399,13 @@ class EnergyConsumption:
                 endDate:   datetime.date() variable, the end of a time period 
         """    
         self.sun = sun(lat=latitude, long=longitude)
-        dateTime = datetime.datetime.combine(startDate, datetime.time(hour=8))
-        while dateTime.date() <= endDate:        
-            daytimeStart, daytimeEnd = self.computeDaytimeStartEnd(dateTime)
-            self.sunriseTimeDict[dateTime.date()] = daytimeStart
-            self.sunsetTimeDict[dateTime.date()] = daytimeEnd
-            dateTime += self.oneDayDelta
+        #the dates outside [startDate, endDate] are computed on demand, the table is saved for the next runs
+        self.sunTimeTable = SunTimeTable(latitude, longitude, self.suntime_table_dir)
+        self.sunriseTimeDict = SunTimeDict(self.sunTimeTable, 'sunrise', self.sunriseTimeDelta)
+        self.sunsetTimeDict = SunTimeDict(self.sunTimeTable, 'sunset', -self.sunsetTimeDelta)
+        self.sunriseTimeDict.fill(startDate, endDate)
+        self.sunsetTimeDict.fill(startDate, endDate)
+        self.sunTimeTable.save()
     
     def computeEnergyForOneDay(self, asset_id, daytimeStart, daytimeEnd):
         """ accumulate the light 'on' time and energy consumption during daytime
@@ -279,9 +426,19 @@ class EnergyConsumption:
             print("I am unable to get data")
 
         rows = self.cur.fetchall() 
+        return self.computeEnergyForRows(rows)
+
+    def computeEnergyForRows(self, rows):
+        """ accumulate the light 'on' time and energy consumption from the readings of one asset within one daytime window
+            the timestamps are datetime objects or epoch seconds (fast fetch)
+
+        return:  (onTime, EnergyConsumed, Watts, numIntervals, numPositiveIntervals)
+
+        """
         if len(rows) == 0:
             return (0, 0, 0, 0, 0)
         
+        epoch_seconds = not isinstance(rows[0][2], datetime.datetime)
         totalOnTime, totalEnergyConsumed, totalWatts = 0, 0, 0
         num_interval, num_interval_positive = 0, 0
         lastEnergy, lastTime = None, None    
@@ -292,7 +449,10 @@ class EnergyConsumption:
             else:
                 currentEnergy = row[1]
                 currentTime = row[2]
-                secondsInterval = (currentTime - lastTime).total_seconds()
+                if epoch_seconds:
+                    secondsInterval = currentTime - lastTime
+                else:
+                    secondsInterval = (currentTime - lastTime).total_seconds()
                 energyConsumed = currentEnergy - lastEnergy
                 lastEnergy = currentEnergy
                 lastTime = currentTime 
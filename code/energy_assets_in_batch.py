@@ -4,6 +4,12 @@ import psycopg2
 import csv
 import sys
 import json
+from interval_engine import IntervalEngine
+from parallel_runner import ParallelRunner
+from readings_cache import ReadingsCache
+from csv_sink import open_sink
+from batch_prefetcher import BatchPrefetcher
+from batch_planner import BatchPlanner
 
 class EnergyConsumption:
 
@@ -78,6 +84,18 @@ class EnergyConsumption:
         #define cursor
         self.cur = self.conn.cursor()  
 
+    def connect_fetch_db(self):
+        """ build the second connection used by the prefetch thread, a psycopg2 cursor must not be shared between threads
+
+        """
+        try:
+            self.fetch_conn = psycopg2.connect("dbname=%s user=%s password=%s host=%s port=%s" % (self.pg_dbname, self.pg_username, self.pg_password, self.pg_host, self.pg_port))
+        except psycopg2.Error as e:
+            print("I am unable to connect to the database")
+            print(e)
+
+        self.fetch_cur = self.fetch_conn.cursor()
+
     def get_config(self, configFilename):
         """ get configuration parameters
 
@@ -90,7 +108,7 @@ class EnergyConsumption:
             self.pg_password = config_data['pg_password']
             self.pg_host = config_data['pg_host']
             self.pg_port = config_data['pg_port']
-            #output filename
+            #output filename, a .parquet file name writes a typed parquet file instead of a csv file (needs pyarrow)
             self.outputFilename = config_data['output_csvfile_name']
             #define energyThreshold: 2 watt
             self.energyThreshold = int(config_data['energy_threshold'])  
@@ -125,6 +143,16 @@ class EnergyConsumption:
             hours_from_utc = int(config_data['hours_from_utc'])
             # UTC time plus this time to get local time
             self.local_time_hours_from_utc = datetime.timedelta(hours=hours_from_utc)
+            #use the vectorized numpy interval engine instead of the per-row loop, optional
+            self.use_vectorized_engine = config_data.get('use_vectorized_engine', 'false').lower() == 'true'
+            #number of worker processes, each one computes shards of the assets list with its own db connection, optional
+            self.num_workers = int(config_data.get('num_workers', '1'))
+            #directory of the local readings cache (see readings_cache.py), the readings are read from it instead of the db, optional
+            self.readings_cache_dir = config_data.get('readings_cache_dir', '')
+            #number of batches fetched ahead on a second db connection while a batch is computed, 0 fetches and computes in turn, optional
+            self.prefetch_batches = int(config_data.get('prefetch_batches', '1'))
+            #target number of readings in a batch of assets (see batch_planner.py), 0 uses batches of 1000 assets, optional
+            self.batch_target_rows = int(config_data.get('batch_target_rows', '500000'))
 
     def run(self):
         """  call this method to run the program
@@ -143,29 +171,151 @@ class EnergyConsumption:
         assets_id_list = self.getAssetsList()
         #step 5:  call computeResults method
         #self.computeResults(assets)
+        # the results of each batch are written to the output file as soon as they are computed
+        assets_id_batches = self.plan_batches(assets_id_list)
+        with open_sink(self.outputFilename, self.get_title_row()) as sink:
+            if self.num_workers > 1:
+                # each worker prepares its own assets info, nominal wattage and db connection
+                # the shards get the same number of batches, so about the same number of readings
+                parallelRunner = ParallelRunner(EnergyConsumption, self.configFilename, self.num_workers, 'prepare_worker')
+                parallelRunner.run(assets_id_batches, 'compute_batches', sink=sink)
+            else:
+                self.prepare_computing()
+                self.compute_batches(assets_id_batches, sink)
+
+            print("finished computing")
+
+        print("finished output to files")
+
+    def prepare_computing(self):
+        """ load the assets info and nominal wattage used by the computing
+
+        """
         self.get_assets_info()
         print("got assets info")
         self.get_nominal_wattage()
         print("got nominal wattage info")
+        if self.readings_cache_dir:
+            self.readingsCache = ReadingsCache(self.readings_cache_dir, self.pg_dbname)
+        else:
+            self.readingsCache = None
+        if self.use_vectorized_engine:
+            self.intervalEngine = IntervalEngine(self.sunrise_time_avg_local, self.sunset_time_avg_local, self.daytime_start_time_local, self.daytime_end_time_local, self.energyThreshold, self.nominal_wattage_ratio)
+
+    def prepare_worker(self):
+        """ prepare a worker process of the parallel runner: read the config, open its own db connection and load the assets info
+
+        """
+        self.get_config(self.configFilename)
+        self.connect_db()
+        self.prepare_computing()
+
+    def plan_batches(self, assets_id_list):
+        """ split the assets list into batches of about batch_target_rows readings with a BatchPlanner,
+            the readings are counted in the readings cache if there is one, else with one grouped query
+            with batch_target_rows = 0, the batches have 1000 assets
+
+        """
+        if self.batch_target_rows <= 0:
+            step = 1000
+            return [assets_id_list[start_index:start_index + step] for start_index in range(0, len(assets_id_list), step)]
+
+        first_date_time = datetime.datetime.combine(self.startDate, datetime.time(0, 0, 0))
+        last_date_time = datetime.datetime.combine(self.endDate, datetime.time(23, 59, 59))
+        batchPlanner = BatchPlanner(self.batch_target_rows)
+        if self.readings_cache_dir:
+            reading_count_dict = ReadingsCache(self.readings_cache_dir, self.pg_dbname).read_reading_counts(assets_id_list, first_date_time, last_date_time)
+        else:
+            reading_count_dict = batchPlanner.count_readings(self.cur, first_date_time, last_date_time)
+
+        return batchPlanner.plan(assets_id_list, reading_count_dict)
+
+    def compute_batches(self, assets_id_sublists, sink=None):
+        """ compute the energy consumption for a list of batches of assets (see plan_batches), one query per batch
+            if a sink is given, the results of each query are written to it and an empty list is returned
+            with prefetch_batches > 0, the readings of the next batches are fetched by a BatchPrefetcher while a batch is computed
+
+        """
+        if self.prefetch_batches > 0:
+            if self.readingsCache is None:
+                self.connect_fetch_db()
+            batch_readings = BatchPrefetcher(self.fetch_readings, assets_id_sublists, self.prefetch_batches)
+        else:
+            # each batch is fetched when it is computed
+            batch_readings = ((assets_id_sublist, None) for assets_id_sublist in assets_id_sublists)
 
-        start_index = 0
-        step = 1000
-        end_index = start_index + step
-        assets_id_sublist = assets_id_list[start_index:end_index]
         results = []
         count = 0
-        while assets_id_sublist:
-            count += 1
-            print(count)
-            results += self.compute_energy_consumption(assets_id_sublist)
-            start_index += step
-            end_index += step
-            assets_id_sublist = assets_id_list[start_index:end_index]
+        try:
+            for assets_id_sublist, readings in batch_readings:
+                count += 1
+                print(count)
+                if readings is not None:
+                    batch_results = self.compute_fetched_readings(assets_id_sublist, readings)
+                elif self.use_vectorized_engine:
+                    batch_results = self.compute_energy_consumption_vectorized(assets_id_sublist)
+                else:
+                    batch_results = self.compute_energy_consumption(assets_id_sublist)
+                if sink is not None:
+                    sink.write_batch(batch_results)
+                else:
+                    results += batch_results
+        finally:
+            if self.prefetch_batches > 0:
+                batch_readings.close()
+                if self.readingsCache is None:
+                    self.fetch_conn.close()
 
-        print("finished computing")
+        return results
 
-        self.write_to_file(results)
-        print("finished output to files")
+    def fetch_readings(self, assets_id_list):
+        """ fetch the readings of a batch of assets in the prefetch thread, with the fetch connection
+            return the rows for compute_energy_consumption_rows, or the arrays of the interval engine in vectorized mode
+
+        """
+        first_date_time = datetime.datetime.combine(self.startDate, datetime.time(0, 0, 0))
+        last_date_time = datetime.datetime.combine(self.endDate, datetime.time(23, 59, 59))
+
+        if self.readingsCache is not None:
+            if self.use_vectorized_engine:
+                (asset_id_array, meter_component_id_array, epoch_array, kwh_array) = self.readingsCache.read_arrays(assets_id_list, first_date_time, last_date_time)
+                return (asset_id_array, meter_component_id_array, epoch_array + self.local_time_hours_from_utc.total_seconds(), kwh_array)
+            return self.readingsCache.read_rows(assets_id_list, first_date_time, last_date_time)
+
+        self.execute_readings_query(self.fetch_cur, assets_id_list, self.use_vectorized_engine)
+        rows = self.fetch_cur.fetchall()
+        if self.use_vectorized_engine:
+            return self.intervalEngine.load_rows(rows, self.local_time_hours_from_utc)
+
+        return rows
+
+    def compute_fetched_readings(self, assets_id_list, readings):
+        """ compute the energy consumption of a batch of assets from the readings returned by fetch_readings
+
+        """
+        if self.use_vectorized_engine:
+            return self.compute_energy_consumption_arrays(assets_id_list, readings)
+
+        return self.compute_energy_consumption_rows([readings])
+
+    def execute_readings_query(self, cur, assets_id_list, epoch_timestamps=False):
+        """ execute the query of the readings of a batch of assets on a cursor
+            with epoch_timestamps, the timestamp is fetched as epoch seconds, so no datetime object is built for each row
+
+        """
+        first_date_time = datetime.datetime.combine(self.startDate, datetime.time(0, 0, 0))
+        last_date_time = datetime.datetime.combine(self.endDate, datetime.time(23, 59, 59))
+        timestamp_column = "extract(epoch from a.timestamp_utc)::float8" if epoch_timestamps else "a.timestamp_utc"
+
+        try:
+            #there might be multiple lights in an assets, so need to order by asset_id and component_id
+            cur.execute("select b.asset_id , b.meter_component_id, a.kwh, " + timestamp_column + " \
+                         from energy_metering_points b, energy_meter_readings a \
+                         where b.asset_id in %s and b.id = a.metering_point_id \
+                         and a.timestamp_utc >= %s and a.timestamp_utc < %s \
+                         order by b.asset_id, b.meter_component_id, a.timestamp_utc", (tuple(assets_id_list), first_date_time, last_date_time))
+        except:
+            print("I am unable to get data")
 
     def getAssetsList(self):
         """ get assets list from assets table, which are not deleted and installation_date and commissioning_date are not null
@@ -268,32 +418,33 @@ class EnergyConsumption:
         """ compute the energy consumption
 
         """
-        results = []
         first_date_time = datetime.datetime.combine(self.startDate, datetime.time(0, 0, 0))
         last_date_time = datetime.datetime.combine(self.endDate, datetime.time(23, 59, 59))
 
-        assets_id_tuple = tuple(assets_id_list)
-
         #print("before query for kwh data")
 
-        try:
-            #there might be multiple lights in an assets, so need to order by asset_id and component_id
-            self.cur.execute("select b.asset_id , b.meter_component_id, a.kwh, a.timestamp_utc \
-                              from energy_metering_points b, energy_meter_readings a \
-                              where b.asset_id in %s and b.id = a.metering_point_id \
-                              and a.timestamp_utc >= %s and a.timestamp_utc < %s \
-                              order by b.asset_id, b.meter_component_id, a.timestamp_utc", (assets_id_tuple, first_date_time, last_date_time))
-        except:
-            print("I am unable to get data")
+        if self.readingsCache is not None:
+            # the readings are read from the local cache in one batch
+            row_batches = iter([self.readingsCache.read_rows(assets_id_list, first_date_time, last_date_time)])
+        else:
+            self.execute_readings_query(self.cur, assets_id_list)
+            row_batches = iter(lambda: self.cur.fetchmany(50000), [])
 
         #print("finished query for kwh data")    
 
+        return self.compute_energy_consumption_rows(row_batches)
+
+    def compute_energy_consumption_rows(self, row_batches):
+        """ compute the energy consumption from batches of rows (asset_id, meter_component_id, kwh, timestamp_utc)
+            ordered by asset_id, meter_component_id, timestamp_utc
+
+        """
+        results = []
         current_asset_id = None
         current_meter_component_id = None
         count = 0
 
-        rows = self.cur.fetchmany(50000)
-        while rows:
+        for rows in row_batches:
             #process each record in order 
             for row in rows:   
                 row_asset_id = row[0]
@@ -405,8 +556,6 @@ class EnergyConsumption:
                 #first_time_stamp_in_daytime, last_time_stamp_in_daytime = None, None
                 first_time_stamp_after_sunrise, last_time_stamp_before_sunset = None, None
 
-            rows = self.cur.fetchmany(50000)   
-
         if current_asset_id is None:
             #no data             
             return results
@@ -421,14 +570,56 @@ class EnergyConsumption:
                 
         return results          
 
+    def compute_energy_consumption_vectorized(self, assets_id_list):
+        """ compute the energy consumption with the numpy interval engine
+            the output rows are the same as compute_energy_consumption
+
+        """
+        first_date_time = datetime.datetime.combine(self.startDate, datetime.time(0, 0, 0))
+        last_date_time = datetime.datetime.combine(self.endDate, datetime.time(23, 59, 59))
+
+        if self.readingsCache is not None:
+            # the readings are read from the local cache as arrays
+            (asset_id_array, meter_component_id_array, epoch_array, kwh_array) = self.readingsCache.read_arrays(assets_id_list, first_date_time, last_date_time)
+            epoch_array = epoch_array + self.local_time_hours_from_utc.total_seconds()
+        else:
+            self.execute_readings_query(self.cur, assets_id_list, True)
+            rows = self.cur.fetchall()
+            (asset_id_array, meter_component_id_array, epoch_array, kwh_array) = self.intervalEngine.load_rows(rows, self.local_time_hours_from_utc)
+            del rows
+
+        return self.compute_energy_consumption_arrays(assets_id_list, (asset_id_array, meter_component_id_array, epoch_array, kwh_array))
+
+    def compute_energy_consumption_arrays(self, assets_id_list, arrays):
+        """ compute the energy consumption with the numpy interval engine from the arrays (asset_id, meter_component_id, local epoch, kwh)
+
+        """
+        (asset_id_array, meter_component_id_array, epoch_array, kwh_array) = arrays
+        results = []
+        valid_start_date_dict = {}
+        for asset_id in assets_id_list:
+            if asset_id in self.assets_commissioning_date_dict:
+                valid_start_date_dict[asset_id] = self.assets_commissioning_date_dict[asset_id] + datetime.timedelta(days=self.commissioningDatePlusDays)
+
+        day_results = self.intervalEngine.compute(asset_id_array, meter_component_id_array, epoch_array, kwh_array, self.assets_nominal_wattage_dict, valid_start_date_dict, self.onTimeThreshold)
+        for (asset_id, meter_component_id, current_date, totalOnTime, first_time_stamp_after_sunrise, last_time_stamp_before_sunset, totalEnergyConsumed, totalWatts, num_interval, num_interval_positive) in day_results:
+            results.append((self.pg_dbname, current_date, asset_id, meter_component_id, self.assets_luminaire_type_dict[asset_id], self.assets_latitude_dict[asset_id], self.assets_longitude_dict[asset_id], self.assets_installation_date_dict[asset_id], self.assets_commissioning_date_dict[asset_id], self.assets_nominal_wattage_dict[asset_id], self.assets_street_name_dict[asset_id], totalOnTime, first_time_stamp_after_sunrise, last_time_stamp_before_sunset, totalEnergyConsumed, totalWatts, num_interval, num_interval_positive))
+
+        return results
+
+    def get_title_row(self):
+        """ title row of the output file
+
+        """
+        return ('region', 'date', 'asset_id', 'meter_component_id', 'luminaire_type', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'nominal_wattage', 'street_name', 'timespan', 'first_timestamp', 'last_timestamp', 'energyConsumedKwh', 'energyConsumedWatts', 'numIntervals', 'numPositiveIntervals')
+
     def write_to_file(self, results):
         """ write results to output file
 
         """
         with open(self.outputFilename, "w") as csvFile:
             csvWriter = csv.writer(csvFile, delimiter=',')   
-            title_row = ('region', 'date', 'asset_id', 'meter_component_id', 'luminaire_type', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'nominal_wattage', 'street_name', 'timespan', 'first_timestamp', 'last_timestamp', 'energyConsumedKwh', 'energyConsumedWatts', 'numIntervals', 'numPositiveIntervals')         
-            csvWriter.writerow(title_row)
+            csvWriter.writerow(self.get_title_row())
             for record in results:
                 csvWriter.writerow(record)
 
@@ -177,7 +177,6 @@ class EnergyConsumption:
         """ compute the energy consumption
 
         """
-        results = []
         first_date_time = datetime.datetime.combine(self.startDate, datetime.time(0, 0, 0))
         last_date_time = datetime.datetime.combine(self.endDate, datetime.time(23, 59, 59))
 
@@ -195,11 +194,17 @@ class EnergyConsumption:
 
         print("finished query for kwh data")    
 
+        return self.compute_energy_consumption_rows(iter(lambda: self.cur.fetchmany(50000), []))
+
+    def compute_energy_consumption_rows(self, row_batches):
+        """ compute the energy consumption from batches of rows (asset_id, kwh, timestamp_utc) ordered by asset_id, timestamp_utc
+
+        """
+        results = []
         current_asset_id = None
         count = 0
 
-        rows = self.cur.fetchmany(50000)
-        while rows:
+        for rows in row_batches:
             #process each record in order 
             for row in rows:   
                 row_asset_id = row[0]
@@ -300,8 +305,6 @@ class EnergyConsumption:
                 #first_time_stamp_in_daytime, last_time_stamp_in_daytime = None, None
                 first_time_stamp_after_sunrise, last_time_stamp_before_sunset = None, None
 
-            rows = self.cur.fetchmany(50000)   
-
         if current_asset_id is None:
             #no data             
             return results
@@ -316,14 +319,19 @@ class EnergyConsumption:
                 
         return results          
 
+    def get_title_row(self):
+        """ title row of the output file
+
+        """
+        return ('region', 'date', 'asset_id', 'luminaire_type', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'nominal_wattage', 'street_name', 'timespan', 'first_timestamp', 'last_timestamp', 'energyConsumedKwh', 'energyConsumedWatts', 'numIntervals', 'numPositiveIntervals')
+
     def write_to_file(self, results):
         """ write results to output file
 
         """
         with open(self.outputFilename, "w") as csvFile:
             csvWriter = csv.writer(csvFile, delimiter=',')   
-            title_row = ('region', 'date', 'asset_id', 'luminaire_type', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'nominal_wattage', 'street_name', 'timespan', 'first_timestamp', 'last_timestamp', 'energyConsumedKwh', 'energyConsumedWatts', 'numIntervals', 'numPositiveIntervals')         
-            csvWriter.writerow(title_row)
+            csvWriter.writerow(self.get_title_row())
             for record in results:
                 csvWriter.writerow(record)
 
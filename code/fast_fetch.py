@@ -0,0 +1,56 @@
+""" opt-in fetch layer for the meter readings
+    by default psycopg2 returns numeric kwh values as Decimal and timestamps as datetime objects,
+    so the row loops do one Decimal subtraction and one timedelta.total_seconds() per reading
+
+    register_float_numeric() makes a connection return every numeric column as a float,
+    readings_columns() casts the kwh column to float8 and the timestamp column to integer epoch seconds in the query,
+    the row loops then only do float and integer arithmetic
+
+"""
+import datetime
+import psycopg2
+import psycopg2.extensions
+
+
+#epoch of the integer timestamps (timestamp_utc is stored in UTC)
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def cast_float(value, cur):
+    """ typecaster of numeric values: the text sent by the server is parsed as a float
+
+    """
+    if value is None:
+        return None
+    return float(value)
+
+
+FLOAT_NUMERIC = psycopg2.extensions.new_type(psycopg2.extensions.DECIMAL.values, 'FLOAT_NUMERIC', cast_float)
+
+
+def register_float_numeric(conn_or_cur):
+    """ return the numeric columns as floats on a connection (or a cursor) instead of Decimal
+
+    """
+    psycopg2.extensions.register_type(FLOAT_NUMERIC, conn_or_cur)
+
+
+def readings_columns(kwh_column='a.kwh', timestamp_column='a.timestamp_utc'):
+    """ select list of the kwh value as a float and the timestamp as integer epoch seconds (rounded to the second)
+
+    """
+    return "%s::float8, extract(epoch from %s)::int8" % (kwh_column, timestamp_column)
+
+
+def to_epoch(date_time):
+    """ convert a datetime object in UTC to epoch seconds, to compare it with the fetched timestamps
+
+    """
+    return (date_time - EPOCH).total_seconds()
+
+
+def from_epoch(seconds):
+    """ convert epoch seconds back to a datetime object in UTC
+
+    """
+    return EPOCH + datetime.timedelta(seconds=seconds)
@@ -3,14 +3,19 @@ import googlemaps as gmaps
 import psycopg2
 import csv
 import json
+from batch_writer import BatchWriter
+from geocoding_pipeline import GeocodeCache, GeocodingPipeline
 
 class GeoCoding:
-    def __init__(self, key):
+    def __init__(self, key, client=None):
         """ initialize variables
+            client: the reverse geocoder, a googlemaps client with the key by default (a StubGeocoder for tests)
 
         """
         self.key = key
-        self.client = gmaps.Client(key = self.key)
+        if client is None:
+            client = gmaps.Client(key = self.key)
+        self.client = client
         #self.table_name = 'streets_reverse_geocoded'
 
         self.pg_dbname = "citytouch_temp"
@@ -19,6 +24,17 @@ class GeoCoding:
         self.pg_host = "citytouch-buenos-aires-log.cuxwb2nbset5.us-west-2.rds.amazonaws.com"
         self.pg_port = "5432"
 
+        #number of geocoded rows written (and committed) in one batch
+        #the rows of an interrupted batch are not in the table, getRemainingAssetsList picks them up again
+        self.write_batch_size = 100
+
+        #local cache (and checkpoint) of the geocoding results
+        self.geocode_cache_file = 'geocode_cache.jsonl'
+        #number of concurrent geocoding requests
+        self.geocoding_threads = 8
+        #max number of geocoding requests per second
+        self.geocoding_rate = 40
+
     def connect_db(self):
         """ build connection to the database
 
@@ -42,6 +58,12 @@ class GeoCoding:
         self.cur.close()
         self.conn.close()
 
+    def getGeocodedWriter(self):
+        """ batched writer for the streets_reverse_geocoded table
+
+        """
+        return BatchWriter(self.conn, 'streets_reverse_geocoded', ['id', 'asset_id', 'route', 'administrative_area_level_2', 'country'], self.write_batch_size)
+
     def load_existing_records(self):
         """ this method is only for CABA, use it to load street address already geocoded into the database
 
@@ -56,6 +78,7 @@ class GeoCoding:
 
         rows = self.cur.fetchall()
         count = 0
+        geocodedWriter = self.getGeocodedWriter()
 
         for row in rows:
             count += 1
@@ -66,14 +89,9 @@ class GeoCoding:
 
             print(count, asset_id, street_name, city_name, country_name)  
 
-            try:
-                self.cur.execute("insert into streets_reverse_geocoded \
-                                  (id, asset_id, route, administrative_area_level_2, country) \
-                                  values (%s, %s, %s, %s, %s)", (count, asset_id, street_name, city_name, country_name))
-            except:
-                print("I am unable to insert data")
+            geocodedWriter.write((count, asset_id, street_name, city_name, country_name))
 
-            self.conn.commit()  
+        geocodedWriter.close()
 
 
     def getAssetsList(self):
@@ -132,6 +150,7 @@ class GeoCoding:
         """
         
         count = 95909
+        geocodedWriter = self.getGeocodedWriter()
         for row in assets_list:
             count += 1            
             #if count > 4:
@@ -185,15 +204,42 @@ class GeoCoding:
 
             print(count, asset_id, street_name, city_name, country_name)  
 
-            try:
-                self.cur.execute("insert into streets_reverse_geocoded \
-                                  (id, asset_id, route, administrative_area_level_2, country) \
-                                  values (%s, %s, %s, %s, %s)", (count, asset_id, street_name, city_name, country_name))
-            except:
-                print("I am unable to insert data")
+            geocodedWriter.write((count, asset_id, street_name, city_name, country_name))
+
+        geocodedWriter.close()
+
+
+    def getNextGeocodedId(self):
+        """ the next id of the streets_reverse_geocoded table
 
-            self.conn.commit()        
+        """
+        try:
+            self.cur.execute("select coalesce(max(id), 0) from streets_reverse_geocoded")
+        except:
+            print("I am unable to get data")
+
+        return self.cur.fetchone()[0] + 1
+
+    def reverseGeocodingConcurrent(self, assets_list):
+        """ concurrent version of reverseGeocoding, each item is a tuple including asset_id, asset_latitude and asset_longitude
+            the near-identical coordinates are geocoded once and the results are kept in the local cache,
+            an interrupted run started again only requests the coordinates that are not in the cache yet
+
+        """
+        geocodeCache = GeocodeCache(self.geocode_cache_file)
+        try:
+            geocodingPipeline = GeocodingPipeline(self.client, geocodeCache, self.geocoding_threads, self.geocoding_rate)
+            results = geocodingPipeline.run(assets_list)
+        finally:
+            geocodeCache.close()
+
+        count = self.getNextGeocodedId() - 1
+        geocodedWriter = self.getGeocodedWriter()
+        for asset_id, street_name, city_name, country_name in results:
+            count += 1
+            geocodedWriter.write((count, asset_id, street_name, city_name, country_name))
 
+        geocodedWriter.close()
 
     def run(self):
         """ 
@@ -203,7 +249,8 @@ class GeoCoding:
 
         #assets_list = self.getAssetsList()
         assets_list = self.getRemainingAssetsList()
-        self.reverseGeocoding(assets_list)
+        #self.reverseGeocoding(assets_list)
+        self.reverseGeocodingConcurrent(assets_list)
         #self.load_existing_records()
 
         self.disconnect_db()
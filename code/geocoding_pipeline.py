@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class TokenBucket:
+    """ token bucket rate limiter shared by the geocoding threads
+        tokens are added at rate per second up to capacity, each request takes one token and waits when the bucket is empty
+
+    """
+
+    def __init__(self, rate, capacity=None):
+        """ initialize variables
+
+        """
+        #tokens added per second
+        self.rate = float(rate)
+        #max number of tokens, the size of a burst
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ take one token, wait until one is available
+
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class GeocodeCache:
+    """ persistent cache of the reverse geocoding results, keyed by the rounded coordinates
+        every result is appended to a json lines file as soon as it is received, the file is also the checkpoint of a run:
+        an interrupted run loaded again skips every coordinate geocoded before the interruption
+
+    """
+
+    def __init__(self, filename):
+        """ load the results of the previous runs
+
+        """
+        self.filename = filename
+        #coordinate key -> (street_name, city_name, country_name)
+        self.addresses = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(filename):
+            with open(filename) as cache_file:
+                for line in cache_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line of an interrupted run may be cut
+                        continue
+                    self.addresses[record['key']] = tuple(record['address'])
+        self.cache_file = open(filename, "a")
+
+    def get(self, key):
+        """ get the address of a coordinate key, None if it is not in the cache
+
+        """
+        return self.addresses.get(key)
+
+    def put(self, key, address):
+        """ add the address of a coordinate key and append it to the file
+
+        """
+        with self.lock:
+            self.addresses[key] = tuple(address)
+            self.cache_file.write(json.dumps({'key': key, 'address': list(address)}) + "\n")
+            self.cache_file.flush()
+
+    def close(self):
+        """ close the cache file
+
+        """
+        self.cache_file.close()
+
+
+class StubGeocoder:
+    """ local stand-in of the googlemaps client for testing the pipeline without the Google API
+        the response has the same structure as googlemaps.Client.reverse_geocode, the names are built from the coordinates
+
+    """
+
+    def __init__(self, delay_seconds=0.0):
+        """ initialize variables
+
+        """
+        #simulated latency of a request
+        self.delay_seconds = delay_seconds
+        #number of requests received
+        self.num_requests = 0
+        self.lock = threading.Lock()
+
+    def reverse_geocode(self, latlng):
+        with self.lock:
+            self.num_requests += 1
+        if self.delay_seconds > 0:
+            time.sleep(self.delay_seconds)
+        latitude, longitude = latlng
+        return [{'address_components': [
+            {'long_name': "street %.3f %.3f" % (latitude, longitude), 'types': ['route']},
+            {'long_name': "city %.1f %.1f" % (latitude, longitude), 'types': ['administrative_area_level_2', 'political']},
+            {'long_name': "country", 'types': ['country', 'political']}]}]
+
+
+class GeocodingPipeline:
+    """ reverse geocode a list of assets with a pool of threads
+          - the coordinates are rounded to precision decimals (5 decimals is about 1 meter), assets with the same rounded coordinates share one request
+          - the requests go through a token bucket, at most rate requests per second
+          - the results are kept in a GeocodeCache, the coordinates already in the cache are not requested again
+
+    """
+
+    def __init__(self, geocoder, cache, num_threads=8, rate=40, precision=5):
+        """ initialize variables
+
+            input args:
+              geocoder: object with a reverse_geocode((latitude, longitude)) method, like googlemaps.Client or StubGeocoder
+              cache: GeocodeCache
+              num_threads: number of concurrent requests
+              rate: max number of requests per second
+              precision: number of decimals of the rounded coordinates
+
+        """
+        self.geocoder = geocoder
+        self.cache = cache
+        self.num_threads = num_threads
+        self.tokenBucket = TokenBucket(rate)
+        self.precision = precision
+
+    def coordinate_key(self, latitude, longitude):
+        """ key of the rounded coordinates
+
+        """
+        return "%.*f,%.*f" % (self.precision, float(latitude), self.precision, float(longitude))
+
+    def parse_address(self, reverse_addr):
+        """ get (street_name, city_name, country_name) from a reverse geocoding response, None for the missing names
+
+        """
+        try:
+            #the returned address is not empty
+            address_component = reverse_addr[0]['address_components']
+            street_name = [obj['long_name'] for obj in address_component if obj['types'][0] == 'route'][0]
+            city_name = [obj['long_name'] for obj in address_component if obj['types'][0] == 'administrative_area_level_2'][0]
+            country_name = [obj['long_name'] for obj in address_component if obj['types'][0] == 'country'][0]
+        except IndexError as indErr:
+            print('IndexError occurred in geocoding, list may be empty: ', indErr)
+            return (None, None, None)
+        except KeyError as keyErr:
+            print('KeyError occurred in geocoding, object does not have the key: ', keyErr)
+            return (None, None, None)
+
+        return (street_name, city_name, country_name)
+
+    def geocode(self, key):
+        """ request the address of a coordinate key and cache it
+
+        """
+        latitude, longitude = [float(value) for value in key.split(',')]
+        self.tokenBucket.acquire()
+        address = self.parse_address(self.geocoder.reverse_geocode((latitude, longitude)))
+        self.cache.put(key, address)
+
+        return address
+
+    def run(self, assets_list):
+        """ reverse geocode the assets, each item is a tuple (asset_id, asset_latitude, asset_longitude)
+            return a list of (asset_id, street_name, city_name, country_name) in the order of assets_list,
+            the assets whose request failed are left out (they are requested again by the next run)
+
+        """
+        asset_keys = [self.coordinate_key(asset[1], asset[2]) for asset in assets_list]
+        missing_keys = sorted(set(key for key in asset_keys if self.cache.get(key) is None))
+        print("%d assets, %d distinct coordinates to geocode" % (len(assets_list), len(missing_keys)))
+
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            futures = dict((executor.submit(self.geocode, key), key) for key in missing_keys)
+            for future in as_completed(futures):
+                count += 1
+                try:
+                    address = future.result()
+                    print(count, futures[future], address)
+                except Exception as e:
+                    print("I am unable to geocode", futures[future])
+                    print(e)
+
+        results = []
+        for asset, key in zip(assets_list, asset_keys):
+            address = self.cache.get(key)
+            if address is not None:
+                results.append((asset[0], ) + tuple(address))
+
+        return results
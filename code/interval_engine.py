@@ -0,0 +1,203 @@
+import datetime
+from operator import itemgetter
+import numpy as np
+
+
+class IntervalEngine:
+    """ vectorized version of the daytime on-time / energy loop in energy_assets_in_batch.py
+        the meter readings of a batch of assets are loaded into numpy arrays (asset id, meter component id, epoch seconds, kwh)
+        and the interval deltas, wattage, threshold masks and per (asset, component, day) reductions are computed with array operations
+
+        the day windows are advanced in the same way as the per-row loop:
+          - the first window of an (asset, component) is the day after its first reading
+          - a window is closed by the first valid reading after its sunset, and the next window is the day after that reading
+
+    """
+
+    def __init__(self, sunrise_time_local, sunset_time_local, daytime_start_time_local, daytime_end_time_local, energy_threshold, nominal_wattage_ratio):
+        """ initialize variables, all the times are datetime.time() objects in local time
+
+        """
+        #seconds from the start of the day for each boundary of the day window
+        self.sunrise_seconds = self.seconds_of_day(sunrise_time_local)
+        self.sunset_seconds = self.seconds_of_day(sunset_time_local)
+        self.daytime_start_seconds = self.seconds_of_day(daytime_start_time_local)
+        self.daytime_end_seconds = self.seconds_of_day(daytime_end_time_local)
+        #wattage threshold above the nominal wattage ratio, in watts
+        self.energyThreshold = energy_threshold
+        #nominal wattage ratio
+        self.nominal_wattage_ratio = nominal_wattage_ratio
+
+        self.epoch = datetime.datetime(1970, 1, 1)
+        self.epoch_date = self.epoch.date()
+        self.secondsPerDay = 86400
+
+    def seconds_of_day(self, time_of_day):
+        """ convert a datetime.time() object to seconds from the start of the day
+
+        """
+        return time_of_day.hour * 3600 + time_of_day.minute * 60 + time_of_day.second + time_of_day.microsecond / 1000000.0
+
+    def load_rows(self, rows, local_time_hours_from_utc):
+        """ load the rows of the query (asset_id, meter_component_id, kwh, timestamp_utc) into numpy arrays
+            the rows must be ordered by asset_id, meter_component_id, timestamp_utc
+            timestamp_utc can be datetime objects or epoch seconds (extract(epoch from timestamp_utc) in the query, which is faster)
+            the returned timestamps are epoch seconds in local time
+
+        """
+        num_rows = len(rows)
+        if num_rows == 0:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64))
+
+        asset_id_array = np.fromiter(map(itemgetter(0), rows), dtype=np.int64, count=num_rows)
+        meter_component_id_array = np.fromiter(map(itemgetter(1), rows), dtype=np.int64, count=num_rows)
+        kwh_array = np.fromiter(map(itemgetter(2), rows), dtype=np.float64, count=num_rows)
+        if isinstance(rows[0][3], datetime.datetime):
+            epoch = self.epoch
+            epoch_array = np.fromiter(((row[3] - epoch).total_seconds() for row in rows), dtype=np.float64, count=num_rows)
+        else:
+            # the timestamps are already epoch seconds
+            epoch_array = np.fromiter(map(itemgetter(3), rows), dtype=np.float64, count=num_rows)
+        epoch_array += local_time_hours_from_utc.total_seconds()
+
+        return (asset_id_array, meter_component_id_array, epoch_array, kwh_array)
+
+    def to_datetime(self, epoch_seconds):
+        """ convert epoch seconds back to a datetime object
+
+        """
+        return self.epoch + datetime.timedelta(seconds=float(epoch_seconds))
+
+    def to_date(self, epoch_day):
+        """ convert epoch day number back to a date object
+
+        """
+        return self.epoch_date + datetime.timedelta(days=int(epoch_day))
+
+    def to_epoch_day(self, date):
+        """ convert a date object to epoch day number
+
+        """
+        return (date - self.epoch_date).days
+
+    def assign_windows(self, group_starts, group_ends, epoch_array, day_array, valid_start_day_array):
+        """ assign each reading to a day window
+            the windows are advanced by jumping with searchsorted, so the python loop runs once per window instead of once per reading
+
+            return (window_of_row, window_group, window_day)
+              window_of_row: the window index of each reading, -1 for readings before the valid start date
+              window_group:  the (asset, component) group index of each window
+              window_day:    the epoch day of each window
+
+        """
+        window_of_row = np.full(len(epoch_array), -1, dtype=np.int64)
+        window_group = []
+        window_day = []
+        group_start_list = group_starts.tolist()
+        group_end_list = group_ends.tolist()
+        valid_start_day_list = valid_start_day_array.tolist()
+        for group_index in range(len(group_start_list)):
+            group_start = group_start_list[group_index]
+            group_end = group_end_list[group_index]
+            # the first window is the day after the first reading of the group
+            current_day = int(day_array[group_start]) + 1
+            # the readings before the valid start date (commissioning date + N days) are skipped, they are a prefix of the group
+            pos = group_start + int(np.searchsorted(day_array[group_start:group_end], valid_start_day_list[group_index], side='left'))
+            while True:
+                window_index = len(window_day)
+                window_group.append(group_index)
+                window_day.append(current_day)
+                if pos >= group_end:
+                    break
+                # the first reading after sunset closes the window
+                sunset = current_day * self.secondsPerDay + self.sunset_seconds
+                trigger = pos + int(np.searchsorted(epoch_array[pos:group_end], sunset, side='right'))
+                window_of_row[pos:min(trigger + 1, group_end)] = window_index
+                if trigger >= group_end:
+                    break
+                current_day = int(day_array[trigger]) + 1
+                pos = trigger + 1
+
+        return (window_of_row, np.array(window_group, dtype=np.int64), np.array(window_day, dtype=np.int64))
+
+    def compute(self, asset_id_array, meter_component_id_array, epoch_array, kwh_array, nominal_wattage_dict, valid_start_date_dict, on_time_threshold=None):
+        """ compute the daytime on time and energy consumption for each (asset, component, day)
+
+            the nominal_wattage_dict and valid_start_date_dict are keyed by asset id
+            if on_time_threshold is given, only the days with totalOnTime > on_time_threshold are returned
+            return a list of tuples (asset_id, meter_component_id, date, totalOnTime, first_timestamp, last_timestamp, totalEnergyConsumed, totalWatts, numIntervals, numPositiveIntervals)
+              totalOnTime is in minutes, the same as the per-row loop
+
+        """
+        results = []
+        num_rows = len(epoch_array)
+        if num_rows == 0:
+            return results
+
+        day_array = np.floor(epoch_array / self.secondsPerDay).astype(np.int64)
+
+        # (asset, component) groups, the readings are ordered by asset_id, meter_component_id, timestamp_utc
+        group_change = np.flatnonzero((asset_id_array[1:] != asset_id_array[:-1]) | (meter_component_id_array[1:] != meter_component_id_array[:-1])) + 1
+        group_starts = np.concatenate(([0], group_change))
+        group_ends = np.concatenate((group_change, [num_rows]))
+        group_asset_ids = asset_id_array[group_starts]
+        group_component_ids = meter_component_id_array[group_starts]
+        group_nominal_wattage = np.array([nominal_wattage_dict[asset_id] for asset_id in group_asset_ids.tolist()], dtype=np.float64)
+        group_valid_start_day = np.array([self.to_epoch_day(valid_start_date_dict[asset_id]) for asset_id in group_asset_ids.tolist()], dtype=np.int64)
+
+        window_of_row, window_group, window_day = self.assign_windows(group_starts, group_ends, epoch_array, day_array, group_valid_start_day)
+        num_windows = len(window_day)
+
+        # per row window boundaries
+        in_window = window_of_row >= 0
+        row_window_day = np.where(in_window, window_day[window_of_row], 0) * self.secondsPerDay
+        after_sunrise = in_window & (epoch_array >= row_window_day + self.sunrise_seconds)
+        before_sunset = after_sunrise & (epoch_array <= row_window_day + self.sunset_seconds)
+        in_daytime = after_sunrise & (epoch_array >= row_window_day + self.daytime_start_seconds) & (epoch_array <= row_window_day + self.daytime_end_seconds)
+
+        # first timestamp after sunrise and last timestamp before sunset for each window
+        first_timestamp = np.full(num_windows, np.nan)
+        rows_after_sunrise = np.flatnonzero(after_sunrise)
+        windows, first_index = np.unique(window_of_row[rows_after_sunrise], return_index=True)
+        first_timestamp[windows] = epoch_array[rows_after_sunrise[first_index]]
+        last_timestamp = np.full(num_windows, np.nan)
+        rows_before_sunset = np.flatnonzero(before_sunset)[::-1]
+        windows, last_index = np.unique(window_of_row[rows_before_sunset], return_index=True)
+        last_timestamp[windows] = epoch_array[rows_before_sunset[last_index]]
+
+        # intervals between consecutive daytime readings of the same window
+        daytime_rows = np.flatnonzero(in_daytime)
+        interval_window = window_of_row[daytime_rows[1:]]
+        secondsInterval = epoch_array[daytime_rows[1:]] - epoch_array[daytime_rows[:-1]]
+        energyConsumed = kwh_array[daytime_rows[1:]] - kwh_array[daytime_rows[:-1]]
+        valid_interval = (interval_window == window_of_row[daytime_rows[:-1]]) & (secondsInterval != 0)
+        interval_window = interval_window[valid_interval]
+        secondsInterval = secondsInterval[valid_interval]
+        energyConsumed = energyConsumed[valid_interval]
+        consumptionRate = (energyConsumed * 1000) / (secondsInterval / 3600.0)
+        # the wattage in the interval is > 30% of nominal wattage and < 5 times of nominal wattage
+        interval_nominal_wattage = group_nominal_wattage[window_group[interval_window]]
+        positive_interval = (consumptionRate > interval_nominal_wattage * self.nominal_wattage_ratio + self.energyThreshold) & (consumptionRate < 5 * interval_nominal_wattage)
+
+        num_interval = np.bincount(interval_window, minlength=num_windows)
+        num_interval_positive = np.bincount(interval_window[positive_interval], minlength=num_windows)
+        totalOnTime = np.bincount(interval_window[positive_interval], weights=secondsInterval[positive_interval] / 60.0, minlength=num_windows)
+        totalEnergyConsumed = np.bincount(interval_window[positive_interval], weights=energyConsumed[positive_interval], minlength=num_windows)
+
+        if on_time_threshold is None:
+            output_windows = range(num_windows)
+        else:
+            output_windows = np.flatnonzero(totalOnTime > on_time_threshold).tolist()
+
+        for window_index in output_windows:
+            onTime = float(totalOnTime[window_index])
+            if onTime == 0:
+                totalWatts = 0
+            else:
+                totalWatts = (float(totalEnergyConsumed[window_index]) * 1000) / (onTime / 60.0)
+            group_index = window_group[window_index]
+            first_time_stamp_after_sunrise = None if np.isnan(first_timestamp[window_index]) else self.to_datetime(first_timestamp[window_index])
+            last_time_stamp_before_sunset = None if np.isnan(last_timestamp[window_index]) else self.to_datetime(last_timestamp[window_index])
+            results.append((int(group_asset_ids[group_index]), int(group_component_ids[group_index]), self.to_date(window_day[window_index]), onTime, first_time_stamp_after_sunrise, last_time_stamp_before_sunset, float(totalEnergyConsumed[window_index]), totalWatts, int(num_interval[window_index]), int(num_interval_positive[window_index])))
+
+        return results
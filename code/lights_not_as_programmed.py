@@ -4,7 +4,12 @@ import sys
 import datetime
 import csv
 from sunrise import sun
-from xml_parser import XML_Parser
+from suntime_table import SunTimeTable, SunTimeDict
+from db_stream import StreamingReader
+from calendar_cache import CalendarCache
+from parallel_runner import ParallelRunner
+from anomaly_episodes import EpisodeCoalescer
+from csv_sink import open_sink
 
 
 class LightsNotAsProgrammed:
@@ -82,7 +87,7 @@ class LightsNotAsProgrammed:
             self.pg_password = config_data['pg_password']
             self.pg_host = config_data['pg_host']
             self.pg_port = config_data['pg_port']
-            #output filename
+            #output filename, a .parquet file name writes a typed parquet file instead of a csv file (needs pyarrow)
             self.outputFilename = config_data['output_csvfile_name']
             #define energyThreshold: 2 watt
             self.energyThreshold = int(config_data['energy_threshold'])  
@@ -112,11 +117,37 @@ class LightsNotAsProgrammed:
             self.suntime_latitude = float(config_data['suntime_location_latitude'])
             #suntime location longitude
             self.suntime_longitude = float(config_data['suntime_location_longitude'])
+            #directory of the persisted sun time tables, empty means the table is only kept in memory
+            self.suntime_table_dir = config_data.get('suntime_table_dir', '')
 
             # hours from UTC time for the local time
             hours_from_utc = int(config_data['hours_from_utc'])
             # UTC time plus this time to get local time
             self.local_time_hours_from_utc = datetime.timedelta(hours=hours_from_utc)
+            # stream the meter readings through a server-side cursor, itersize rows per round trip, 0 means fetchall, optional
+            self.streaming_itersize = int(config_data.get('streaming_itersize', '0'))
+            # parsed calendar cache file (json), repeated runs skip the XML parsing of unchanged calendars, optional
+            self.calendar_cache_file = config_data.get('calendar_cache_file', '')
+            #number of worker processes, each one computes shards of the assets list with its own db connection, optional
+            self.num_workers = int(config_data.get('num_workers', '1'))
+            #merge consecutive flagged intervals with the same status into one episode record, 'false' writes one record per interval, optional
+            self.episode_mode = config_data.get('episode_mode', 'true').lower() == 'true'
+
+    def fetch_rows(self, query, params):
+        """ run a query and return its rows
+            in streaming mode the rows are read through a named (server-side) cursor and processed as they arrive
+
+        """
+        if self.streaming_itersize > 0:
+            streamingReader = StreamingReader(self.conn, self.streaming_itersize)
+            return streamingReader.iter_rows(query, params)
+
+        try:
+            self.cur.execute(query, params)
+        except:
+            print("I am unable to get data")
+
+        return self.cur.fetchall()
 
     def getAssetsList(self):
         """ get assets list from assets table, which are not deleted and installation_date and commissioning_date are not null
@@ -269,108 +300,34 @@ class LightsNotAsProgrammed:
                 endDate:   datetime.date() variable, the end of a time period 
         """    
         self.sun = sun(lat=latitude, long=longitude)
-        dateTime = datetime.datetime.combine(startDate, datetime.time(hour=8))
-        while dateTime.date() <= endDate:        
-            daytimeStart, daytimeEnd = self.computeDaytimeStartEnd(dateTime)
-            self.sunriseTimeDict[dateTime.date()] = daytimeStart
-            self.sunsetTimeDict[dateTime.date()] = daytimeEnd
-            dateTime += self.oneDayDelta   
+        #the dates outside [startDate, endDate] are computed on demand, the table is saved for the next runs
+        self.sunTimeTable = SunTimeTable(latitude, longitude, self.suntime_table_dir)
+        self.sunriseTimeDict = SunTimeDict(self.sunTimeTable, 'sunrise')
+        self.sunsetTimeDict = SunTimeDict(self.sunTimeTable, 'sunset')
+        self.sunriseTimeDict.fill(startDate, endDate)
+        self.sunsetTimeDict.fill(startDate, endDate)
+        self.sunTimeTable.save()
             
-    def get_xml_with_asset_id(self, asset_id):
-        """ get the last calendar revision XML for the input asset id
-
-        """
-        try:
-                self.cur.execute("select id \
-                                  from components \
-                                  where asset_id = %s and component_kind = 100", (asset_id,))
-        except:
-                print("I am unable to get data") 
-
-        row = self.cur.fetchone()
-        component_id = row[0]
-        #print(component_id)
-
-        try:
-                self.cur.execute("select dimming_calendar_id \
-                                  from communications_nodes \
-                                  where id = %s", (component_id,))
-        except:
-                print("I am unable to get data") 
-
-        row = self.cur.fetchone()
-        dimming_calendar_id = row[0]      
-        print(dimming_calendar_id)
-
-        return self.get_xml_with_calendar_id(dimming_calendar_id)            
-
-    def get_xml_with_calendar_id(self, calendar_id):
-        """ get the xml of a calendar according to the calendar id
-
+    def find_energy_consumption_not_as_programmed(self, asset_id, start_time, end_time):
         """
-        try:
-                self.cur.execute("select serialized_schedules \
-                                  from driver_calendar_revisions \
-                                  where core_calendar_id = %s \
-                                  order by created_on_utc desc", (calendar_id,))
-        except:
-                print("I am unable to get data")
-
-        rows = self.cur.fetchall()
-        if len(rows) == 0:
-            return None
-
-        calendar_xml = rows[0][0] 
-        #calendar_xml is of type str
-        #print(type(calendar_xml))
-        #print(calendar_xml) 
-        return calendar_xml   
-
-    def parse_calendar_xml(self, calendar_xml_str):
-        """ use the imported parser to parse the calendar XML
 
         """
-        #step 4:  parse the calendar xml 
-        xml_parser = XML_Parser()
-        # the calendars is a list of dict, which contains shapes for 7 days in a week starting from Sunday
-        # the useful fields in calendars include 'shape_sunrise_offset', 'shape_sunset_offset', 'item_minutes', 'item_percent'
-        # the time in 'item_minutes' is local time
-        calendars = xml_parser.parse_from_string(calendar_xml_str) 
-        return calendars
-        
-    def check_weekday_of_date(self, date):
-        """ check which weekday the input date belongs to, the input is a date object
-            Sunday is 0, Monday is 1, etc
-            the returned value is an integer from 0 to 6 corresponding to Sunday to Saturday
-
-        """
-        return date.isoweekday() % 7
-        
-    def get_calendar_item(self, calendar_item_list, minutes_from_calendar_date_start):
-        """ get the calendar item that the input time belongs
+        print("asset id: ", asset_id)
+        # the assets without calendar are skipped before querying their readings
+        if self.calendarCache.get_compiled_calendar(asset_id) is None:
+            return []
 
-            input args:
-              calendar_item_list: a list of shape items, each of which is a dictionary
-              minutes_from_calendar_date_start: the input time in the format of minutes from the start of the calendar date 
-                                                (for example: 720 represents 12pm noon time )
+        #there might be multiple lights in an assets, so need to order by asset_id and component_id
+        rows = self.fetch_rows("select b.asset_id , b.meter_component_id, a.kwh, a.timestamp_utc \
+                                from energy_metering_points b, energy_meter_readings a \
+                                where b.asset_id = %s and b.id = a.metering_point_id \
+                                and a.timestamp_utc >= %s and a.timestamp_utc < %s \
+                                order by b.asset_id, b.meter_component_id, a.timestamp_utc", (asset_id, start_time, end_time))
 
-        """
-        last_calendar_item = None 
-        for item in calendar_item_list:
-            if last_calendar_item is None:
-                last_calendar_item = item
-            else:
-                current_calendar_item = item
-                last_time_minutes = int(last_calendar_item['item_minutes'])
-                current_time_minutes = int(current_calendar_item['item_minutes'])
-                if minutes_from_calendar_date_start >= last_time_minutes and minutes_from_calendar_date_start < current_time_minutes:
-                    return last_calendar_item
-                last_calendar_item = current_calendar_item
+        return self.check_readings(asset_id, rows)
 
-        return last_calendar_item   
-
-    def find_energy_consumption_not_as_programmed(self, asset_id, start_time, end_time):
-        """
+    def check_readings(self, asset_id, rows):
+        """ check the readings (asset_id, meter_component_id, kwh, timestamp_utc) of an asset against its calendar
 
         """
         component_id = self.assets_component_id_dict[asset_id]
@@ -382,27 +339,16 @@ class LightsNotAsProgrammed:
         street_name = self.assets_street_name_dict[asset_id]
         nominal_wattage = self.assets_nominal_wattage_dict[asset_id]
 
-        print("asset id: ", asset_id)
-        # get calendars for this asset from XML
-        calendar_xml_str = self.get_xml_with_asset_id(asset_id)
-        if calendar_xml_str is None:
+        # get the compiled calendar (7 shapes, one for each day in a week, starting from Sunday) of this asset from the calendar cache
+        calendar = self.calendarCache.get_compiled_calendar(asset_id)
+        if calendar is None:
             return []
-        # calendars is a list of 7 dictionaries (shapes), each of which correponds to one day in a week, starting from Sunday
-        calendars = self.parse_calendar_xml(calendar_xml_str)
-
-        try:
-            #there might be multiple lights in an assets, so need to order by asset_id and component_id
-            self.cur.execute("select b.asset_id , b.meter_component_id, a.kwh, a.timestamp_utc \
-                              from energy_metering_points b, energy_meter_readings a \
-                              where b.asset_id = %s and b.id = a.metering_point_id \
-                              and a.timestamp_utc >= %s and a.timestamp_utc < %s \
-                              order by b.asset_id, b.meter_component_id, a.timestamp_utc", (asset_id, start_time, end_time))
-        except:
-            print("I am unable to get data")
-
-        rows = self.cur.fetchall()
 
         results = []
+        if self.episode_mode:
+            episodes = EpisodeCoalescer(results, (self.pg_dbname, asset_id, latitude, longitude, installation_date, commissioning_date, street_name, nominal_wattage))
+        else:
+            episodes = None
         
         lastTime = None
         lastEnergy = None
@@ -419,39 +365,18 @@ class LightsNotAsProgrammed:
                 currentEnergy = energy_reading
                 
                 currentDate = currentTime.date()
-                timePart = currentTime.time()
-
-                noontime = datetime.time(12, 0, 0)
-                if timePart < noontime:
-                    calendar_date = currentDate - self.oneDayDelta
-                else: 
-                    calendar_date = currentDate 
-
                 # get this day's sunrise and sunset time in local time
                 sunrise_time = self.sunriseTimeDict[currentDate] + self.local_time_hours_from_utc
                 sunset_time = self.sunsetTimeDict[currentDate] + self.local_time_hours_from_utc  
 
-                calendar_index = self.check_weekday_of_date(calendar_date)
-                calendar_shape_dict = calendars[calendar_index] 
-
-                shape_sunrise_offset = int(calendar_shape_dict['shape_sunrise_offset'])
-                shape_sunrise_offset_time = datetime.timedelta(minutes=shape_sunrise_offset)
-                shape_sunset_offset = int(calendar_shape_dict['shape_sunset_offset'])
-                shape_sunset_offset_time = datetime.timedelta(minutes=shape_sunset_offset)
-                # shape_items is a list of dictionary (each dict is an item ordered by time)
-                shape_items = calendar_shape_dict['items']
-
-                calendar_date_start_time = datetime.datetime.combine(calendar_date, datetime.time())
-                minutes_from_calendar_date_start = (currentTime - calendar_date_start_time).total_seconds() / 60
-
-                calendar_item = self.get_calendar_item(shape_items, minutes_from_calendar_date_start)  
+                # the calendar date is the previous day before 12pm noon, its weekday selects the shape
+                shape_sunrise_offset_time, shape_sunset_offset_time, calendar_percentage = calendar.lookup(currentTime)
                 
                 sunrise_time_with_buffer = sunrise_time + shape_sunrise_offset_time + self.sunriseTimeDelta
                 sunrise_time_lower_boundary = sunrise_time + shape_sunrise_offset_time - self.sunriseTimeDelta
                 # always add the offset, for Jakarta_utara, the sunset_offset for calendar 2 is -6, so we add this value to sunset time
                 sunset_time_with_buffer = sunset_time + shape_sunset_offset_time - self.sunsetTimeDelta
                 sunset_time_higher_boundary = sunset_time + shape_sunset_offset_time + self.sunsetTimeDelta
-                calendar_percentage = int(calendar_item['item_percent']) 
                 
                 # the status is an indicator ('normal', 'dayburner', 'night_outage', 'night_not_dimming')
                 status = 'normal'
@@ -470,32 +395,44 @@ class LightsNotAsProgrammed:
                     if consumptionRate > nominal_wattage * self.nominal_wattage_ratio + self.energyThreshold and consumptionRate < 5 * nominal_wattage:
                         # this is a dayburning interval
                         status = 'dayburner'
-                        results.append((self.pg_dbname, asset_id, latitude, longitude, installation_date, commissioning_date, street_name, nominal_wattage, lastTime, currentTime, 0, consumptionRate, status))
+                        record_percentage = 0
 
                 elif currentTime < sunrise_time_lower_boundary or currentTime > sunset_time_higher_boundary:
                     # this is the night time, check if the energy consumption following calendars
                     if consumptionRate < nominal_wattage * (calendar_percentage * 0.01 - 0.1):
                         # the actal wattage is below the (calendar percentage - 10%) * nominal_wattage, it is night time outage 
                         status = 'night_outage'
-                        results.append((self.pg_dbname, asset_id, latitude, longitude, installation_date, commissioning_date, street_name, nominal_wattage, lastTime, currentTime, calendar_percentage, consumptionRate, status))
+                        record_percentage = calendar_percentage
 
                     elif consumptionRate > nominal_wattage * (calendar_percentage * 0.01 + 0.1) and consumptionRate <= nominal_wattage * (1 + 0.1):
                         # the actual wattage is above the (calendar percentage + 10%) * nominal_wattage and below 110% * nominal_wattage, it is night not dimming
                         status = 'night_not_dimming'
-                        results.append((self.pg_dbname, asset_id, latitude, longitude, installation_date, commissioning_date, street_name, nominal_wattage, lastTime, currentTime, calendar_percentage, consumptionRate, status))
+                        record_percentage = calendar_percentage
 
                     elif consumptionRate > nominal_wattage * (1 + 0.1):
                         # the actual wattage is above 110% * nominal_wattage, it is actual wattage above nominal wattage
                         status = 'actual_above_nominal_wattage'   
-                        results.append((self.pg_dbname, asset_id, latitude, longitude, installation_date, commissioning_date, street_name, nominal_wattage, lastTime, currentTime, calendar_percentage, consumptionRate, status)) 
+                        record_percentage = calendar_percentage
+
+                if status != 'normal':
+                    if episodes is not None:
+                        episodes.add_interval(lastTime, currentTime, energyConsumed, record_percentage, status)
+                    else:
+                        results.append((self.pg_dbname, asset_id, latitude, longitude, installation_date, commissioning_date, street_name, nominal_wattage, lastTime, currentTime, record_percentage, consumptionRate, status))
+                elif episodes is not None:
+                    episodes.end_episode()
 
                 lastTime = currentTime
                 lastEnergy = currentEnergy         
 
+        if episodes is not None:
+            episodes.end_episode()
+
         return results                
         
-    def compute_results(self, assets_id_list):
+    def compute_results(self, assets_id_list, sink=None):
         """ do the main computing and detect lights energy consumption not as programmed
+            if a sink is given, the results of each asset are written to it and an empty list is returned
 
         """    
 
@@ -525,18 +462,29 @@ class LightsNotAsProgrammed:
         for asset_id in assets_id_list:
             count += 1
             print(count)
-            results += self.find_energy_consumption_not_as_programmed(asset_id, start_time, end_time)
+            asset_results = self.find_energy_consumption_not_as_programmed(asset_id, start_time, end_time)
+            if sink is not None:
+                sink.write_batch(asset_results)
+            else:
+                results += asset_results
 
         return results                              
 
+    def get_title_row(self):
+        """ title row of the output file
+
+        """
+        if self.episode_mode:
+            return ('region', 'asset_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'nominal_wattage', 'timestamp_start', 'timestamp_end', 'duration_seconds', 'energy_kwh', 'mean_wattage', 'calendar_percentage', 'error_type', 'num_intervals')
+        return ('region', 'asset_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'nominal_wattage', 'timestamp_start', 'timestamp_end', 'calendar_percentage', 'actual_wattage', 'error_type')
+
     def write_to_file(self, results):
         """ write results to output file
 
         """
         with open(self.outputFilename, "w") as csvFile:
             csvWriter = csv.writer(csvFile, delimiter=',')   
-            title_row = ('region', 'asset_id', 'latitude', 'longitude', 'installation_date', 'commissioning_date', 'street_name', 'nominal_wattage', 'timestamp_start', 'timestamp_end', 'calendar_percentage', 'actual_wattage', 'error_type')         
-            csvWriter.writerow(title_row)
+            csvWriter.writerow(self.get_title_row())
             for record in results:
                 csvWriter.writerow(record)        
 
@@ -548,15 +496,39 @@ class LightsNotAsProgrammed:
         self.get_config(self.configFilename)
         #step 2:  connect to db
         self.connect_db()
-        #step 3:  compute sunrise and sunset time 
-        self.computeSunTime(self.suntime_latitude, self.suntime_longitude, self.startDate, self.endDate)
-        #step 4:  get assets list
+        #step 3:  get assets list
         #assets = self.getAssetsList()
         #assets = [(3776, -6.118187, 106.894265, datetime.date(2016, 5, 27), datetime.date(2016, 6, 1))]
         #assets = [(3776, -6.118187, 106.894265), (13532, -6.102635, 106.932242)]
         assets_id_list = self.getAssetsList()
-        #step 5:  call computeResults method
+        #step 4:  call computeResults method
         #self.computeResults(assets)
+        # the results are written to the output file as soon as they are computed
+        with open_sink(self.outputFilename, self.get_title_row()) as sink:
+            if self.num_workers > 1:
+                # the on-disk caches are filled once here, the workers only read them
+                self.warm_caches()
+                # each worker prepares its own calendars, sun time, assets info and db connection
+                parallelRunner = ParallelRunner(LightsNotAsProgrammed, self.configFilename, self.num_workers, 'prepare_worker')
+                print("start computing")
+                parallelRunner.run(assets_id_list, 'compute_results', sink=sink)
+            else:
+                self.prepare_computing()
+                print("start computing")
+                self.compute_results(assets_id_list, sink)
+            print("finished computing") 
+
+        print("finished output to files")        
+
+    def prepare_computing(self):
+        """ load the calendars, sun time and assets information used by the computing
+
+        """
+        #load the calendars of all the assets
+        self.calendarCache = CalendarCache(self.cur, self.calendar_cache_file)
+        self.calendarCache.load()
+        #compute sunrise and sunset time 
+        self.computeSunTime(self.suntime_latitude, self.suntime_longitude, self.startDate, self.endDate)
         self.get_assets_info()
         print("got assets info")
         self.get_nominal_wattage()
@@ -564,12 +536,22 @@ class LightsNotAsProgrammed:
         self.get_components_id()
         print("got components id info")
 
-        print("start computing")
-        results = self.compute_results(assets_id_list)
-        print("finished computing") 
+    def warm_caches(self):
+        """ fill the on-disk calendar cache and sun time table before the workers start,
+            otherwise every worker parses the calendars and computes the sun time itself and they all write the same files
 
-        self.write_to_file(results)
-        print("finished output to files")        
+        """
+        if self.calendar_cache_file:
+            CalendarCache(self.cur, self.calendar_cache_file).load()
+        self.computeSunTime(self.suntime_latitude, self.suntime_longitude, self.startDate, self.endDate)
+
+    def prepare_worker(self):
+        """ prepare a worker process of the parallel runner: read the config, open its own db connection and load the assets information
+
+        """
+        self.get_config(self.configFilename)
+        self.connect_db()
+        self.prepare_computing()
 
 
 if __name__ == "__main__":
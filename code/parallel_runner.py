@@ -0,0 +1,141 @@
+import multiprocessing
+import traceback
+
+
+#script object of the current worker process, created once per worker by setup_worker
+worker_script = None
+#traceback of a failed setup of the current worker process, the later shards of the worker fail with it
+worker_setup_error = None
+
+
+def setup_worker(script_class, config_filename, prepare_method):
+    """ create the script object of a worker process and let it prepare itself (read the config, open its own db connection, ...)
+
+    """
+    global worker_script
+    worker_script = script_class(config_filename)
+    if prepare_method is not None:
+        getattr(worker_script, prepare_method)()
+
+
+def run_shard(task):
+    """ run the shard method of the worker script object on one shard, return (shard index, results, error)
+        the worker is set up with its first shard (not in the pool initializer: a failing initializer makes the pool respawn workers forever),
+        a setup or shard exception is returned as the formatted traceback in error, results is None then
+
+    """
+    global worker_setup_error
+    shard_index, shard_method, shard, setup_args = task
+    if worker_setup_error is not None:
+        return (shard_index, None, worker_setup_error)
+    if worker_script is None:
+        try:
+            setup_worker(*setup_args)
+        except Exception:
+            worker_setup_error = "worker setup failed:\n" + traceback.format_exc()
+            return (shard_index, None, worker_setup_error)
+
+    try:
+        return (shard_index, getattr(worker_script, shard_method)(shard), None)
+    except Exception:
+        return (shard_index, None, traceback.format_exc())
+
+
+class ParallelRunner:
+    """ run a script over shards of its asset list in a pool of worker processes
+        every worker builds its own script object from the config file and opens its own db connection,
+        then computes whole shards with the same method the script uses for a sequential batch
+
+        the shard results are merged in the order of the shards, so the merged list (and the csv written from it)
+        is the same as the one of a sequential run whatever the number of workers
+
+        the workers are started with the 'spawn' method: a forked worker would share the psycopg2 connection of the parent process
+
+    """
+
+    def __init__(self, script_class, config_filename, num_workers, prepare_method=None):
+        """ initialize variables
+
+            input args:
+              script_class: the script class, it is built in each worker with script_class(config_filename)
+              config_filename: the json config file of the script
+              num_workers: number of worker processes
+              prepare_method: name of the method called once in each worker after the script object is built, None if the constructor is enough
+
+        """
+        self.script_class = script_class
+        self.config_filename = config_filename
+        self.num_workers = num_workers
+        self.prepare_method = prepare_method
+
+    def split(self, items, shard_size=None):
+        """ split the items into contiguous shards
+            by default there are 4 shards per worker, so a slow shard does not keep the other workers idle at the end of the run
+
+        """
+        if shard_size is None:
+            shard_size = max(1, -(-len(items) // (self.num_workers * 4)))
+
+        shards = []
+        for start_index in range(0, len(items), shard_size):
+            shards.append(items[start_index:start_index + shard_size])
+
+        return shards
+
+    def run(self, items, shard_method, shard_size=None, sink=None):
+        """ compute shard_method(shard) for every shard of the items in the worker processes
+            shard_method must return a list, the lists are concatenated in the shard order
+
+        """
+        shards = self.split(items, shard_size)
+        return self.run_shards(shards, shard_method, sink)
+
+    def run_shards(self, shards, shard_method, sink=None):
+        """ compute shard_method(shard) for every given shard in the worker processes
+            the lists are concatenated in the order of the shards
+
+            if a sink (CsvSink) is given, the shard results are written to it as soon as all the shards before them are done,
+            and an empty list is returned
+
+        """
+        if len(shards) == 0:
+            return []
+
+        setup_args = (self.script_class, self.config_filename, self.prepare_method)
+        tasks = [(shard_index, shard_method, shard, setup_args) for shard_index, shard in enumerate(shards)]
+        shard_results = [None] * len(shards)
+        #index of the next shard to write to the sink
+        next_shard_index = 0
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(processes=min(self.num_workers, len(shards)))
+        try:
+            count = 0
+            # the shards finish in any order, they are put back in place by their index
+            for shard_index, results, error in pool.imap_unordered(run_shard, tasks):
+                if error is not None:
+                    # the first failed shard stops the run, the except clause terminates the pool
+                    raise RuntimeError("shard %d failed in a worker process:\n%s" % (shard_index, error))
+                count += 1
+                print("finished shard %d / %d" % (count, len(shards)))
+                shard_results[shard_index] = results
+                if sink is not None:
+                    # write the finished shards in order, a shard finished early waits for the ones before it
+                    while next_shard_index < len(shards) and shard_results[next_shard_index] is not None:
+                        sink.write_batch(shard_results[next_shard_index])
+                        shard_results[next_shard_index] = []
+                        next_shard_index += 1
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if sink is not None:
+            return []
+
+        merged_results = []
+        for results in shard_results:
+            merged_results += results
+
+        return merged_results
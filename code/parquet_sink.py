@@ -0,0 +1,108 @@
+import datetime
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow is only needed for the parquet output
+    pa = None
+    pq = None
+
+
+class ParquetSink:
+    """ write the results of a run to a parquet file, with the same interface as CsvSink
+        the records are buffered and written as row groups of row_group_size rows, the schema is declared from the column names
+        of the title row (not inferred from the values, a column that is all None in the first row group would get the null type):
+          - the text columns in dictionary_columns (region, street name, luminaire type, ...) are dictionary<string>
+          - the id columns (name ending with 'id') and the interval counts (name ending with 'intervals') are int64
+          - 'date' and the columns ending with '_date' are date32
+          - the columns with 'timestamp' in the name are timestamps without time zone, written as the scripts give them
+            (some scripts write local times, e.g. lights_not_as_programmed, so no time zone is assumed)
+          - the other columns are float64, the scripts mix 0 and float values in the same column
+
+        column_types gives the type of the columns that do not follow these names, e.g. {'timespan': pa.int64()}
+
+    """
+
+    def __init__(self, filename, title_row, dictionary_columns=('region', 'street_name', 'luminaire_type', 'error_type'), row_group_size=100000, column_types=None):
+        """ initialize variables and declare the schema, the file is created with the first row group
+
+        """
+        if pa is None:
+            raise ImportError("pyarrow is needed to write the parquet output %s" % filename)
+
+        self.filename = filename
+        self.title_row = list(title_row)
+        self.dictionary_columns = set(dictionary_columns)
+        self.row_group_size = row_group_size
+        #records not written yet
+        self.records = []
+        #number of records written
+        self.num_records = 0
+        column_types = column_types or {}
+        self.schema = pa.schema([(name, column_types.get(name, self.column_type(name))) for name in self.title_row])
+        self.writer = None
+
+    def column_type(self, name):
+        """ arrow type of a column from its name
+
+        """
+        if name in self.dictionary_columns:
+            return pa.dictionary(pa.int32(), pa.string())
+        if name.endswith('id') or name.lower().endswith('intervals'):
+            return pa.int64()
+        if name == 'date' or name.endswith('_date'):
+            return pa.date32()
+        if 'timestamp' in name:
+            return pa.timestamp('us')
+
+        return pa.float64()
+
+    def column_array(self, field, values):
+        """ build the arrow array of a column with the declared type of its field
+
+        """
+        if pa.types.is_floating(field.type):
+            values = [None if value is None else float(value) for value in values]
+        elif pa.types.is_date(field.type):
+            values = [value.date() if isinstance(value, datetime.datetime) else value for value in values]
+        elif pa.types.is_dictionary(field.type):
+            values = [None if value is None else str(value) for value in values]
+            return pa.array(values, type=pa.string()).dictionary_encode().cast(field.type)
+
+        return pa.array(values, type=field.type)
+
+    def write_row_group(self):
+        """ write the buffered records as a row group
+
+        """
+        columns = list(zip(*self.records)) if self.records else [[] for name in self.title_row]
+        arrays = [self.column_array(field, list(values)) for field, values in zip(self.schema, columns)]
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.filename, self.schema)
+        self.writer.write_table(table)
+        self.num_records += len(self.records)
+        self.records = []
+
+    def write_batch(self, records):
+        """ add a batch of records
+
+        """
+        self.records += records
+        if len(self.records) >= self.row_group_size:
+            self.write_row_group()
+
+    def close(self):
+        """ write the remaining records and close the file
+
+        """
+        if self.records or self.writer is None:
+            self.write_row_group()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
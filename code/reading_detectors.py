@@ -0,0 +1,334 @@
+import csv
+import datetime
+import itertools
+import json
+import sys
+import psycopg2
+from db_stream import StreamingReader
+from csv_sink import open_sink
+import energy_assets_in_batch
+import energy_first_last_timestamp
+import lights_not_as_programmed
+import watts
+
+
+class ReadingDetector:
+    """ base class of the detectors fed by FusedReadingScan
+        a detector wraps the script object of a report, the script reads its own config file and loads its own assets information,
+        the scan gives it the meter readings of each asset and the detector keeps the records of its report
+
+        subclasses set the script, the assets and the time range in prepare() and implement check_asset()
+
+    """
+
+    def __init__(self, configFilename):
+        """ initialize variables
+
+        """
+        #config file of the wrapped script
+        self.configFilename = configFilename
+        #the wrapped script object
+        self.script = None
+        #ids of the assets checked by the detector
+        self.asset_id_set = set()
+        #time range of the readings (timestamp_utc) checked by the detector
+        self.start_time = None
+        self.end_time = None
+        #whether a reading at end_time is in the range
+        self.include_end = False
+        #records of the report
+        self.results = []
+
+    def prepare(self):
+        """ build the script object, read its config and load the assets information
+
+        """
+        raise NotImplementedError
+
+    def accepts(self, asset_id):
+        """ check if the detector checks an asset
+
+        """
+        return asset_id in self.asset_id_set
+
+    def select_rows(self, rows):
+        """ keep the rows (asset_id, meter_component_id, kwh, timestamp_utc) within the time range of the detector
+
+        """
+        start_time = self.start_time
+        end_time = self.end_time
+        if self.include_end:
+            return [row for row in rows if start_time <= row[3] <= end_time]
+        return [row for row in rows if start_time <= row[3] < end_time]
+
+    def process_asset(self, asset_id, rows):
+        """ check the readings of one asset, rows are ordered by meter_component_id, timestamp_utc
+
+        """
+        self.results += self.check_asset(asset_id, self.select_rows(rows))
+
+    def check_asset(self, asset_id, rows):
+        """ compute the records of one asset from its readings within the time range
+
+        """
+        raise NotImplementedError
+
+    def finish(self):
+        """ write the records to the output file of the script, a parquet file if its name ends with .parquet
+
+        """
+        with open_sink(self.script.outputFilename, self.script.get_title_row()) as sink:
+            sink.write_batch(self.results)
+
+
+class DayburnerRatioDetector(ReadingDetector):
+    """ dayburner on-time report of energy_assets_in_batch.py
+
+    """
+
+    def prepare(self):
+        self.script = energy_assets_in_batch.EnergyConsumption(self.configFilename)
+        self.script.prepare_worker()
+        self.asset_id_set = set(self.script.getAssetsList())
+        self.start_time = datetime.datetime.combine(self.script.startDate, datetime.time(0, 0, 0))
+        self.end_time = datetime.datetime.combine(self.script.endDate, datetime.time(23, 59, 59))
+
+    def check_asset(self, asset_id, rows):
+        return self.script.compute_energy_consumption_rows(iter([rows]))
+
+
+class LightsNotAsProgrammedDetector(ReadingDetector):
+    """ dayburner / night outage / not dimming / above nominal wattage report of lights_not_as_programmed.py
+
+    """
+
+    def prepare(self):
+        self.script = lights_not_as_programmed.LightsNotAsProgrammed(self.configFilename)
+        self.script.prepare_worker()
+        self.asset_id_set = set(self.script.getAssetsList())
+        self.start_time = datetime.datetime.combine(self.script.startDate, datetime.time())
+        self.end_time = datetime.datetime.combine(self.script.endDate, datetime.time())
+
+    def check_asset(self, asset_id, rows):
+        return self.script.check_readings(asset_id, rows)
+
+
+class FirstLastTimestampDetector(ReadingDetector):
+    """ first / last timestamp report of energy_first_last_timestamp.py
+        this report reads the readings of all the meters of an asset in timestamp order
+
+    """
+
+    def prepare(self):
+        self.script = energy_first_last_timestamp.EnergyConsumption(self.configFilename)
+        self.script.get_config(self.script.configFilename)
+        self.script.connect_db()
+        self.script.get_assets_info()
+        self.script.get_nominal_wattage()
+        self.asset_id_set = set(self.script.assets_latitude_dict)
+        self.start_time = datetime.datetime.combine(self.script.startDate, datetime.time(0, 0, 0))
+        self.end_time = datetime.datetime.combine(self.script.endDate, datetime.time(23, 59, 59))
+        self.include_end = True
+
+    def check_asset(self, asset_id, rows):
+        rows = sorted(rows, key=lambda row: row[3])
+        return self.script.compute_energy_consumption_rows(iter([[(row[0], row[2], row[3]) for row in rows]]))
+
+
+class IntervalWattsDetector(ReadingDetector):
+    """ per interval wattage report of watts.py
+        this report reads the readings of all the meters of an asset in timestamp order
+
+    """
+
+    def __init__(self, configFilename, assets_id_list=None):
+        """ initialize variables
+            assets_id_list: the assets of the report, None for all the assets of the scan
+
+        """
+        ReadingDetector.__init__(self, configFilename)
+        self.assets_id_list = assets_id_list
+
+    def prepare(self):
+        self.script = watts.ComputeWatts(self.configFilename)
+        self.script.getConfig(self.script.configFilename)
+        if self.assets_id_list is not None:
+            self.asset_id_set = set(self.assets_id_list)
+        self.start_time = datetime.datetime.combine(self.script.startDate, datetime.time(hour=6))
+        self.end_time = datetime.datetime.combine(self.script.endDate, datetime.time(hour=23))
+        self.include_end = True
+
+    def accepts(self, asset_id):
+        return self.assets_id_list is None or asset_id in self.asset_id_set
+
+    def check_asset(self, asset_id, rows):
+        rows = sorted(rows, key=lambda row: row[3])
+        return self.script.computeWattsForRows(asset_id, [(row[0], row[2], row[3]) for row in rows])
+
+    def finish(self):
+        # the same output as ComputeWatts.computeResults, no title row
+        with open(self.script.outputFilename, "w") as csvFile:
+            csvWriter = csv.writer(csvFile, delimiter=',')
+            for record in self.results:
+                csvWriter.writerow(record)
+
+
+class FusedReadingScan:
+    """ read the meter readings once for any number of detectors
+        the readings of the union of the detectors' assets and time ranges are streamed in batches of assets,
+        the rows of each asset are given to every detector that checks the asset
+
+    """
+
+    def __init__(self, conn, detectors, batch_size=1000, itersize=50000):
+        """ initialize variables
+
+            input args:
+              conn: database connection used to stream the readings
+              detectors: list of prepared ReadingDetector objects
+              batch_size: number of assets per query
+              itersize: rows per round trip of the streaming cursor
+
+        """
+        self.conn = conn
+        self.detectors = detectors
+        self.batch_size = batch_size
+        self.itersize = itersize
+
+    def assets_id_list(self):
+        """ the assets checked by at least one detector, the detectors checking all the assets are not counted
+
+        """
+        asset_id_set = set()
+        for detector in self.detectors:
+            asset_id_set |= detector.asset_id_set
+
+        return sorted(asset_id_set)
+
+    def run(self, assets_id_list=None):
+        """ stream the readings and feed the detectors
+
+        """
+        if assets_id_list is None:
+            assets_id_list = self.assets_id_list()
+        start_time = min(detector.start_time for detector in self.detectors)
+        end_time = max(detector.end_time for detector in self.detectors)
+        streamingReader = StreamingReader(self.conn, self.itersize)
+
+        count = 0
+        for start_index in range(0, len(assets_id_list), self.batch_size):
+            count += 1
+            print(count)
+            rows = streamingReader.iter_rows("select b.asset_id , b.meter_component_id, a.kwh, a.timestamp_utc \
+                                              from energy_metering_points b, energy_meter_readings a \
+                                              where b.asset_id = any(%s) and b.id = a.metering_point_id \
+                                              and a.timestamp_utc >= %s and a.timestamp_utc <= %s \
+                                              order by b.asset_id, b.meter_component_id, a.timestamp_utc",
+                                             (assets_id_list[start_index:start_index + self.batch_size], start_time, end_time))
+            for asset_id, asset_rows in itertools.groupby(rows, key=lambda row: row[0]):
+                asset_rows = list(asset_rows)
+                for detector in self.detectors:
+                    if detector.accepts(asset_id):
+                        detector.process_asset(asset_id, asset_rows)
+
+        for detector in self.detectors:
+            detector.finish()
+
+
+class FusedDetectorRun:
+    """ run several reports with one scan of the meter readings:
+          python reading_detectors.py config.json
+        the config has the db connection and the config file of each report to run (an empty string skips the report):
+          dayburner_ratio_config, lights_not_as_programmed_config, first_last_timestamp_config, interval_watts_config
+        each report writes to the output file of its own config, all the configs must use the same database
+
+    """
+
+    def __init__(self, configJSONFilename):
+        """ initialize variables
+
+        """
+        #configuration file name
+        self.configFilename = configJSONFilename
+
+    def connect_db(self):
+        """ build connection to the database
+
+        """
+        #connect to the database
+        try:
+            print(self.pg_dbname)
+            self.conn = psycopg2.connect("dbname=%s user=%s password=%s host=%s port=%s" % (self.pg_dbname, self.pg_username, self.pg_password, self.pg_host, self.pg_port))
+            print("connected!")
+        except psycopg2.Error as e:
+            print("I am unable to connect to the database")
+            print(e)
+
+    def get_config(self, configFilename):
+        """ get configuration parameters
+
+        """
+        with open(configFilename) as config_file:
+            config_data = json.load(config_file)
+
+            self.pg_dbname = config_data['pg_dbname']
+            self.pg_username = config_data['pg_username']
+            self.pg_password = config_data['pg_password']
+            self.pg_host = config_data['pg_host']
+            self.pg_port = config_data['pg_port']
+            #config files of the reports
+            self.dayburner_ratio_config = config_data.get('dayburner_ratio_config', '')
+            self.lights_not_as_programmed_config = config_data.get('lights_not_as_programmed_config', '')
+            self.first_last_timestamp_config = config_data.get('first_last_timestamp_config', '')
+            self.interval_watts_config = config_data.get('interval_watts_config', '')
+            #comma separated asset ids of the watts report, empty means all the assets of the other reports
+            self.watts_asset_ids = config_data.get('watts_asset_ids', '')
+            #number of assets per query
+            self.scan_batch_size = int(config_data.get('scan_batch_size', '1000'))
+            #rows per round trip when streaming the readings
+            self.streaming_itersize = int(config_data.get('streaming_itersize', '50000'))
+
+    def get_detectors(self):
+        """ build the detectors of the reports in the config
+
+        """
+        detectors = []
+        if self.dayburner_ratio_config:
+            detectors.append(DayburnerRatioDetector(self.dayburner_ratio_config))
+        if self.lights_not_as_programmed_config:
+            detectors.append(LightsNotAsProgrammedDetector(self.lights_not_as_programmed_config))
+        if self.first_last_timestamp_config:
+            detectors.append(FirstLastTimestampDetector(self.first_last_timestamp_config))
+        if self.interval_watts_config:
+            if self.watts_asset_ids:
+                watts_assets_id_list = [int(asset_id) for asset_id in self.watts_asset_ids.split(',')]
+            else:
+                watts_assets_id_list = None
+            detectors.append(IntervalWattsDetector(self.interval_watts_config, watts_assets_id_list))
+
+        return detectors
+
+    def run(self):
+        """  call this method to run the program
+
+        """
+        self.get_config(self.configFilename)
+        self.connect_db()
+        detectors = self.get_detectors()
+        for detector in detectors:
+            detector.prepare()
+        print("prepared %d detectors" % len(detectors))
+
+        fusedReadingScan = FusedReadingScan(self.conn, detectors, self.scan_batch_size, self.streaming_itersize)
+        fusedReadingScan.run()
+        print("finished output to files")
+
+        self.conn.commit()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+
+    configJSONFilename = sys.argv[1]
+    fusedDetectorRun = FusedDetectorRun(configJSONFilename)
+    fusedDetectorRun.run()
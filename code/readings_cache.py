@@ -0,0 +1,356 @@
+import collections
+import datetime
+import json
+import os
+import sys
+import numpy as np
+import psycopg2
+from db_stream import StreamingReader
+
+
+class ReadingsCache:
+    """ local cache of the energy meter readings (asset_id, meter_component_id, timestamp_utc, kwh)
+        the readings are stored in compressed numpy files (one array per column), one file per region and month:
+          <cache_dir>/<region>/<YYYY-MM>.npz
+        the rows of a file are ordered by asset_id, meter_component_id, timestamp_utc and the timestamps are epoch seconds in UTC
+
+        each file keeps the high-water mark of its month (the latest timestamp already fetched), a sync only fetches the newer rows,
+        readings inserted later with an older timestamp than the high-water mark are not picked up (delete the month file to refetch it)
+
+        the loaded months are kept in memory (up to max_loaded_partitions), so the batches of assets of a run decompress each month once
+
+    """
+
+    def __init__(self, cache_dir, region, max_loaded_partitions=12):
+        """ initialize variables
+
+        """
+        #directory of the cache
+        self.cache_dir = cache_dir
+        #region (database name), each region has its own sub directory
+        self.region = region
+        #number of months kept in memory
+        self.max_loaded_partitions = max_loaded_partitions
+        #month -> dict of column arrays, least recently used first
+        self.loaded_partitions = collections.OrderedDict()
+
+        self.epoch = datetime.datetime(1970, 1, 1)
+        self.columns = ('asset_id', 'meter_component_id', 'timestamp_utc', 'kwh')
+
+    def months(self, start_date, end_date):
+        """ get the first day of each month from start_date to end_date (included)
+
+        """
+        months = []
+        month = datetime.date(start_date.year, start_date.month, 1)
+        while month <= end_date:
+            months.append(month)
+            month = self.next_month(month)
+
+        return months
+
+    def next_month(self, month):
+        """ get the first day of the next month
+
+        """
+        if month.month == 12:
+            return datetime.date(month.year + 1, 1, 1)
+        return datetime.date(month.year, month.month + 1, 1)
+
+    def partition_filename(self, month):
+        """ get the file of a month
+
+        """
+        return os.path.join(self.cache_dir, self.region, "%04d-%02d.npz" % (month.year, month.month))
+
+    def to_epoch(self, date_time):
+        """ convert a datetime object in UTC to epoch seconds
+
+        """
+        return (date_time - self.epoch).total_seconds()
+
+    def empty_partition(self):
+        """ get a partition without rows
+
+        """
+        return {'asset_id': np.empty(0, dtype=np.int64), 'meter_component_id': np.empty(0, dtype=np.int64),
+                'timestamp_utc': np.empty(0, dtype=np.float64), 'kwh': np.empty(0, dtype=np.float64)}
+
+    def read_partition_file(self, month):
+        """ read the file of a month, return (column arrays, high-water mark), (None, None) if the month is not in the cache
+            the high-water mark is None when the month has no row
+
+        """
+        filename = self.partition_filename(month)
+        if not os.path.exists(filename):
+            return (None, None)
+
+        with np.load(filename) as data:
+            partition = {}
+            for column in self.columns:
+                partition[column] = data[column]
+            high_water_mark = float(data['high_water_mark'])
+        if np.isnan(high_water_mark):
+            high_water_mark = None
+
+        return (partition, high_water_mark)
+
+    def write_partition_file(self, month, partition, high_water_mark):
+        """ write the file of a month, the rows must be ordered by asset_id, meter_component_id, timestamp_utc
+
+        """
+        filename = self.partition_filename(month)
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if high_water_mark is None:
+            high_water_mark = np.nan
+        # write to a temporary file first, so an interrupted sync never leaves a half written month
+        tmp_filename = filename + ".tmp.npz"
+        np.savez_compressed(tmp_filename, high_water_mark=np.float64(high_water_mark), **partition)
+        os.replace(tmp_filename, filename)
+
+    def sync_month(self, conn, month, itersize=50000):
+        """ fetch the readings of a month newer than its high-water mark and add them to the file of the month
+            return the number of new rows
+
+        """
+        partition, high_water_mark = self.read_partition_file(month)
+        if partition is None:
+            partition = self.empty_partition()
+
+        month_start = datetime.datetime.combine(month, datetime.time())
+        month_end = datetime.datetime.combine(self.next_month(month), datetime.time())
+        query = "select b.asset_id, b.meter_component_id, extract(epoch from a.timestamp_utc)::float8, a.kwh::float8 \
+                 from energy_metering_points b, energy_meter_readings a \
+                 where b.id = a.metering_point_id \
+                 and a.timestamp_utc >= %s and a.timestamp_utc < %s"
+        params = (month_start, month_end)
+        if high_water_mark is not None:
+            # only the rows newer than the high-water mark
+            query += " and a.timestamp_utc > %s"
+            params += (self.epoch + datetime.timedelta(seconds=high_water_mark), )
+
+        streamingReader = StreamingReader(conn, itersize)
+        new_columns = {'asset_id': [], 'meter_component_id': [], 'timestamp_utc': [], 'kwh': []}
+        for rows in streamingReader.iter_batches(query, params):
+            for index, column in enumerate(self.columns):
+                dtype = np.int64 if index < 2 else np.float64
+                new_columns[column].append(np.fromiter((row[index] for row in rows), dtype=dtype, count=len(rows)))
+
+        num_new_rows = sum(len(array) for array in new_columns['asset_id'])
+        if num_new_rows == 0 and os.path.exists(self.partition_filename(month)):
+            return 0
+
+        for column in self.columns:
+            partition[column] = np.concatenate([partition[column]] + new_columns[column])
+        order = np.lexsort((partition['timestamp_utc'], partition['meter_component_id'], partition['asset_id']))
+        for column in self.columns:
+            partition[column] = partition[column][order]
+        if len(partition['timestamp_utc']) > 0:
+            high_water_mark = float(partition['timestamp_utc'].max())
+
+        self.write_partition_file(month, partition, high_water_mark)
+        self.loaded_partitions.pop(month, None)
+
+        return num_new_rows
+
+    def sync(self, conn, start_date, end_date, itersize=50000):
+        """ sync every month from start_date to end_date
+
+        """
+        for month in self.months(start_date, end_date):
+            num_new_rows = self.sync_month(conn, month, itersize)
+            print("%04d-%02d: %d new rows" % (month.year, month.month, num_new_rows))
+
+    def get_partition(self, month):
+        """ get the column arrays of a month from memory or from its file, None if the month is not in the cache
+
+        """
+        if month in self.loaded_partitions:
+            self.loaded_partitions.move_to_end(month)
+            return self.loaded_partitions[month]
+
+        partition, high_water_mark = self.read_partition_file(month)
+        if partition is None:
+            return None
+        self.loaded_partitions[month] = partition
+        if len(self.loaded_partitions) > self.max_loaded_partitions:
+            self.loaded_partitions.popitem(last=False)
+
+        return partition
+
+    def read_arrays(self, assets_id_list, start_time, end_time):
+        """ read the readings of a list of assets with start_time <= timestamp_utc < end_time (datetime objects in UTC)
+            the months of the period must have been synced
+
+            return (asset_id_array, meter_component_id_array, epoch_array, kwh_array)
+              ordered by asset_id, meter_component_id, timestamp_utc, epoch_array is in UTC
+
+        """
+        assets_id_array = np.unique(np.asarray(list(assets_id_list), dtype=np.int64))
+        start_epoch = self.to_epoch(start_time)
+        end_epoch = self.to_epoch(end_time)
+
+        pieces = []
+        for month in self.months(start_time.date(), end_time.date()):
+            partition = self.get_partition(month)
+            if partition is None:
+                print("month %04d-%02d is not in the readings cache" % (month.year, month.month))
+                continue
+            # the rows of each asset are contiguous, take the row ranges of the requested assets
+            range_starts = np.searchsorted(partition['asset_id'], assets_id_array, side='left')
+            range_ends = np.searchsorted(partition['asset_id'], assets_id_array, side='right')
+            has_rows = range_ends > range_starts
+            if not has_rows.any():
+                continue
+            range_starts = range_starts[has_rows]
+            range_ends = range_ends[has_rows]
+            lengths = range_ends - range_starts
+            offsets = np.repeat(range_starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+            row_index = np.arange(lengths.sum()) + offsets
+            timestamps = partition['timestamp_utc'][row_index]
+            row_index = row_index[(timestamps >= start_epoch) & (timestamps < end_epoch)]
+            pieces.append(tuple(partition[column][row_index] for column in self.columns))
+
+        if len(pieces) == 0:
+            empty = self.empty_partition()
+            return tuple(empty[column] for column in self.columns)
+
+        asset_id_array, meter_component_id_array, epoch_array, kwh_array = [np.concatenate([piece[index] for piece in pieces]) for index in range(len(self.columns))]
+        # the months are read one after another, order the rows across months
+        order = np.lexsort((epoch_array, meter_component_id_array, asset_id_array))
+
+        return (asset_id_array[order], meter_component_id_array[order], epoch_array[order], kwh_array[order])
+
+    def read_reading_counts(self, assets_id_list, start_time, end_time):
+        """ count the readings of each asset with start_time <= timestamp_utc < end_time, without reading the rows
+            the months inside the period are counted from the row ranges of the assets, only the first and last months filter the timestamps
+
+            return a dict: asset id -> number of readings, the assets without reading are left out
+
+        """
+        assets_id_array = np.unique(np.asarray(list(assets_id_list), dtype=np.int64))
+        start_epoch = self.to_epoch(start_time)
+        end_epoch = self.to_epoch(end_time)
+        counts = np.zeros(len(assets_id_array), dtype=np.int64)
+
+        for month in self.months(start_time.date(), end_time.date()):
+            partition = self.get_partition(month)
+            if partition is None:
+                print("month %04d-%02d is not in the readings cache" % (month.year, month.month))
+                continue
+            range_starts = np.searchsorted(partition['asset_id'], assets_id_array, side='left')
+            range_ends = np.searchsorted(partition['asset_id'], assets_id_array, side='right')
+            month_start = datetime.datetime.combine(month, datetime.time())
+            month_end = datetime.datetime.combine(self.next_month(month), datetime.time())
+            if start_time <= month_start and month_end <= end_time:
+                counts += range_ends - range_starts
+                continue
+            # a month cut by the period, count the rows of each range inside the period
+            in_period = (partition['timestamp_utc'] >= start_epoch) & (partition['timestamp_utc'] < end_epoch)
+            cumulative = np.concatenate(([0], np.cumsum(in_period)))
+            counts += cumulative[range_ends] - cumulative[range_starts]
+
+        reading_count_dict = {}
+        for asset_id, count in zip(assets_id_array.tolist(), counts.tolist()):
+            if count > 0:
+                reading_count_dict[asset_id] = count
+
+        return reading_count_dict
+
+    def read_last_timestamps(self, assets_id_list, start_time, end_time):
+        """ get the latest reading time of each asset with start_time <= timestamp_utc < end_time
+            return a dict: asset id -> datetime object in UTC, the assets without reading are left out
+
+        """
+        asset_id_array, meter_component_id_array, epoch_array, kwh_array = self.read_arrays(assets_id_list, start_time, end_time)
+        last_timestamp_dict = {}
+        if len(asset_id_array) == 0:
+            return last_timestamp_dict
+
+        group_starts = np.concatenate(([0], np.flatnonzero(asset_id_array[1:] != asset_id_array[:-1]) + 1))
+        last_epochs = np.maximum.reduceat(epoch_array, group_starts)
+        for asset_id, seconds in zip(asset_id_array[group_starts].tolist(), last_epochs.tolist()):
+            last_timestamp_dict[asset_id] = self.epoch + datetime.timedelta(seconds=seconds)
+
+        return last_timestamp_dict
+
+    def read_rows(self, assets_id_list, start_time, end_time):
+        """ read the readings in the same format as the query rows (asset_id, meter_component_id, kwh, timestamp_utc)
+            ordered by asset_id, meter_component_id, timestamp_utc, timestamp_utc is a datetime object in UTC
+
+        """
+        asset_id_array, meter_component_id_array, epoch_array, kwh_array = self.read_arrays(assets_id_list, start_time, end_time)
+        epoch = self.epoch
+        timestamps = [epoch + datetime.timedelta(seconds=seconds) for seconds in epoch_array.tolist()]
+
+        return list(zip(asset_id_array.tolist(), meter_component_id_array.tolist(), kwh_array.tolist(), timestamps))
+
+
+class ReadingsCacheSync:
+    """ sync command of the readings cache:
+          python readings_cache.py config.json
+        fetches the new readings of every month of the config period (period_start_date to period_end_date)
+        into readings_cache_dir, the region is the database name
+
+    """
+
+    def __init__(self, configJSONFilename):
+        """ initialize variables
+
+        """
+        #configuration file name
+        self.configFilename = configJSONFilename
+
+    def connect_db(self):
+        """ build connection to the database
+
+        """
+        #connect to the database
+        try:
+            print(self.pg_dbname)
+            self.conn = psycopg2.connect("dbname=%s user=%s password=%s host=%s port=%s" % (self.pg_dbname, self.pg_username, self.pg_password, self.pg_host, self.pg_port))
+            print("connected!")
+        except psycopg2.Error as e:
+            print("I am unable to connect to the database")
+            print(e)
+
+    def get_config(self, configFilename):
+        """ get configuration parameters
+
+        """
+        with open(configFilename) as config_file:
+            config_data = json.load(config_file)
+
+            self.pg_dbname = config_data['pg_dbname']
+            self.pg_username = config_data['pg_username']
+            self.pg_password = config_data['pg_password']
+            self.pg_host = config_data['pg_host']
+            self.pg_port = config_data['pg_port']
+            #period start date
+            self.startDate = datetime.datetime.strptime(config_data['period_start_date'], '%m/%d/%Y').date()
+            #period end date
+            self.endDate = datetime.datetime.strptime(config_data['period_end_date'], '%m/%d/%Y').date()
+            #directory of the readings cache
+            self.readings_cache_dir = config_data['readings_cache_dir']
+            #rows per round trip when fetching the readings
+            self.streaming_itersize = int(config_data.get('streaming_itersize', '50000'))
+
+    def run(self):
+        """  call this method to run the program
+
+        """
+        self.get_config(self.configFilename)
+        self.connect_db()
+        readingsCache = ReadingsCache(self.readings_cache_dir, self.pg_dbname)
+        readingsCache.sync(self.conn, self.startDate, self.endDate, self.streaming_itersize)
+        self.conn.commit()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+
+    configJSONFilename = sys.argv[1]
+    readingsCacheSync = ReadingsCacheSync(configJSONFilename)
+    readingsCacheSync.run()
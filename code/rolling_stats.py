@@ -0,0 +1,127 @@
+import collections
+
+
+class RollingWindowStats:
+    """ mean and sample standard deviation of the last window_size values, updated in O(1) per value
+        the values are kept in a deque together with their running sum and sum of squares,
+        the sums are recomputed from the deque once every window_size updates so the floating point error does not build up
+
+        a window where all the values are equal has a standard deviation of exactly 0 (the same as statistics.stdev),
+        this is tracked with the length of the run of equal values at the end of the window
+
+    """
+
+    def __init__(self, window_size=30):
+        """ initialize variables
+
+        """
+        #number of values in a full window
+        self.window_size = window_size
+        #values in the window, oldest first
+        self.window = collections.deque()
+        #running sums of the values and of the squared values
+        self.total = 0.0
+        self.total_squares = 0.0
+        #number of equal values at the end of the window
+        self.equal_run = 0
+        #number of updates since the sums were recomputed
+        self.updates = 0
+
+    def is_full(self):
+        """ check if the window holds window_size values
+
+        """
+        return len(self.window) == self.window_size
+
+    def push(self, value):
+        """ add a value to the window, the oldest value is dropped when the window is full
+            the value is converted to float, the daily energy of the scripts is a Decimal (numeric kwh columns)
+
+        """
+        value = float(value)
+        if self.window and value == self.window[-1]:
+            self.equal_run += 1
+        else:
+            self.equal_run = 1
+
+        if len(self.window) == self.window_size:
+            oldest = self.window.popleft()
+            self.total -= oldest
+            self.total_squares -= oldest * oldest
+        self.window.append(value)
+        self.total += value
+        self.total_squares += value * value
+
+        self.updates += 1
+        if self.updates >= self.window_size:
+            self.total = float(sum(self.window))
+            self.total_squares = float(sum(v * v for v in self.window))
+            self.updates = 0
+
+    def mean(self):
+        """ mean of the values in the window
+
+        """
+        if self.equal_run >= len(self.window):
+            return self.window[-1]
+        return self.total / len(self.window)
+
+    def stdev(self):
+        """ sample standard deviation of the values in the window, at least 2 values are needed
+
+        """
+        count = len(self.window)
+        if self.equal_run >= count:
+            return 0.0
+        variance = (self.total_squares - self.total * self.total / count) / (count - 1)
+        if variance <= 0:
+            return 0.0
+        return variance ** 0.5
+
+
+class RollingDeviationDetector:
+    """ compare each daily energy consumption with the mean and standard deviation of the previous window_size days
+        a day is reported when it is more than num_std_threshold standard deviations and more than energy_deviation_threshold kWh above the mean
+        (when the standard deviation is 0, only the kWh threshold is used)
+
+    """
+
+    def __init__(self, window_size=30, num_std_threshold=1.5, energy_deviation_threshold=0.2):
+        """ initialize variables
+
+        """
+        #number of days in the rolling window
+        self.window_size = window_size
+        #number of standard deviations above the mean
+        self.num_std_threshold = num_std_threshold
+        #deviation from the mean in kWh
+        self.energy_deviation_threshold = energy_deviation_threshold
+
+    def new_window(self):
+        """ get an empty rolling window for a new asset
+
+        """
+        return RollingWindowStats(self.window_size)
+
+    def check(self, rolling_window, daily_energy):
+        """ check a daily energy consumption against the rolling window, then add it to the window
+
+            return None if the day is normal, otherwise (avg_energy_consumption, std_energy_consumption, num_std)
+              num_std is None when the standard deviation is 0
+
+        """
+        daily_energy = float(daily_energy)
+        result = None
+        if rolling_window.is_full():
+            avg_energy_consumption = rolling_window.mean()
+            std_energy_consumption = rolling_window.stdev()
+            if std_energy_consumption == 0:
+                if daily_energy - avg_energy_consumption > self.energy_deviation_threshold:
+                    result = (avg_energy_consumption, std_energy_consumption, None)
+            else:
+                num_std = (daily_energy - avg_energy_consumption) / std_energy_consumption
+                if num_std > self.num_std_threshold and daily_energy - avg_energy_consumption > self.energy_deviation_threshold:
+                    result = (avg_energy_consumption, std_energy_consumption, num_std)
+        rolling_window.push(daily_energy)
+
+        return result
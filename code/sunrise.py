@@ -121,6 +121,61 @@ class sun:
   self.sunrise_t  =self.solarnoon_t-hourangle*4/1440  
   self.sunset_t   =self.solarnoon_t+hourangle*4/1440  
   
+def sun_times(when,lat,long,timezone=0):
+ """
+ vectorized version of sun.sunrise, sun.sunset and sun.solarnoon,
+ computes the sun times for arrays of dates and coordinates in one call
+
+ when is a sequence of datetime.date / datetime.datetime objects or a numpy
+ datetime64 array, the time of day is used in the same way as the scalar
+ version (the scripts use 8:00). lat and long are scalars or arrays, they are
+ broadcast against when, e.g. when[:,None] with lat[None,:] gives a
+ dates x assets table. timezone is in hours, east is positive.
+
+ returns (sunrise, sunset, solarnoon) as float arrays of whole seconds from
+ the beginning of the day, the same value as h*3600+m*60+s of the scalar
+ version
+ """
+ import numpy as np
+
+ when=np.asarray(when)
+ if when.dtype==object:
+  when=when.astype('datetime64[us]')
+ when=when.astype('datetime64[us]')
+ days=when.astype('datetime64[D]')
+ # days since 1/1/1900 as in sun.__preptime, 719163 is date(1970,1,1).toordinal()
+ day=days.astype(np.int64)+719163-(734124-40529)
+ time=(when-days).astype(np.int64)/86400e6
+ longitude=np.asarray(long,dtype=np.float64)
+ latitude=np.asarray(lat,dtype=np.float64)
+
+ rad=np.radians
+ deg=np.degrees
+ Jday     =day+2415018.5+time-timezone/24.0 # Julian day
+ Jcent    =(Jday-2451545)/36525    # Julian century
+
+ Manom    = 357.52911+Jcent*(35999.05029-0.0001537*Jcent)
+ Mlong    = 280.46646+Jcent*(36000.76983+Jcent*0.0003032)%360
+ Eccent   = 0.016708634-Jcent*(0.000042037+0.0001537*Jcent)
+ Mobliq   = 23+(26+((21.448-Jcent*(46.815+Jcent*(0.00059-Jcent*0.001813))))/60)/60
+ obliq    = Mobliq+0.00256*np.cos(rad(125.04-1934.136*Jcent))
+ vary     = np.tan(rad(obliq/2))*np.tan(rad(obliq/2))
+ Seqcent  = np.sin(rad(Manom))*(1.914602-Jcent*(0.004817+0.000014*Jcent))+np.sin(rad(2*Manom))*(0.019993-0.000101*Jcent)+np.sin(rad(3*Manom))*0.000289
+ Struelong= Mlong+Seqcent
+ Sapplong = Struelong-0.00569-0.00478*np.sin(rad(125.04-1934.136*Jcent))
+ declination = deg(np.arcsin(np.sin(rad(obliq))*np.sin(rad(Sapplong))))
+
+ eqtime   = 4*deg(vary*np.sin(2*rad(Mlong))-2*Eccent*np.sin(rad(Manom))+4*Eccent*vary*np.sin(rad(Manom))*np.cos(2*rad(Mlong))-0.5*vary*vary*np.sin(4*rad(Mlong))-1.25*Eccent*Eccent*np.sin(2*rad(Manom)))
+
+ hourangle= deg(np.arccos(np.cos(rad(90.833))/(np.cos(rad(latitude))*np.cos(rad(declination)))-np.tan(rad(latitude))*np.tan(rad(declination))))
+
+ solarnoon_t=(720-4*longitude-eqtime+timezone*60)/1440
+ sunrise_t  =solarnoon_t-hourangle*4/1440
+ sunset_t   =solarnoon_t+hourangle*4/1440
+
+ # whole seconds, truncated towards zero like sun.__timefromdecimalday
+ return (np.trunc(sunrise_t*86400),np.trunc(sunset_t*86400),np.trunc(solarnoon_t*86400))
+
 if __name__ == "__main__":  
  s=sun(lat=52.37,long=4.90)  
  print(datetime.today())
@@ -0,0 +1,135 @@
+import collections
+import datetime
+import json
+import os
+import tempfile
+from sunrise import sun
+
+
+class SunTimeTable:
+    """ sunrise and sunset times (UTC) of one location, computed lazily for any date
+        the coordinates are rounded to precision decimals (4 decimals is about 11 meters, less than 0.1 second of sun time),
+        the table of a location is shared by all the scripts of a region
+
+        three layers, the first one that has the date answers:
+          - an in-process LRU of the (sunrise_datetime, sunset_datetime) tuples, at most max_cached_dates dates
+          - the table of the seconds from the beginning of the day, loaded from table_dir and saved by save()
+          - the sun computation at 8:00 of the date, like computeSunTime of the scripts
+
+        if table_dir is empty the table is only kept in memory
+
+    """
+
+    def __init__(self, latitude, longitude, table_dir='', precision=4, max_cached_dates=4096):
+        """ initialize variables and load the table saved by the previous runs
+
+        """
+        self.latitude = round(float(latitude), precision)
+        self.longitude = round(float(longitude), precision)
+        self.sun = sun(lat=self.latitude, long=self.longitude)
+        self.max_cached_dates = max_cached_dates
+        #date -> (sunrise_datetime, sunset_datetime)
+        self.lru = collections.OrderedDict()
+        #iso date -> [sunrise_seconds, sunset_seconds] from the beginning of the day
+        self.seconds_table = {}
+        #number of dates computed since the table was loaded or saved
+        self.num_computed = 0
+
+        self.filename = ''
+        if table_dir:
+            self.filename = os.path.join(table_dir, "suntime_%.*f_%.*f.json" % (precision, self.latitude, precision, self.longitude))
+            if os.path.exists(self.filename):
+                with open(self.filename) as table_file:
+                    self.seconds_table = json.load(table_file)
+
+    def compute_seconds(self, date):
+        """ compute the sunrise and sunset seconds from the beginning of the day
+
+        """
+        dateTime = datetime.datetime.combine(date, datetime.time(hour=8))
+        (h, m, s) = self.sun.sunrise(when=dateTime)
+        sunrise_seconds = h * 3600 + m * 60 + s
+        (h, m, s) = self.sun.sunset(when=dateTime)
+        sunset_seconds = h * 3600 + m * 60 + s
+
+        return [sunrise_seconds, sunset_seconds]
+
+    def get(self, date):
+        """ return a tuple (sunrise_datetime, sunset_datetime) of a datetime.date()
+
+        """
+        sun_times = self.lru.get(date)
+        if sun_times is not None:
+            self.lru.move_to_end(date)
+            return sun_times
+
+        key = date.isoformat()
+        seconds = self.seconds_table.get(key)
+        if seconds is None:
+            seconds = self.compute_seconds(date)
+            self.seconds_table[key] = seconds
+            self.num_computed += 1
+
+        dayStartTime = datetime.datetime.combine(date, datetime.time())
+        sun_times = (dayStartTime + datetime.timedelta(seconds=seconds[0]), dayStartTime + datetime.timedelta(seconds=seconds[1]))
+        self.lru[date] = sun_times
+        if len(self.lru) > self.max_cached_dates:
+            self.lru.popitem(last=False)
+
+        return sun_times
+
+    def save(self):
+        """ write the table to table_dir if dates were computed since it was loaded
+
+        """
+        if not self.filename or self.num_computed == 0:
+            return
+
+        table_dir = os.path.dirname(self.filename)
+        if table_dir and not os.path.exists(table_dir):
+            os.makedirs(table_dir)
+        # write a temporary file first so an interrupted run never leaves a cut table,
+        # with a unique name so processes saving the same table at the same time do not mix their files
+        fd, temp_filename = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(self.filename)))
+        try:
+            with os.fdopen(fd, "w") as table_file:
+                json.dump(self.seconds_table, table_file, sort_keys=True)
+            os.replace(temp_filename, self.filename)
+        except:
+            os.remove(temp_filename)
+            raise
+        self.num_computed = 0
+
+
+class SunTimeDict(dict):
+    """ drop-in replacement of the sunriseTimeDict / sunsetTimeDict of the scripts
+        a date that is not in the dictionary is looked up in the SunTimeTable instead of raising a KeyError,
+        so readings outside [startDate, endDate] get the sun time of their own date
+
+        kind is 'sunrise' or 'sunset', offset is a timedelta added to the sun time (e.g. the daytime buffer of energy.py)
+
+    """
+
+    def __init__(self, table, kind, offset=datetime.timedelta(0)):
+        dict.__init__(self)
+        self.table = table
+        self.index = 0 if kind == 'sunrise' else 1
+        self.offset = offset
+
+    def __missing__(self, date):
+        value = self.table.get(date)[self.index] + self.offset
+        self[date] = value
+        return value
+
+    def fill(self, startDate, endDate):
+        """ add every date between [startDate, endDate], for the scripts that iterate over the dates of the period
+
+        """
+        if isinstance(startDate, datetime.datetime):
+            startDate = startDate.date()
+        if isinstance(endDate, datetime.datetime):
+            endDate = endDate.date()
+        date = startDate
+        while date <= endDate:
+            self[date]
+            date += datetime.timedelta(days=1)
@@ -4,7 +4,11 @@ import sys
 import datetime
 import csv
 from sunrise import sun
-from xml_parser import XML_Parser
+from suntime_table import SunTimeTable, SunTimeDict
+from db_stream import StreamingReader
+from calendar_cache import CalendarCache
+from parallel_runner import ParallelRunner
+from asset_metadata import AssetMetadataLoader
 
 
 class SP_Calendar_Mismatch_Detector:
@@ -36,6 +40,9 @@ class SP_Calendar_Mismatch_Detector:
         self.connectDB()
         #step 3:  compute sunrise and sunset time 
         self.computeSunTime(self.suntime_latitude, self.suntime_longitude, self.startDate, self.endDate)
+        #step 4:  load the calendars of all the assets
+        self.calendarCache = CalendarCache(self.cur, self.calendar_cache_file, exclude_deleted_nodes=True)
+        self.calendarCache.load()
         
     def connectDB(self):
         """ build connection to the database
@@ -80,6 +87,8 @@ class SP_Calendar_Mismatch_Detector:
             self.suntime_latitude = float(config_data['suntime_location_latitude'])
             #suntime location longitude
             self.suntime_longitude = float(config_data['suntime_location_longitude'])
+            #directory of the persisted sun time tables, empty means the table is only kept in memory
+            self.suntime_table_dir = config_data.get('suntime_table_dir', '')
 
             # sunrise time offset
             sunrise_time_delta_hours = int(config_data['sunrise_time_delta_hours'])
@@ -97,73 +106,36 @@ class SP_Calendar_Mismatch_Detector:
             # hours from UTC time for the local time
             hours_from_utc = int(config_data['hours_from_utc'])
             self.local_time_hours_from_utc = datetime.timedelta(hours=hours_from_utc)
+            # stream the switching points through a server-side cursor, itersize rows per round trip, 0 means fetchall, optional
+            self.streaming_itersize = int(config_data.get('streaming_itersize', '0'))
+            # parsed calendar cache file (json), repeated runs skip the XML parsing of unchanged calendars, optional
+            self.calendar_cache_file = config_data.get('calendar_cache_file', '')
+            #number of worker processes, each one computes shards of the components list with its own db connection, optional
+            self.num_workers = int(config_data.get('num_workers', '1'))
 
-    def getComponentsList(self):
-        """ get assets list from assets table, which are not deleted and installation_date and commissioning_date are not null
+    def fetch_rows(self, query, params):
+        """ run a query and return its rows
+            in streaming mode the rows are read through a named (server-side) cursor and processed as they arrive
+
+        """
+        if self.streaming_itersize > 0:
+            streamingReader = StreamingReader(self.conn, self.streaming_itersize)
+            return streamingReader.iter_rows(query, params)
 
-        """                
         try:
-            self.cur.execute("select id, latitude, longitude, installation_date, commissioning_date \
-                              from assets \
-                              where is_deleted = 'f' \
-                              and installation_date is not null and commissioning_date is not null")
+            self.cur.execute(query, params)
         except:
             print("I am unable to get data")
 
-        rows = self.cur.fetchall()   
-        results = []
-        for row in rows:
-            asset_id = row[0]
-            latitude = row[1]
-            longitude = row[2]
-            installation_date = row[3]
-            commissioning_date = row[4]
-
-            try:
-                self.cur.execute("select id \
-                                  from components \
-                                  where asset_id = %s \
-                                  and is_deleted = 'f' and component_kind = 0", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            component_id_data = self.cur.fetchall() 
-            component_id = component_id_data[0][0] 
-
-            try:
-                self.cur.execute("select s.name as street_name \
-                                  from assets as a, streets as s \
-                                  where a.id = %s \
-                                  and a.street_id = s.id", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            street_name_data = self.cur.fetchall() 
-            street_name = street_name_data[0][0]
-
-            try:
-                self.cur.execute("select parent_id \
-                                  from components A,communications_nodes B \
-                                  where A.id=B.id and asset_id = %s", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            cabinet_id_data = self.cur.fetchall()     
-            cabinet_id = cabinet_id_data[0][0]
-
-            try:
-                self.cur.execute("select c.asset_id, lt.type_designation, lt.actual_wattage \
-                                  from luminaire_types lt, luminaires l, components c \
-                                  where c.asset_id = %s and c.id = l.id and l.luminaire_type_id = lt.id", (asset_id, ))
-            except:
-                print("I am unable to get data")
-
-            nominal_wattage_data = self.cur.fetchall()     
-            nominal_wattage = nominal_wattage_data[0][2]
-
-            results.append((asset_id, component_id, latitude, longitude, installation_date, commissioning_date, street_name, cabinet_id, nominal_wattage))
-
-        return results  
+        return self.cur.fetchall()
+
+    def getComponentsList(self):
+        """ get assets list from assets table, which are not deleted and installation_date and commissioning_date are not null
+            the component, street, cabinet and wattage are loaded for all assets at once by the shared AssetMetadataLoader
+
+        """
+        metadataLoader = AssetMetadataLoader(self.cur)
+        return metadataLoader.get_components_list()
 
     def get_component_info_for_one_asset(self, asset_id):
         """ get the information related to one asset
@@ -263,103 +235,13 @@ class SP_Calendar_Mismatch_Detector:
                 endDate:   datetime.date() variable, the end of a time period 
         """    
         self.sun = sun(lat=latitude, long=longitude)
-        dateTime = datetime.datetime.combine(startDate, datetime.time(hour=8))
-        while dateTime.date() <= endDate:        
-            daytimeStart, daytimeEnd = self.computeDaytimeStartEnd(dateTime)
-            self.sunriseTimeDict[dateTime.date()] = daytimeStart
-            self.sunsetTimeDict[dateTime.date()] = daytimeEnd
-            dateTime += self.oneDayDelta  
-
-    def get_xml_with_asset_id(self, asset_id):
-        """ get the last calendar revision XML for the input asset id
-
-        """
-        
-        try:
-                self.cur.execute("select id \
-                                  from components \
-                                  where asset_id = %s and is_deleted = 'f' and component_kind = 100", (asset_id,))
-        except:
-                print("I am unable to get data") 
-
-        rows = self.cur.fetchall()
-        component_id = rows[0][0]
-        print(component_id)
-
-        try:
-                self.cur.execute("select dimming_calendar_id \
-                                  from communications_nodes \
-                                  where id = %s", (component_id,))
-        except:
-                print("I am unable to get data") 
-
-        rows = self.cur.fetchall()
-        dimming_calendar_id = rows[0][0]        
-        print(dimming_calendar_id)
-
-        return self.get_xml_with_calendar_id(dimming_calendar_id)            
-
-    def get_xml_with_calendar_id(self, calendar_id):
-        """ get the xml of a calendar according to the calendar id
-
-        """
-        try:
-                self.cur.execute("select serialized_schedules \
-                                  from driver_calendar_revisions \
-                                  where core_calendar_id = %s \
-                                  order by created_on_utc desc", (calendar_id,))
-        except:
-                print("I am unable to get data")
-
-        rows = self.cur.fetchall()
-        calendar_xml = rows[0][0] 
-        #calendar_xml is of type str
-        #print(type(calendar_xml))
-        #print(calendar_xml) 
-        return calendar_xml   
-
-    def parse_calendar_xml(self, calendar_xml_str):
-        """ use the imported parser to parse the calendar XML
-
-        """
-        #step 4:  parse the calendar xml 
-        xml_parser = XML_Parser()
-        # the calendars is a list of dict, which contains shapes for 7 days in a week starting from Sunday
-        # the useful fields in calendars include 'shape_sunrise_offset', 'shape_sunset_offset', 'item_minutes', 'item_percent'
-        # the time in 'item_minutes' is local time
-        calendars = xml_parser.parse_from_string(calendar_xml_str) 
-        return calendars
-        
-    def check_weekday_of_date(self, date):
-        """ check which weekday the input date belongs to, the input is a date object
-            Sunday is 0, Monday is 1, etc
-            the returned value is an integer from 0 to 6 corresponding to Sunday to Saturday
-
-        """
-        return date.isoweekday() % 7
-
-    def get_calendar_item(self, calendar_item_list, minutes_from_calendar_date_start):
-        """ get the calendar item that the input time belongs
-
-            input args:
-              calendar_item_list: a list of shape items, each of which is a dictionary
-              minutes_from_calendar_date_start: the input time in the format of minutes from the start of the calendar date 
-                                                (for example: 720 represents 12pm noon time )
-
-        """
-        last_calendar_item = None 
-        for item in calendar_item_list:
-            if last_calendar_item is None:
-                last_calendar_item = item
-            else:
-                current_calendar_item = item
-                last_time_minutes = int(last_calendar_item['item_minutes'])
-                current_time_minutes = int(current_calendar_item['item_minutes'])
-                if minutes_from_calendar_date_start >= last_time_minutes and minutes_from_calendar_date_start < current_time_minutes:
-                    return last_calendar_item
-                last_calendar_item = current_calendar_item
-
-        return last_calendar_item                        
+        #the dates outside [startDate, endDate] are computed on demand, the table is saved for the next runs
+        self.sunTimeTable = SunTimeTable(latitude, longitude, self.suntime_table_dir)
+        self.sunriseTimeDict = SunTimeDict(self.sunTimeTable, 'sunrise')
+        self.sunsetTimeDict = SunTimeDict(self.sunTimeTable, 'sunset')
+        self.sunriseTimeDict.fill(startDate, endDate)
+        self.sunsetTimeDict.fill(startDate, endDate)
+        self.sunTimeTable.save()
 
     def find_SP_calendar_mismatch(self, asset_tuple, start_time, end_time):
         """ get the switching data for the input asset and check the mismatch compared with calendar and suntime
@@ -379,21 +261,16 @@ class SP_Calendar_Mismatch_Detector:
         cabinet_id = asset_tuple[7]
         nominal_wattage = asset_tuple[8]
 
-        # get calendars for this asset from XML
-        calendar_xml_str = self.get_xml_with_asset_id(asset_id)
-        # calendars is a list of 7 dictionaries (shapes), each of which correponds to one day in a week, starting from Sunday
-        calendars = self.parse_calendar_xml(calendar_xml_str)
-
-        try:
-            self.cur.execute("select timestamp_utc, log_value, is_log_value_off \
-                              from switching_points \
-                              where component_id = %s \
-                              and timestamp_utc >= %s and timestamp_utc < %s \
-                              order by timestamp_utc", (component_id, start_time, end_time))
-        except:
-            print("I am unable to get data")        
+        # get the compiled calendar (7 shapes, one for each day in a week, starting from Sunday) of this asset from the calendar cache
+        calendar = self.calendarCache.get_compiled_calendar(asset_id)
+        if calendar is None:
+            return []
 
-        rows = self.cur.fetchall()
+        rows = self.fetch_rows("select timestamp_utc, log_value, is_log_value_off \
+                                from switching_points \
+                                where component_id = %s \
+                                and timestamp_utc >= %s and timestamp_utc < %s \
+                                order by timestamp_utc", (component_id, start_time, end_time))
 
         results = []
         for row in rows:
@@ -405,32 +282,12 @@ class SP_Calendar_Mismatch_Detector:
             currentIsLogValueOff = row[2]
 
             currentDate = currentTime.date()
-            timePart = currentTime.time()
-
-            noontime = datetime.time(12, 0, 0)
-            if timePart < noontime:
-                calendar_date = currentDate - self.oneDayDelta
-            else: 
-                calendar_date = currentDate 
-
             # get this day's sunrise and sunset time in local time
             sunrise_time = self.sunriseTimeDict[currentDate] + self.local_time_hours_from_utc
             sunset_time = self.sunsetTimeDict[currentDate] + self.local_time_hours_from_utc  
 
-            calendar_index = self.check_weekday_of_date(calendar_date)
-            calendar_shape_dict = calendars[calendar_index] 
-
-            shape_sunrise_offset = int(calendar_shape_dict['shape_sunrise_offset'])
-            shape_sunrise_offset_time = datetime.timedelta(minutes=shape_sunrise_offset)
-            shape_sunset_offset = int(calendar_shape_dict['shape_sunset_offset'])
-            shape_sunset_offset_time = datetime.timedelta(minutes=shape_sunset_offset)
-            # shape_items is a list of dictionary (each dict is an item ordered by time)
-            shape_items = calendar_shape_dict['items']
-
-            calendar_date_start_time = datetime.datetime.combine(calendar_date, datetime.time())
-            minutes_from_calendar_date_start = (currentTime - calendar_date_start_time).total_seconds() / 60
-
-            calendar_item = self.get_calendar_item(shape_items, minutes_from_calendar_date_start)
+            # the calendar date is the previous day before 12pm noon, its weekday selects the shape
+            shape_sunrise_offset_time, shape_sunset_offset_time, calendar_percentage = calendar.lookup(currentTime)
 
             # check if the log value is valid, according to calendars and sun time
             recordInvalid = False
@@ -438,7 +295,6 @@ class SP_Calendar_Mismatch_Detector:
             sunrise_time_lower_boundary = sunrise_time + shape_sunrise_offset_time - self.sunriseTimeDelta
             # always add the offset, for Jakarta_utara, the sunset_offset for calendar 2 is -6, so we add this value to sunset time
             sunset_time_with_buffer = sunset_time + shape_sunset_offset_time - self.sunsetTimeDelta
-            calendar_percentage = int(calendar_item['item_percent'])
             if currentLogValue > 0:
                 # it is light on record
                 # need to match both sun time and calendar percent                 
@@ -512,7 +368,12 @@ class SP_Calendar_Mismatch_Detector:
         asset_id = 3776
         component_id_list = self.get_component_info_for_one_asset(asset_id)
         # call computeResults method
-        results = self.compute_results(component_id_list)
+        if self.num_workers > 1:
+            # the constructor of each worker reads the config, connects to db and loads the sun time and calendars
+            parallelRunner = ParallelRunner(SP_Calendar_Mismatch_Detector, self.configFilename, self.num_workers)
+            results = parallelRunner.run(component_id_list, 'compute_results')
+        else:
+            results = self.compute_results(component_id_list)
         # write to the output file
         self.write_to_file(results)
 
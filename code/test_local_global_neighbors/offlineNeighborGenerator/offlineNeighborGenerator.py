@@ -5,9 +5,65 @@ import sys
 import StringIO
 import traceback
 import json
+import numpy as np
+import os
+
+#the shared helpers are in the code directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from batch_writer import BatchWriter
 
 #in this class, I will generate streets, local neighbors and global neighbors in an offline fashion
 
+class SpatialGridIndex:
+    """ in-memory grid index of asset positions, the assets are put into cells of cell_size degrees of latitude and longitude
+        a rectangle query only looks at the cells overlapping the rectangle instead of all the assets
+
+    """
+
+    def __init__(self, latitudes, longitudes, cell_size):
+        #asset positions, the index of an asset is its position in these arrays
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        #cell size in degrees
+        self.cell_size = cell_size
+
+        #cell (row, col) -> array of asset indexes in the cell, in increasing order
+        self.cells = {}
+        cell_rows = np.floor(self.latitudes / cell_size).astype(np.int64)
+        cell_cols = np.floor(self.longitudes / cell_size).astype(np.int64)
+        order = np.lexsort((np.arange(len(cell_rows)), cell_cols, cell_rows))
+        if len(order) > 0:
+            sorted_rows = cell_rows[order]
+            sorted_cols = cell_cols[order]
+            cell_starts = np.concatenate(([0], np.flatnonzero((sorted_rows[1:] != sorted_rows[:-1]) | (sorted_cols[1:] != sorted_cols[:-1])) + 1))
+            cell_ends = np.concatenate((cell_starts[1:], [len(order)]))
+            for cell_start, cell_end in zip(cell_starts.tolist(), cell_ends.tolist()):
+                self.cells[(int(sorted_rows[cell_start]), int(sorted_cols[cell_start]))] = order[cell_start:cell_end]
+
+    def query_box(self, lat_low, lat_high, lon_low, lon_high):
+        #get the indexes (in increasing order) of the assets with lat_low <= latitude <= lat_high and lon_low <= longitude <= lon_high
+        row_low = int(math.floor(lat_low / self.cell_size))
+        row_high = int(math.floor(lat_high / self.cell_size))
+        col_low = int(math.floor(lon_low / self.cell_size))
+        col_high = int(math.floor(lon_high / self.cell_size))
+
+        pieces = []
+        for row in range(row_low, row_high + 1):
+            for col in range(col_low, col_high + 1):
+                cell = self.cells.get((row, col))
+                if cell is not None:
+                    pieces.append(cell)
+        if len(pieces) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        candidates = np.sort(np.concatenate(pieces))
+        candidate_latitudes = self.latitudes[candidates]
+        candidate_longitudes = self.longitudes[candidates]
+        in_box = (candidate_latitudes >= lat_low) & (candidate_latitudes <= lat_high) & (candidate_longitudes >= lon_low) & (candidate_longitudes <= lon_high)
+
+        return candidates[in_box]
+
+
 class OfflineNeighborGenerator:
 
     def __init__(self):
@@ -47,6 +103,10 @@ class OfflineNeighborGenerator:
             self.pg_password = config_data['pg_password']
             self.pg_host = config_data['pg_host']
             self.pg_port = config_data['pg_port']     
+            #number of neighbor rows written (and committed) in one batch
+            self.write_batch_size = int(config_data.get('write_batch_size', '1000'))
+            #'values' (multi-row insert) or 'copy' (COPY FROM STDIN)
+            self.write_method = config_data.get('write_method', 'values')
             
     
     """Distance helper function."""
@@ -86,7 +146,53 @@ class OfflineNeighborGenerator:
         d = self.EARTH_CIRCUMFERENCE * c
 
         return d
-            
+
+    #vectorized version of great_circle_distance
+    #compute the great circle distances from one point to arrays of points
+    #latlong_a is a tuple (latitude, longitude), latitudes and longitudes are numpy arrays
+    def great_circle_distance_array(self, latlong_a, latitudes, longitudes):
+        lat1, lon1 = latlong_a
+
+        dLat = np.radians(latitudes - lat1)
+        dLon = np.radians(longitudes - lon1)
+        a = (np.sin(dLat / 2) * np.sin(dLat / 2) +
+            math.cos(math.radians(lat1)) * np.cos(np.radians(latitudes)) *
+            np.sin(dLon / 2) * np.sin(dLon / 2))
+        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+        d = self.EARTH_CIRCUMFERENCE * c
+
+        return d
+
+    #find the closest neighbor and second closest neighbor among the candidate assets
+    #the candidates closer than 2 meters are skipped, they are too near each other, maybe they are just the same asset
+    #the returned value is a tuple (closest index, closest distance, second closest index, second closest distance), or None if there are less than 2 valid candidates
+    def findTwoClosestNeighbors(self, latlong, candidates, latitudes, longitudes, max_distance=None):
+        distances = self.great_circle_distance_array(latlong, latitudes[candidates], longitudes[candidates])
+        valid = distances >= 2
+        if max_distance is not None:
+            valid &= distances <= max_distance
+        valid_positions = np.flatnonzero(valid)
+        if len(valid_positions) < 2:
+            return None
+
+        #the stable sort keeps the first candidate when two distances are equal, the same as the scan in candidate order
+        nearest = valid_positions[np.argsort(distances[valid_positions], kind='mergesort')[:2]]
+
+        return (candidates[nearest[0]], float(distances[nearest[0]]), candidates[nearest[1]], float(distances[nearest[1]]))
+
+    def getAllAssetRows(self):
+        #get all valid assets (id, latitude, longitude, street_id) with one query
+        self.cur.execute("select id, latitude, longitude, street_id \
+                          from assets \
+                          where is_deleted = 'f' and installation_date is not null and commissioning_date is not null")
+
+        return self.cur.fetchall()
+
+    def getNeighborWriter(self, table_name):
+        #batched writer for the asset_neighbors or global_asset_neighbors table
+        return BatchWriter(self.conn, table_name,
+                           ['street_id', 'asset_id', 'latitude', 'longitude', 'first_neighbor_id', 'distance_to_first_neighbor', 'second_neighbor_id', 'distance_to_second_neighbor'],
+                           self.write_batch_size, self.write_method)
 
     def populateStreetsTable(self):
         #this method populates the streets table using assets_map_complete table
@@ -103,6 +209,8 @@ class OfflineNeighborGenerator:
             
     def generateStreetLocalNeighbors(self):
         #this method generates street local neighbors
+        #all assets are loaded once, the assets of each street are put in a grid index,
+        #only the assets within 1000 meters (max limit) are compared with the target asset
         
         #self.cur.execute("select street_id, street_name from streets")
         # skip the DEFAULT street
@@ -117,6 +225,19 @@ class OfflineNeighborGenerator:
         for row in street_rows:
             street_id_list.append(row[0])
             street_name_list.append(row[1])
+
+        #the neighbor rows are written in batches, one commit per batch
+        neighborWriter = self.getNeighborWriter('asset_neighbors')
+
+        #all assets rows of each street
+        street_asset_rows_dict = {}
+        for asset_row in self.getAllAssetRows():
+            street_asset_rows_dict.setdefault(asset_row[3], []).append(asset_row)
+
+        #the max limit of the neighbor distance in meters
+        max_neighbor_distance = 1000
+        #grid cell size in degrees, about the max limit distance
+        cell_size = math.degrees(max_neighbor_distance * 1.0 / self.EARTH_CIRCUMFERENCE)
               
         for street_index in range(num_streets):
             #process each street
@@ -126,16 +247,8 @@ class OfflineNeighborGenerator:
             street_id = street_id_list[street_index]
             street_name = street_name_list[street_index]
             
-            #get all assets record in this street from the 'assets_map_complete' table
-            #self.cur.execute("select id, latitude, longitude from assets_map_complete where is_deleted = 'f' and lower(street_name)=%s", (street_name,))
-
-            self.cur.execute("select id, latitude, longitude \
-                              from assets \
-                              where is_deleted = 'f' and installation_date is not null and commissioning_date is not null \
-                              and street_id = %s", (street_id,))
-
             #all assets rows in the street
-            asset_rows_in_one_street = self.cur.fetchall()
+            asset_rows_in_one_street = street_asset_rows_dict.get(street_id, [])
 
             num_assets_in_the_street = len(asset_rows_in_one_street)        
 
@@ -156,71 +269,46 @@ class OfflineNeighborGenerator:
                 asset_latitude_list.append(asset_row[1])
                 asset_longitude_list.append(asset_row[2])
 
+            asset_latitude_array = np.array(asset_latitude_list, dtype=np.float64)
+            asset_longitude_array = np.array(asset_longitude_list, dtype=np.float64)
+            street_index_grid = SpatialGridIndex(asset_latitude_array, asset_longitude_array, cell_size)
+
             #for each asset, compute the closest neighbor and second closest neighbor
             for target_asset_index in range(num_assets_in_the_street):
                 #target asset info
                 target_asset_id = asset_id_list[target_asset_index]
                 target_asset_latitude = asset_latitude_list[target_asset_index]
                 target_asset_longitude = asset_longitude_list[target_asset_index]
-                #the distance to closest neighbor and second closest neighbor
-                closest_neighbor_distance = sys.maxint
-                second_closest_neighbor_distance = sys.maxint
-
-                #compute the target asset distance to other assets in the street
-                for compare_asset_index in range(num_assets_in_the_street):
-                    if compare_asset_index == target_asset_index:
-                        continue
-                    compare_asset_id = asset_id_list[compare_asset_index]
-                    compare_asset_latitude = asset_latitude_list[compare_asset_index]
-                    compare_asset_longitude = asset_longitude_list[compare_asset_index]       
-
-                    #compute distance from target_asset to compare_asset
-                    target_lat_long = (target_asset_latitude, target_asset_longitude)
-                    compare_lat_long = (compare_asset_latitude, compare_asset_longitude)
-                    distance_in_meters = self.great_circle_distance(target_lat_long, compare_lat_long)
-
-                    #if the distance is smaller than 2 meters, then skip it, they are too near each other, maybe they are just the same asset
-                    if distance_in_meters < 2:
-                        continue
-
-                    if distance_in_meters < closest_neighbor_distance:
-                        #this distance is smaller than the closest neighbor distance
-                        if closest_neighbor_distance < sys.maxint:
-                            second_closest_neighbor_distance = closest_neighbor_distance
-                            second_closest_neighbor_id = closest_neighbor_id
-                        closest_neighbor_distance = distance_in_meters
-                        closest_neighbor_id = compare_asset_id
-                    elif distance_in_meters < second_closest_neighbor_distance:
-                        second_closest_neighbor_distance = distance_in_meters
-                        second_closest_neighbor_id = compare_asset_id
-
-                #if the closest distance or second closest distance is still sys.maxint, skip, don't insert into database
-                if closest_neighbor_distance == sys.maxint or second_closest_neighbor_distance == sys.maxint:
+                target_lat_long = (float(target_asset_latitude), float(target_asset_longitude))
+
+                #the assets in a rectangle a bit larger than the max limit distance, the other assets of the street are farther
+                (latRangeLow, latRangeHigh) = self.same_long_get_lat(target_lat_long, max_neighbor_distance * 1.01)
+                (lonRangeLow, lonRangeHigh) = self.same_lat_get_long(target_lat_long, max_neighbor_distance * 1.01)
+                candidates = street_index_grid.query_box(latRangeLow, latRangeHigh, lonRangeLow, lonRangeHigh)
+                candidates = candidates[candidates != target_asset_index]
+
+                #if there are less than 2 neighbors within 1000 meters (max limit), skip, don't insert into database
+                neighbors = self.findTwoClosestNeighbors(target_lat_long, candidates, asset_latitude_array, asset_longitude_array, max_neighbor_distance)
+                if neighbors is None:
                     print "invalid distance occurs, skip the record, don't insert into the asset_neighbors table"
                     continue
 
-                #if the closest distance or second closest distance is greater than 1000 meters (max limit), skip, don't insert into database
-                if closest_neighbor_distance > 1000 or second_closest_neighbor_distance > 1000:
-                    print "invalid distance occurs, skip the record, don't insert into the asset_neighbors table"
-                    continue    
+                (closest_neighbor_index, closest_neighbor_distance, second_closest_neighbor_index, second_closest_neighbor_distance) = neighbors
+                closest_neighbor_id = asset_id_list[closest_neighbor_index]
+                second_closest_neighbor_id = asset_id_list[second_closest_neighbor_index]
         
                 #already get the closest neighbor and second closest neighbor 
                 #store the two neighbors into the database table 'asset_neighbors', attributes include: 
                 #street_id, target_asset_id, target_asset_latitude, target_asset_longitude, closest_neighbor_id, closest_neighbor_distance, second_closest_neighbor_id, second_closest_neighbor_distance
 
-                #clear asset_neighbors table
-                try:               
-                    #insert neighbors of the target asset into asset_neighbors table
-                    self.cur.execute("insert into asset_neighbors(street_id, asset_id, latitude, longitude, first_neighbor_id, distance_to_first_neighbor, second_neighbor_id, distance_to_second_neighbor) values (%s, %s, %s, %s, %s, %s, %s, %s)", 
-                                    (street_id, target_asset_id, target_asset_latitude, target_asset_longitude, closest_neighbor_id, closest_neighbor_distance, second_closest_neighbor_id, second_closest_neighbor_distance))
-                except:
-                    print "I am unable to insert into asset_neighbors table for street %d, asset %d." % (street_id, target_asset_id)
+                #insert neighbors of the target asset into asset_neighbors table
+                neighborWriter.write((street_id, target_asset_id, target_asset_latitude, target_asset_longitude, closest_neighbor_id, closest_neighbor_distance, second_closest_neighbor_id, second_closest_neighbor_distance))
 
             #*********** finished generating neighbors for assets in the street *********
 
-            #final commit:
-            #commit the update for the asset record in the street into the database
-            self.conn.commit()
+        #final commit:
+        #write the remaining neighbor rows into the database
+        neighborWriter.close()
     
     #compute the longitude of points with the same latitude and distance away from the input point 
     #latlong_a is a tuple, representing the latitude and longitude of the input point   
@@ -292,18 +380,28 @@ class OfflineNeighborGenerator:
         return asset_rows_in_neighborhood_region
                    
     
+    def getAssetIndexesInRegion(self, grid_index, latlong, radius):
+        #grid_index: the SpatialGridIndex of all assets
+        #latlong: this is a tuple, like (lat, long)
+        #radius:  this is the radius for the rectangle region
+        #the same rectangle region as getAssetRowsInRegion, the returned value is an array of asset indexes in the grid index
+
+        #compute the lat range for the neighborhood region
+        (latRangeLow, latRangeHigh) = self.same_long_get_lat(latlong, radius)
+        #compute the long range for the neighborhood region
+        (lonRangeLow, lonRangeHigh) = self.same_lat_get_long(latlong, radius)
+
+        return grid_index.query_box(latRangeLow, latRangeHigh, lonRangeLow, lonRangeHigh)
+
     def generateGlobalNeighbors(self):
         #this method generates global neighbors
+        #all assets are loaded once into a grid index, the neighborhood region of each asset is a rectangle query on the index
+        #instead of a query on the database
         
         #self.cur.execute("select id, latitude, longitude, street_id from assets_map_complete as a, streets as s where a.is_deleted = 'f' and lower(a.street_name) = s.street_name")
         
-        # get all valid assets and their street id, skip street 1, which is DEFAULT street
-        self.cur.execute("select id, latitude, longitude, street_id \
-                          from assets \
-                          where is_deleted = 'f' and installation_date is not null and commissioning_date is not null \
-                          and street_id <> 1")
-        
-        all_asset_rows = self.cur.fetchall()
+        # get all valid assets and their street id, the neighbors may be on any street
+        all_asset_rows = self.getAllAssetRows()
         
         num_assets = len(all_asset_rows)
         
@@ -316,113 +414,83 @@ class OfflineNeighborGenerator:
             all_asset_latitude_list.append(row[1])
             all_asset_longitude_list.append(row[2])
             all_asset_street_id_list.append(row[3])
+
+        all_asset_latitude_array = np.array(all_asset_latitude_list, dtype=np.float64)
+        all_asset_longitude_array = np.array(all_asset_longitude_list, dtype=np.float64)
+        #grid cell size in degrees, about the size of the neighborhood region
+        cell_size = math.degrees(2 * self.radius * 1.0 / self.EARTH_CIRCUMFERENCE)
+        all_asset_index_grid = SpatialGridIndex(all_asset_latitude_array, all_asset_longitude_array, cell_size)
+
+        #the neighbor rows are written in batches, one commit per batch
+        neighborWriter = self.getNeighborWriter('global_asset_neighbors')
         
         #generate global neighbor for each asset
         for asset_index in range(num_assets):
+
+            #the street_id for the asset
+            street_id = all_asset_street_id_list[asset_index]
+
+            # skip street 1, which is DEFAULT street
+            if street_id == 1:
+                continue
                 
             print "process asset ", asset_index
             
             #the input asset id
             asset_id = all_asset_id_list[asset_index]
-            
-            #the street_id for the asset
-            street_id = all_asset_street_id_list[asset_index]
     
             #get the lat, long for the input asset
             latitude = all_asset_latitude_list[asset_index]
             longitude = all_asset_longitude_list[asset_index]
     
             #construct the lat, long tuple 
-            latlong = (latitude, longitude)
+            latlong = (float(latitude), float(longitude))
     
-            #get all assets rows in the neighborhood region                                
-            asset_rows_in_neighborhood_region = self.getAssetRowsInRegion(latlong, self.radius)
+            #get all assets in the neighborhood region                                
+            candidates = self.getAssetIndexesInRegion(all_asset_index_grid, latlong, self.radius)
 
-            num_assets_in_neighborhood_region = len(asset_rows_in_neighborhood_region)        
+            num_assets_in_neighborhood_region = len(candidates)        
 
             #if the number of assets in the neighborhood region is less than 3, we will try a larger region
             if num_assets_in_neighborhood_region < 3:
                                     
-                #get all assets rows in a larger neighborhood region                                
-                asset_rows_in_neighborhood_region = self.getAssetRowsInRegion(latlong, 2*self.radius)
+                #get all assets in a larger neighborhood region                                
+                candidates = self.getAssetIndexesInRegion(all_asset_index_grid, latlong, 2*self.radius)
 
-                num_assets_in_neighborhood_region = len(asset_rows_in_neighborhood_region)        
+                num_assets_in_neighborhood_region = len(candidates)        
             
             #if the number of assets in the larger neighborhood region is still less than 3, we will skip global neighbor update
             if num_assets_in_neighborhood_region < 3:
                 continue                        
                 #return
             
-            #within the neighborhood, find the two closest neighbors for the asset
-            
-            asset_id_list = []
-            asset_latitude_list = []
-            asset_longitude_list = []
-
-            #get all asset id, latitude, longitude in one street
-            for asset_row in asset_rows_in_neighborhood_region:
-                asset_id_list.append(asset_row[0])
-                asset_latitude_list.append(asset_row[1])
-                asset_longitude_list.append(asset_row[2])
+            #within the neighborhood, find the two closest neighbors for the asset, the target asset itself is not a neighbor
+            candidates = candidates[candidates != asset_index]
+            neighbors = self.findTwoClosestNeighbors(latlong, candidates, all_asset_latitude_array, all_asset_longitude_array)
     
             #set the target asset as the input asset
             target_asset_id = asset_id
             target_asset_latitude = latitude
             target_asset_longitude = longitude
-            #the distance to closest neighbor and second closest neighbor
-            closest_neighbor_distance = sys.maxint
-            second_closest_neighbor_distance = sys.maxint
-            
-            #compute the target asset distance to other assets in the street
-            for compare_asset_index in range(num_assets_in_neighborhood_region):
-                compare_asset_id = asset_id_list[compare_asset_index]
-                compare_asset_latitude = asset_latitude_list[compare_asset_index]
-                compare_asset_longitude = asset_longitude_list[compare_asset_index]       
-        
-                if compare_asset_id == target_asset_id:
-                    #this is the target asset 
-                    continue
-        
-                #compute distance from target_asset to compare_asset
-                target_lat_long = (target_asset_latitude, target_asset_longitude)
-                compare_lat_long = (compare_asset_latitude, compare_asset_longitude)
-                distance_in_meters = self.great_circle_distance(target_lat_long, compare_lat_long)
-
-                #if the distance is smaller than 2 meters, then skip it, they are too near each other, maybe they are just the same asset
-                if distance_in_meters < 2:
-                    continue
-        
-                #check if can update the target asset's closest and second closest neighbor        
-                if distance_in_meters < closest_neighbor_distance:
-                    #this distance is smaller than the closest neighbor distance
-                    if closest_neighbor_distance < sys.maxint:
-                            second_closest_neighbor_distance = closest_neighbor_distance
-                            second_closest_neighbor_id = closest_neighbor_id
-                    closest_neighbor_distance = distance_in_meters
-                    closest_neighbor_id = compare_asset_id
-                elif distance_in_meters < second_closest_neighbor_distance:
-                    second_closest_neighbor_distance = distance_in_meters
-                    second_closest_neighbor_id = compare_asset_id
                                               
-            #if the closest distance or second closest distance is still sys.maxint, skip, don't insert into database
-            if closest_neighbor_distance == sys.maxint or second_closest_neighbor_distance == sys.maxint:
+            #if there are less than 2 neighbors, skip, don't insert into database
+            if neighbors is None:
                 print "invalid distance occurs in addGlobalNeighbor, skip the record, don't insert into the global_asset_neighbors table"
                 continue
+
+            (closest_neighbor_index, closest_neighbor_distance, second_closest_neighbor_index, second_closest_neighbor_distance) = neighbors
+            closest_neighbor_id = all_asset_id_list[closest_neighbor_index]
+            second_closest_neighbor_id = all_asset_id_list[second_closest_neighbor_index]
     
             #already get the closest neighbor and second closest neighbor 
             #store the two neighbors into the database table 'global_asset_neighbors', attributes include: 
             #street_id, target_asset_id, target_asset_latitude, target_asset_longitude, closest_neighbor_id, closest_neighbor_distance, second_closest_neighbor_id, second_closest_neighbor_distance
 
-            #insert into global_asset_neighbors table
-            try:               
-                #insert neighbors of the target asset into global_asset_neighbors table
-                self.cur.execute("insert into global_asset_neighbors(street_id, asset_id, latitude, longitude, first_neighbor_id, distance_to_first_neighbor, second_neighbor_id, distance_to_second_neighbor) values (%s, %s, %s, %s, %s, %s, %s, %s)", 
-                                (street_id, target_asset_id, target_asset_latitude, target_asset_longitude, closest_neighbor_id, closest_neighbor_distance, second_closest_neighbor_id, second_closest_neighbor_distance))
-            except:
-                print "I am unable to insert into global_asset_neighbors table for street %d, asset %d." % (street_id, target_asset_id)
+            #insert neighbors of the target asset into global_asset_neighbors table
+            neighborWriter.write((street_id, target_asset_id, target_asset_latitude, target_asset_longitude, closest_neighbor_id, closest_neighbor_distance, second_closest_neighbor_id, second_closest_neighbor_distance))
 
-            #commit the global neighbor update into the database        
-            self.conn.commit()
+        #commit the global neighbor update into the database
+        neighborWriter.close()
                     
 
     def run(self):
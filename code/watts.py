@@ -157,6 +157,15 @@ class ComputeWatts:
             print("I am unable to get data")
 
         rows = self.cur.fetchall() 
+
+        return self.computeWattsForRows(asset_id, rows)
+
+    def computeWattsForRows(self, asset_id, rows):
+        """ compute the wattage of each interval between consecutive rows (asset_id, kwh, timestamp_utc) ordered by timestamp_utc
+
+        return:  list of (asset_id, interval end time, wattage)
+
+        """
         if len(rows) == 0:
             return []
         